@@ -31,6 +31,9 @@ control_broker_stack = ControlBrokerStack(
     f"ControlBroker{STACK_VERSION}",
     env=env,
     pac_framework=app.node.try_get_context("control-broker/pac-framework"),
+    pac_bundle_optimization_level=app.node.try_get_context(
+        "control-broker/pac-bundle/optimization-level"
+    ),
 )
 
 if continuously_deployed:
@@ -101,6 +101,7 @@ class ControlBrokerApi(aws_apigatewayv2_alpha.HttpApi):
         name: str,
         lambda_function: aws_cdk.aws_lambda.Function,
         path: str,
+        grant_eval_engine_invoke: bool = True,
         **kwargs: Any,
     ) -> aws_apigatewayv2_alpha.HttpRoute:
         """Add a Control Broker Handler to process requests. Expected to invoke the Control Broker upon successful completion.
@@ -113,13 +114,17 @@ class ControlBrokerApi(aws_apigatewayv2_alpha.HttpApi):
         :type lambda_function: aws_cdk.aws_lambda.Function
         :param path: Path on the API for this handler.
         :type path: str
+        :param grant_eval_engine_invoke: Whether the handler may call the Eval Engine route. Not needed when
+                                         handlers reach the engine another way, e.g. by invoking it directly.
+        :type grant_eval_engine_invoke: bool
         :param *kwargs: Keyword arguments are passing to the
                         aws_apigatewayv2_alpha.HttpApi.add_routes() method. This allows setting
                         authorizers, for instance.
         :type *kwargs: Any
         """
 
-        self.eval_engine_route.grant_invoke(lambda_function)
+        if grant_eval_engine_invoke:
+            self.eval_engine_route.grant_invoke(lambda_function)
 
         # TODO: Test that users cannot inject their own eval engine URL when calling the API with that header
         integration = aws_apigatewayv2_integrations_alpha.HttpLambdaIntegration(
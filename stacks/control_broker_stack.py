@@ -4,13 +4,18 @@ from typing import List, Sequence
 from os import path
 
 from aws_cdk import (
+    BundlingOptions,
+    DockerImage,
     Duration,
     Stack,
     CfnOutput,
     RemovalPolicy,
     aws_lambda,
+    aws_lambda_destinations,
+    aws_lambda_event_sources,
     aws_iam,
     aws_config,
+    aws_dynamodb,
     aws_sqs,
     aws_s3,
     aws_s3_deployment,
@@ -31,7 +36,9 @@ from constructs import Construct
 
 from components.control_broker_api import ControlBrokerApi
 
+from utils import paths
 from utils.mixins import SecretConfigStackMixin
+from utils.pac_frameworks import package_path, policy_index, rego_packages
 
 
 class ControlBrokerStack(Stack, SecretConfigStackMixin):
@@ -40,25 +47,26 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
         scope: Construct,
         construct_id: str,
         pac_framework: str,
+        pac_bundle_optimization_level: int = 1,
         **kwargs,
     ) -> None:
 
         super().__init__(scope, construct_id, **kwargs)
 
         self.pac_framework = pac_framework
+        self.pac_bundle_optimization_level = pac_bundle_optimization_level
+        
+        # "server" keeps one OPA server per container, "eval" runs a fresh opa eval process per request,
+        # "wasm" evaluates policies compiled to Wasm in-process
+        
+        self.opa_mode = self.node.try_get_context("control-broker/eval-engine/opa-mode") or "eval"
 
         self.layers = {
-            'requests': aws_lambda_python_alpha.PythonLayerVersion(self,
-                    "requests",
-                    entry="./supplementary_files/lambda_layers/requests",
-                    compatible_runtimes=[
-                        aws_lambda.Runtime.PYTHON_3_9
-                    ]
-                ),
-            'aws_requests_auth':aws_lambda_python_alpha.PythonLayerVersion(
+            # modules shared by every Lambda, e.g. instrumentation, and the handlers' SigV4 transport to the engine
+            'common':aws_lambda_python_alpha.PythonLayerVersion(
                     self,
-                    "aws_requests_auth",
-                    entry="./supplementary_files/lambda_layers/aws_requests_auth",
+                    "common",
+                    entry="./supplementary_files/lambda_layers/common",
                     compatible_runtimes=[
                         aws_lambda.Runtime.PYTHON_3_9
                     ]
@@ -77,6 +85,7 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
         self.input_handler_sam()
         
         self.eval_engine()
+        self.eval_engine_transport()
         
         self.api = ControlBrokerApi(
             self,
@@ -96,6 +105,7 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
             "EvaluationContext",
             removal_policy=RemovalPolicy.DESTROY,
             auto_delete_objects=True,
+            versioned=True,
             block_public_access=aws_s3.BlockPublicAccess(
                 block_public_acls=True,
                 ignore_public_acls=True,
@@ -128,6 +138,7 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
             "PaCPolicies",
             removal_policy=RemovalPolicy.DESTROY,
             auto_delete_objects=True,
+            versioned=True,
             block_public_access=aws_s3.BlockPublicAccess(
                 block_public_acls=True,
                 ignore_public_acls=True,
@@ -135,15 +146,33 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
                 restrict_public_buckets=True,
             ),
         )
-
+        """
+        NB: the PaC framework is published as a single optimized OPA bundle rather than loose .rego files,
+        so the Eval Engine fetches one object and skips parsing and compiling policies on every evaluation.
+        """
+        self.pac_bundle_key = f"{self.pac_framework}/bundle.tar.gz"
+        
+        # the same policies compiled to Wasm, only built when the Eval Engine evaluates in-process
+        
+        self.pac_wasm_bundle_key = f"{self.pac_framework}/bundle-wasm.tar.gz"
+        
+        # InputType -> applicable packages, so the Eval Engine only queries policies relevant to each input
+        
+        self.pac_policy_index_key = f"{self.pac_framework}/policy-index.json"
 
         aws_s3_deployment.BucketDeployment(
             self,
             "PaCPoliciesDeployment",
             sources=[
-                aws_s3_deployment.Source.asset("./supplementary_files/pac_frameworks")
+                self.pac_bundle_source(),
+                aws_s3_deployment.Source.json_data(
+                    "policy-index.json",
+                    policy_index(paths.PAC_FRAMEWORKS / self.pac_framework)
+                ),
+                *([self.pac_bundle_source(target="wasm")] if self.opa_mode == "wasm" else []),
             ],
             destination_bucket=self.bucket_pac_policies,
+            destination_key_prefix=self.pac_framework,
             retain_on_delete=False,
         )
         
@@ -163,6 +192,47 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
             event_bridge_enabled=True
         )
         
+    def pac_bundle_source(self, target: str = "rego"):
+        
+        pac_framework_path = paths.PAC_FRAMEWORKS / self.pac_framework
+        
+        opa_version = json.loads(
+            (paths.LAMBDA_FUNCTIONS / "eval_engine_lambdalith/opa_version.json").read_text()
+        )["version"]
+        
+        packages = [package_path(package) for package in rego_packages(pac_framework_path)]
+        
+        # declaring the policy packages as bundle roots tells the optimizer that InputType, ApprovedContext
+        # and EvaluationContext are supplied at evaluation time, so they are not folded away as undefined
+        
+        manifest = json.dumps({"roots": packages})
+        
+        output = "bundle.tar.gz" if target == "rego" else f"bundle-{target}.tar.gz"
+        
+        opa_build = " ".join(
+            [
+                "/opa build",
+                f"--target {target}",
+                "--bundle /tmp/bundle",
+                # the Wasm planner works from the unoptimized policies
+                *([f"--optimize {self.pac_bundle_optimization_level}"] if target == "rego" else []),
+                *[f"--entrypoint {package}" for package in packages],
+                f"--output /asset-output/{output}",
+            ]
+        )
+        
+        return aws_s3_deployment.Source.asset(
+            str(pac_framework_path),
+            bundling=BundlingOptions(
+                # -debug variant ships a shell, needed to stage the manifest next to the policies
+                image=DockerImage.from_registry(f"openpolicyagent/opa:{opa_version}-debug"),
+                entrypoint=["/busybox/sh", "-c"],
+                command=[
+                    f"mkdir -p /tmp/bundle && cp -r /asset-input/. /tmp/bundle && echo '{manifest}' > /tmp/bundle/.manifest && {opa_build}"
+                ],
+            ),
+        )
+        
     def output_handler_event_driven(self):
         
         self.bucket_output_handler = aws_s3.Bucket(
@@ -223,6 +293,9 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
                 "InfractionsEventBusName":self.event_bus_infractions.event_bus_name,
                 "OutputHandlerProcessedResultsBucket":self.bucket_output_handler.bucket_name
             },
+            layers=[
+                self.layers['common']
+            ]
         )
         
         self.lambda_output_handler_opa.role.add_to_policy(
@@ -334,8 +407,7 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
                 "CloudFormationRawInputsBucket": self.bucket_cloudformation_raw_inputs.bucket_name,
             },
             layers=[
-                self.layers['requests'],
-                self.layers['aws_requests_auth']
+                self.layers['common']
             ]
         )
         
@@ -415,8 +487,7 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
                 "ConfigEventsConvertedInputsBucket":self.bucket_config_events_converted_inputs.bucket_name
             },
             layers=[
-                self.layers['requests'],
-                self.layers['aws_requests_auth']
+                self.layers['common']
             ]
         )
         
@@ -805,8 +876,7 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
                 "CFNHookConvertedInputsBucket":self.bucket_cfn_hook_converted_inputs.bucket_name
             },
             layers=[
-                self.layers['requests'],
-                self.layers['aws_requests_auth']
+                self.layers['common']
             ]
         )
         
@@ -920,8 +990,7 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
                 "CrossCloudInputsBucket": self.bucket_cross_cloud_inputs.bucket_name
             },
             layers=[
-                self.layers['requests'],
-                self.layers['aws_requests_auth']
+                self.layers['common']
             ]
         )
     
@@ -990,8 +1059,7 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
                 "TerraformInputsBucket": self.bucket_terraform_inputs.bucket_name
             },
             layers=[
-                self.layers['requests'],
-                self.layers['aws_requests_auth']
+                self.layers['common']
             ]
         )
     
@@ -1060,8 +1128,7 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
                 "SAMInputsBucket": self.bucket_sam_inputs.bucket_name
             },
             layers=[
-                self.layers['requests'],
-                self.layers['aws_requests_auth']
+                self.layers['common']
             ]
         )
     
@@ -1092,6 +1159,152 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
         )
         
     def eval_engine(self):
+        
+        # how long a warm container trusts its cached EvaluationContext before a conditional GET
+        
+        evaluation_context_ttl_seconds = self.node.try_get_context(
+            "control-broker/eval-engine/evaluation-context-ttl-seconds"
+        ) or 0
+        
+        # server mode only: distinct (InputType, ApprovedContext) combinations kept partially evaluated per container
+        
+        partial_evaluation_cache_size = self.node.try_get_context(
+            "control-broker/eval-engine/partial-evaluation-cache-size"
+        ) or 32
+        
+        # results are passed through as bytes rather than parsed, so memory can be tuned down from the maximum
+        
+        memory_size = self.node.try_get_context("control-broker/eval-engine/memory-size") or 3008
+        
+        # templates evaluated one resource at a time for packages declaring evaluation_unit = "resource",
+        # reusing each container's verdicts for unchanged resources; every changed resource is one OPA query,
+        # cheap against the OPA server, a process each in "eval" mode
+        
+        incremental_evaluation = bool(self.node.try_get_context("control-broker/eval-engine/incremental-evaluation"))
+        
+        incremental_cache_size = self.node.try_get_context(
+            "control-broker/eval-engine/incremental-cache-size"
+        ) or 4096
+        
+        # inputs at least this large are split into resource chunks for resource-local packages and evaluated in
+        # parallel, one chunk per vCPU (Lambda allots vCPUs in proportion to memory_size) unless set otherwise
+        
+        chunked_evaluation_min_bytes = self.node.try_get_context(
+            "control-broker/eval-engine/chunked-evaluation-min-bytes"
+        ) or 1024 * 1024
+        
+        evaluation_concurrency = self.node.try_get_context("control-broker/eval-engine/evaluation-concurrency") or 0
+        
+        # each applicable package queried on its own, in parallel, and reported as timed out past this deadline;
+        # 0 queries them together
+        
+        package_deadline_ms = self.node.try_get_context("control-broker/eval-engine/package-deadline-ms") or 0
+        
+        # kept back from a request's budget by the engine, and from their own by the handlers, to answer in
+        
+        deadline_margin_ms = self.node.try_get_context("control-broker/eval-engine/deadline-margin-ms") or 500
+        
+        engine_call_attempts = self.node.try_get_context("control-broker/eval-engine/engine-call-attempts") or 3
+        
+        # handlers pass inputs up to this size inline rather than through S3, and archive them off the critical path
+        
+        inline_input_max_bytes = self.node.try_get_context("control-broker/eval-engine/inline-input-max-bytes") or 0
+        
+        # byte-identical requests answered from earlier raw results: "s3" keeps copies, "dynamodb" keeps pointers
+        
+        result_cache_store = self.node.try_get_context("control-broker/eval-engine/result-cache-store") or "none"
+        
+        result_cache_ttl_seconds = self.node.try_get_context(
+            "control-broker/eval-engine/result-cache-ttl-seconds"
+        ) or 86400
+        
+        # "never", "cold" (only while a container has not loaded policies) or "always" serve the last verdict
+        # for an input when its exact verdict is missing, and revalidate it asynchronously
+        
+        result_cache_serve_stale = self.node.try_get_context(
+            "control-broker/eval-engine/result-cache-serve-stale"
+        ) or "never"
+        
+        result_cache_stale_seconds = self.node.try_get_context(
+            "control-broker/eval-engine/result-cache-stale-seconds"
+        ) or 0
+        
+        result_cache_environment = {
+            "ResultCacheStore": result_cache_store,
+            "ResultCacheTTLSeconds": str(result_cache_ttl_seconds),
+            "ResultCacheServeStale": result_cache_serve_stale,
+            "ResultCacheStaleSeconds": str(result_cache_stale_seconds),
+        }
+        
+        if result_cache_store == "s3":
+            self.bucket_result_cache = aws_s3.Bucket(
+                self,
+                "EvalResultCache",
+                removal_policy=RemovalPolicy.DESTROY,
+                auto_delete_objects=True,
+                block_public_access=aws_s3.BlockPublicAccess.BLOCK_ALL,
+                lifecycle_rules=[
+                    aws_s3.LifecycleRule(
+                        expiration=Duration.days(
+                            max(1, -(-max(result_cache_ttl_seconds, result_cache_stale_seconds) // 86400))
+                        )
+                    )
+                ],
+            )
+            result_cache_environment["ResultCacheBucket"] = self.bucket_result_cache.bucket_name
+        elif result_cache_store == "dynamodb":
+            self.table_result_cache = aws_dynamodb.Table(
+                self,
+                "EvalResultCacheTable",
+                partition_key=aws_dynamodb.Attribute(
+                    name="CacheKey", type=aws_dynamodb.AttributeType.STRING
+                ),
+                billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+                time_to_live_attribute="ExpiresAt",
+                removal_policy=RemovalPolicy.DESTROY,
+            )
+            result_cache_environment["ResultCacheTable"] = self.table_result_cache.table_name
+        
+        # handlers answer identical requests, and retries with the same Idempotency-Key, with the evaluation
+        # already issued: "memory" per container, "dynamodb" across them, "none" evaluates every request
+        
+        coalescing_store = self.node.try_get_context("control-broker/eval-engine/coalescing-store") or "none"
+        
+        coalescing_window_seconds = self.node.try_get_context(
+            "control-broker/eval-engine/coalescing-window-seconds"
+        ) or 300
+        
+        coalescing_environment = {
+            "CoalescingStore": coalescing_store,
+            "CoalescingWindowSeconds": str(coalescing_window_seconds),
+        }
+        
+        if coalescing_store == "dynamodb":
+            self.table_request_coalescing = aws_dynamodb.Table(
+                self,
+                "RequestCoalescingTable",
+                partition_key=aws_dynamodb.Attribute(
+                    name="CoalescingKey", type=aws_dynamodb.AttributeType.STRING
+                ),
+                billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+                time_to_live_attribute="ExpiresAt",
+                removal_policy=RemovalPolicy.DESTROY,
+            )
+            coalescing_environment["CoalescingTable"] = self.table_request_coalescing.table_name
+        
+        layers = [self.layers['common']]
+        
+        if self.opa_mode == "wasm":
+            layers.append(
+                aws_lambda_python_alpha.PythonLayerVersion(
+                    self,
+                    "wasmtime",
+                    entry="./supplementary_files/lambda_layers/wasmtime",
+                    compatible_runtimes=[
+                        aws_lambda.Runtime.PYTHON_3_9
+                    ]
+                )
+            )
 
         self.lambda_eval_engine_lambdalith = aws_lambda.Function(
             self,
@@ -1099,18 +1312,52 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
             runtime=aws_lambda.Runtime.PYTHON_3_9,
             handler="lambda_function.lambda_handler",
             timeout=Duration.seconds(60),
-            memory_size=3008, # TODO power-tune
+            memory_size=memory_size, # TODO power-tune
             code=aws_lambda.Code.from_asset(
                 "./supplementary_files/lambdas/eval_engine_lambdalith"
             ),
             environment={
                 "PaCFramework": self.pac_framework,
                 "PaCPoliciesBucket": self.bucket_pac_policies.bucket_name,
+                "PaCBundleKey": self.pac_wasm_bundle_key if self.opa_mode == "wasm" else self.pac_bundle_key,
+                "PaCPolicyIndexKey": self.pac_policy_index_key,
+                "OpaMode": self.opa_mode,
                 "EvaluationContext": json.dumps(self.evaluation_context) ,
-                "RawPaCResultsBucket": self.bucket_raw_pac_results.bucket_name
+                "EvaluationContextCacheTTLSeconds": str(evaluation_context_ttl_seconds),
+                "PartialEvaluationCacheSize": str(partial_evaluation_cache_size),
+                "IncrementalEvaluation": str(incremental_evaluation).lower(),
+                "IncrementalCacheSize": str(incremental_cache_size),
+                "ChunkedEvaluationMinBytes": str(chunked_evaluation_min_bytes),
+                "EvaluationConcurrency": str(evaluation_concurrency),
+                "PackageDeadlineMs": str(package_deadline_ms),
+                "EngineDeadlineMarginMs": str(deadline_margin_ms),
+                "RawPaCResultsBucket": self.bucket_raw_pac_results.bucket_name,
+                **result_cache_environment,
             },
+            layers=layers,
         )
         
+        # handlers send the engine what is left of their budget, retry failed calls while it lasts,
+        # inline small inputs and coalesce identical requests
+        
+        for handler in [
+            self.lambda_invoked_by_apigw_cfn_hook,
+            self.lambda_invoked_by_apigw_cloudformation,
+            self.lambda_invoked_by_apigw_config_event,
+            self.lambda_invoked_by_apigw_cross_cloud,
+            self.lambda_invoked_by_apigw_terraform,
+            self.lambda_invoked_by_apigw_sam,
+        ]:
+            handler.add_environment("DeadlineMarginMs", str(deadline_margin_ms))
+            handler.add_environment("EvalEngineAttempts", str(engine_call_attempts))
+            handler.add_environment("InlineInputMaxBytes", str(inline_input_max_bytes))
+            for name, value in coalescing_environment.items():
+                handler.add_environment(name, value)
+            if coalescing_store == "dynamodb":
+                self.table_request_coalescing.grant(
+                    handler, "dynamodb:GetItem", "dynamodb:PutItem", "dynamodb:UpdateItem", "dynamodb:DeleteItem"
+                )
+        
         self.lambda_eval_engine_lambdalith.role.add_to_policy(
             aws_iam.PolicyStatement(
                 actions=[
@@ -1141,6 +1388,7 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
             aws_iam.PolicyStatement(
                 actions=[
                     "s3:PutObject",
+                    "s3:AbortMultipartUpload",
                     "s3:GetBucket",
                     "s3:List*",
                 ],
@@ -1150,33 +1398,181 @@ class ControlBrokerStack(Stack, SecretConfigStackMixin):
                 ],
             )
         )
+        
+        if result_cache_store != "none":
+            
+            # hits are server-side copies, which read the cached raw result as well as write the requested one
+            
+            self.lambda_eval_engine_lambdalith.role.add_to_policy(
+                aws_iam.PolicyStatement(
+                    actions=[
+                        "s3:GetObject",
+                    ],
+                    resources=[
+                        self.bucket_raw_pac_results.arn_for_objects("*"),
+                    ],
+                )
+            )
+        
+        if result_cache_store == "s3":
+            self.bucket_result_cache.grant_read_write(self.lambda_eval_engine_lambdalith)
+        elif result_cache_store == "dynamodb":
+            self.table_result_cache.grant(
+                self.lambda_eval_engine_lambdalith, "dynamodb:GetItem", "dynamodb:PutItem"
+            )
+        
+        if result_cache_store != "none" and result_cache_serve_stale != "never":
+            
+            # revalidation invokes the engine itself asynchronously; a policy of its own rather than the role's
+            # default policy, which the function depends on, so that naming the function's ARN makes no cycle
+            
+            aws_iam.Policy(
+                self,
+                "EvalEngineLambdalithRevalidation",
+                roles=[self.lambda_eval_engine_lambdalith.role],
+                statements=[
+                    aws_iam.PolicyStatement(
+                        actions=[
+                            "lambda:InvokeFunction",
+                        ],
+                        resources=[
+                            self.lambda_eval_engine_lambdalith.function_arn,
+                        ],
+                    )
+                ],
+            )
+    
+    def eval_engine_transport(self):
+        
+        # "http": handlers call the engine through API Gateway and wait for it,
+        # "lambda": handlers invoke the engine function directly and wait for it,
+        # "lambda-event": handlers invoke the engine function asynchronously and return,
+        # "sqs": handlers enqueue the engine input and return, the engine consumes the queue in batches.
+        # Only the chosen transport is granted; the API route stays for other callers either way
+        
+        self.eval_engine_transport_name = self.node.try_get_context("control-broker/eval-engine/transport") or "http"
+        
+        transport = self.eval_engine_transport_name
+        
+        if transport not in ("http", "lambda", "lambda-event", "sqs"):
+            raise ValueError(f"unknown control-broker/eval-engine/transport: {transport}")
+        
+        handlers = [
+            self.lambda_invoked_by_apigw_cfn_hook,
+            self.lambda_invoked_by_apigw_cloudformation,
+            self.lambda_invoked_by_apigw_config_event,
+            self.lambda_invoked_by_apigw_cross_cloud,
+            self.lambda_invoked_by_apigw_terraform,
+            self.lambda_invoked_by_apigw_sam,
+        ]
+        
+        for handler in handlers:
+            handler.add_environment("EvalEngineTransport", transport)
+        
+        if transport == "http":
+            return
+        
+        # receives, or asynchronous attempts, before a request is moved to the dead-letter queue, from where it can be redriven
+        
+        max_receive_count = self.node.try_get_context("control-broker/eval-engine/queue-max-receive-count") or 3
+        
+        if transport != "lambda":
+            self.queue_eval_engine_dead_letters = aws_sqs.Queue(
+                self,
+                "EvalEngineDeadLetters",
+                retention_period=Duration.days(14),
+            )
+            CfnOutput(self, "EvalEngineDeadLettersUrl", value=self.queue_eval_engine_dead_letters.queue_url)
+        
+        if transport in ("lambda", "lambda-event"):
+            
+            for handler in handlers:
+                handler.add_environment("EvalEngineFunctionName", self.lambda_eval_engine_lambdalith.function_name)
+                # a read outlasts the engine's own timeout, by which it has answered or failed
+                handler.add_environment(
+                    "EvalEngineInvokeReadTimeoutSeconds",
+                    str(self.lambda_eval_engine_lambdalith.timeout.to_seconds() + 5),
+                )
+                self.lambda_eval_engine_lambdalith.grant_invoke(handler)
+            
+            if transport == "lambda-event":
+                # Lambda allows at most two retries of an asynchronous invocation
+                self.lambda_eval_engine_lambdalith.configure_async_invoke(
+                    retry_attempts=min(2, max_receive_count - 1),
+                    on_failure=aws_lambda_destinations.SqsDestination(self.queue_eval_engine_dead_letters),
+                )
+            
+            return
+        
+        batch_size = self.node.try_get_context("control-broker/eval-engine/queue-batch-size") or 10
+        
+        batching_window_seconds = self.node.try_get_context(
+            "control-broker/eval-engine/queue-batching-window-seconds"
+        ) or 0
+        
+        self.queue_eval_engine = aws_sqs.Queue(
+            self,
+            "EvalEngineQueue",
+            # at least six times the engine's timeout, as recommended for Lambda event sources
+            visibility_timeout=Duration.seconds(6 * self.lambda_eval_engine_lambdalith.timeout.to_seconds()),
+            dead_letter_queue=aws_sqs.DeadLetterQueue(
+                max_receive_count=max_receive_count,
+                queue=self.queue_eval_engine_dead_letters,
+            ),
+        )
+        
+        self.lambda_eval_engine_lambdalith.add_event_source(
+            aws_lambda_event_sources.SqsEventSource(
+                self.queue_eval_engine,
+                batch_size=batch_size,
+                max_batching_window=Duration.seconds(batching_window_seconds) if batching_window_seconds else None,
+                # failed messages are returned as batchItemFailures and retried on their own
+                report_batch_item_failures=True,
+            )
+        )
+        
+        for handler in handlers:
+            handler.add_environment("EvalEngineQueueUrl", self.queue_eval_engine.queue_url)
+            self.queue_eval_engine.grant_send_messages(handler)
+        
+        CfnOutput(self, "EvalEngineQueueUrl", value=self.queue_eval_engine.queue_url)
     
     def add_apis(self):
         
+        # handlers only need the Eval Engine route when they call the engine through it
+        
+        grant_eval_engine_invoke = self.eval_engine_transport_name == "http"
+        
         handler_url_cfn_hook = self.api.add_api_handler(
-            "CFNHook", self.lambda_invoked_by_apigw_cfn_hook, "/CFNHook"
+            "CFNHook", self.lambda_invoked_by_apigw_cfn_hook, "/CFNHook",
+            grant_eval_engine_invoke = grant_eval_engine_invoke
         )
 
         handler_url_config_event = self.api.add_api_handler(
-            "ConfigEvent", self.lambda_invoked_by_apigw_config_event, "/ConfigEvent"
+            "ConfigEvent", self.lambda_invoked_by_apigw_config_event, "/ConfigEvent",
+            grant_eval_engine_invoke = grant_eval_engine_invoke
         )
         
         handler_url_cloudformation = self.api.add_api_handler(
-            "CloudFormation", self.lambda_invoked_by_apigw_cloudformation, "/CloudFormation"
+            "CloudFormation", self.lambda_invoked_by_apigw_cloudformation, "/CloudFormation",
+            grant_eval_engine_invoke = grant_eval_engine_invoke
         )
         
         handler_url_cloudformation = self.api.add_api_handler(
             "CrossCloudCustomAuth",
             self.lambda_invoked_by_apigw_cross_cloud,
             "/CrossCloudCustomAuth",
+            grant_eval_engine_invoke = grant_eval_engine_invoke,
             authorizer = self.authorizer_lambda_cross_cloud
         )
         
         handler_url_cloudformation = self.api.add_api_handler(
-            "Terraform", self.lambda_invoked_by_apigw_terraform, "/Terraform"
+            "Terraform", self.lambda_invoked_by_apigw_terraform, "/Terraform",
+            grant_eval_engine_invoke = grant_eval_engine_invoke
         )
         
         handler_url_cloudformation = self.api.add_api_handler(
-            "SAM", self.lambda_invoked_by_apigw_sam, "/SAM"
+            "SAM", self.lambda_invoked_by_apigw_sam, "/SAM",
+            grant_eval_engine_invoke = grant_eval_engine_invoke
         )
         
\ No newline at end of file
@@ -0,0 +1,27 @@
+import threading
+
+class LazyClient():
+    """A boto3 client that is only created, and boto3 only imported, on first use.
+
+    Stands in for `boto3.client(service_name)` at module level, so a cold start does not pay
+    for clients (or boto3 itself) until an invocation actually needs them.
+    """
+
+    def __init__(self,service_name,**kwargs):
+        self._service_name = service_name
+        self._kwargs = kwargs
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    self._client = boto3.client(self._service_name,**self._kwargs)
+
+        return self._client
+
+    def __getattr__(self,name):
+        return getattr(self.get(),name)
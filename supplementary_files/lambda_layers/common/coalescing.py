@@ -0,0 +1,306 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from clients import LazyClient
+
+# identical requests within the window share one evaluation: "memory" coalesces within a container,
+# "dynamodb" across all of a handler's containers, "none" turns coalescing off
+
+COALESCING_STORES = {'none','memory','dynamodb'}
+
+COALESCING_WINDOW_SECONDS = int(os.environ.get('CoalescingWindowSeconds',300))
+
+# the memory store's size per container; once full, expired entries go first, then the least recently claimed
+
+COALESCING_MEMORY_MAX_ENTRIES = int(os.environ.get('CoalescingMemoryMaxEntries',10000))
+
+# API Gateway HTTP APIs pass header names lowercased
+
+IDEMPOTENCY_KEY_HEADER = 'idempotency-key'
+
+class IdempotencyKeyReused(ValueError):
+    pass
+
+def canonical_json(value):
+    return json.dumps(value,sort_keys=True,separators=(',',':'),ensure_ascii=False).encode('utf-8')
+
+def request_fingerprint(*,consumer_metadata,input_type,context,input):
+    """sha256 over what decides a verdict: the input, the approved context and the input type.
+
+    Scoped by the consumer too, since the evaluation is reported under its ConsumerMetadata.
+    """
+
+    return hashlib.sha256(canonical_json({
+        'ConsumerMetadata': consumer_metadata,
+        'InputType': input_type,
+        'Context': context,
+        'Input': input
+    })).hexdigest()
+
+def idempotency_fingerprint(*,consumer_metadata,idempotency_key:str):
+
+    # a client's key only names its own requests, so it is scoped by who sent it
+
+    return hashlib.sha256(canonical_json({
+        'ConsumerMetadata': consumer_metadata,
+        'IdempotencyKey': idempotency_key
+    })).hexdigest()
+
+class MemoryCoalescingStore():
+    """In-process store, for tests and for coalescing retries that reach the same container."""
+
+    def __init__(self,*,max_entries:int=COALESCING_MEMORY_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def purge(self,now:float):
+
+        # a scan only once full, and down to 90% so that the next claims do not scan again
+
+        for key in [key for key, entry in self.entries.items() if entry['ExpiresAt'] <= now]:
+            del self.entries[key]
+
+        while len(self.entries) > self.max_entries*9//10:
+            self.entries.popitem(last=False)
+
+    def claim(self,key,*,evaluation_keys:list,fingerprint:str,expires_at:float):
+
+        # None when claimed, else the live entry: {'EvaluationKeys','Fingerprint'}
+
+        with self.lock:
+            now = time.time()
+            entry = self.entries.get(key)
+            if entry and entry['ExpiresAt'] > now:
+                return entry
+            self.entries[key] = {'EvaluationKeys': evaluation_keys,'Fingerprint': fingerprint,'ExpiresAt': expires_at}
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.purge(now)
+            return None
+
+    def extend(self,key,*,evaluation_keys:list,expires_at:float):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['EvaluationKeys'] == evaluation_keys:
+                entry['ExpiresAt'] = expires_at
+
+    def release(self,key,*,evaluation_keys:list):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['EvaluationKeys'] == evaluation_keys:
+                del self.entries[key]
+
+class DynamoDBCoalescingStore():
+    """Entries shared by every container, claimed with a conditional put.
+
+    ExpiresAt is also the table's TTL attribute; removal is best-effort, so claims compare it too.
+    """
+
+    def __init__(self,*,dynamodb,table:str):
+        self.dynamodb = dynamodb
+        self.table = table
+
+    def claim(self,key,*,evaluation_keys:list,fingerprint:str,expires_at:float):
+
+        from botocore.exceptions import ClientError
+
+        try:
+            self.dynamodb.put_item(
+                TableName = self.table,
+                Item = {
+                    'CoalescingKey': {'S': key},
+                    'EvaluationKeys': {'S': json.dumps(evaluation_keys)},
+                    'Fingerprint': {'S': fingerprint},
+                    'ExpiresAt': {'N': str(int(expires_at))}
+                },
+                ConditionExpression = 'attribute_not_exists(CoalescingKey) OR ExpiresAt < :now',
+                ExpressionAttributeValues = {':now': {'N': str(int(time.time()))}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        else:
+            return None
+
+        r = self.dynamodb.get_item(
+            TableName = self.table,
+            Key = {'CoalescingKey': {'S': key}},
+            ConsistentRead = True
+        )
+
+        return {
+            'EvaluationKeys': json.loads(r['Item']['EvaluationKeys']['S']),
+            'Fingerprint': r['Item'].get('Fingerprint',{}).get('S')
+        }
+
+    def extend(self,key,*,evaluation_keys:list,expires_at:float):
+
+        from botocore.exceptions import ClientError
+
+        try:
+            self.dynamodb.update_item(
+                TableName = self.table,
+                Key = {'CoalescingKey': {'S': key}},
+                UpdateExpression = 'SET ExpiresAt = :expires_at',
+                ConditionExpression = 'EvaluationKeys = :evaluation_keys',
+                ExpressionAttributeValues = {
+                    ':expires_at': {'N': str(int(expires_at))},
+                    ':evaluation_keys': {'S': json.dumps(evaluation_keys)}
+                }
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    def release(self,key,*,evaluation_keys:list):
+
+        from botocore.exceptions import ClientError
+
+        try:
+            self.dynamodb.delete_item(
+                TableName = self.table,
+                Key = {'CoalescingKey': {'S': key}},
+                ConditionExpression = 'EvaluationKeys = :evaluation_keys',
+                ExpressionAttributeValues = {':evaluation_keys': {'S': json.dumps(evaluation_keys)}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+class Claim():
+
+    def __init__(self,*,evaluation_keys:list,coalesced:bool,keys:list):
+        self.evaluation_keys = evaluation_keys
+        self.coalesced = coalesced
+        self.keys = keys
+
+class RequestCoalescer():
+    """Single-flight for handler requests: one evaluation per Idempotency-Key or per request fingerprint.
+
+    The first request claims its keys for its evaluation keys, a lease that lasts as long as its own
+    invocation can run. Once the engine has the request the lease is extended to window_seconds; if the
+    engine fails it is released, and if the handler dies it lapses. Requests matching a live entry get
+    its evaluation keys, and so its results, without any new work.
+    """
+
+    def __init__(self,*,store,window_seconds:int=COALESCING_WINDOW_SECONDS):
+        self.store = store
+        self.window_seconds = window_seconds
+
+    def claim(self,*,scope:str,keys:list,fingerprint:str,evaluation_keys:list,lease_seconds=None):
+        """Claims every key (the request fingerprint, an idempotency fingerprint) for evaluation_keys.
+
+        The request's own fingerprint is stored with each, so a key already claimed by a different
+        request raises IdempotencyKeyReused rather than handing out that request's evaluation.
+        """
+
+        keys = [f'{scope}/{key}' for key in keys if key]
+
+        if self.store is None:
+            return Claim(evaluation_keys=evaluation_keys,coalesced=False,keys=[])
+
+        expires_at = time.time() + (lease_seconds if lease_seconds is not None else self.window_seconds)
+
+        claimed = []
+
+        for key in keys:
+
+            try:
+                existing = self.store.claim(key,evaluation_keys=evaluation_keys,fingerprint=fingerprint,expires_at=expires_at)
+            except Exception as e:
+                # coalescing is an optimization, an unavailable store evaluates the request as usual
+                print(f'request coalescing failed:\n{e}')
+                return Claim(evaluation_keys=evaluation_keys,coalesced=False,keys=claimed)
+
+            if existing is None:
+                claimed.append(key)
+                continue
+
+            self.release(Claim(evaluation_keys=evaluation_keys,coalesced=False,keys=claimed))
+
+            if existing['Fingerprint'] not in (None,fingerprint):
+                raise IdempotencyKeyReused(f'Idempotency-Key already used for a different request: {key}')
+
+            print(f'request coalesced:\nkey:\n{key}\nevaluation_keys:\n{existing["EvaluationKeys"]}')
+
+            return Claim(evaluation_keys=existing['EvaluationKeys'],coalesced=True,keys=[])
+
+        return Claim(evaluation_keys=evaluation_keys,coalesced=False,keys=claimed)
+
+    def claim_request(self,*,
+        scope:str,
+        headers:dict,
+        consumer_metadata,
+        input_type,
+        context,
+        input,
+        evaluation_keys:list,
+        lease_seconds=None
+    ):
+        """claim() by the request's Idempotency-Key header, if sent, and by its fingerprint."""
+
+        idempotency_key = next((v for k,v in headers.items() if k.lower() == IDEMPOTENCY_KEY_HEADER),None)
+
+        fingerprint = request_fingerprint(consumer_metadata=consumer_metadata,input_type=input_type,context=context,input=input)
+
+        return self.claim(
+            scope = scope,
+            keys = [
+                idempotency_fingerprint(consumer_metadata=consumer_metadata,idempotency_key=idempotency_key) if idempotency_key else None,
+                fingerprint
+            ],
+            fingerprint = fingerprint,
+            evaluation_keys = evaluation_keys,
+            lease_seconds = lease_seconds
+        )
+
+    def settle(self,claim:Claim,eval_engine_response):
+
+        # the engine has the request: later matches may share it for the window, unless it was refused
+
+        succeeded = isinstance(eval_engine_response,dict) and eval_engine_response.get('StatusCode',200) < 400
+
+        if not succeeded:
+            return self.release(claim)
+
+        for key in claim.keys:
+            try:
+                self.store.extend(key,evaluation_keys=claim.evaluation_keys,expires_at=time.time() + self.window_seconds)
+            except Exception as e:
+                print(f'request coalescing settle failed:\nkey:\n{key}\n{e}')
+
+    def release(self,claim:Claim):
+
+        # the request never reached the engine, so the next match evaluates it rather than waiting on nothing
+
+        for key in claim.keys:
+            try:
+                self.store.release(key,evaluation_keys=claim.evaluation_keys)
+            except Exception as e:
+                print(f'request coalescing release failed:\nkey:\n{key}\n{e}')
+
+def get_request_coalescer():
+
+    store = os.environ.get('CoalescingStore','none')
+
+    if store not in COALESCING_STORES:
+        raise ValueError(f'unknown CoalescingStore: {store}, expected one of {COALESCING_STORES}')
+
+    if store == 'memory':
+        store = MemoryCoalescingStore()
+    elif store == 'dynamodb':
+        store = DynamoDBCoalescingStore(
+            dynamodb = LazyClient('dynamodb'),
+            table = os.environ['CoalescingTable']
+        )
+    else:
+        store = None
+
+    return RequestCoalescer(store=store)
+
+request_coalescer = get_request_coalescer()
@@ -0,0 +1,106 @@
+import random
+import time
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+class Deadline():
+    """The time budget of one request, counted down on the monotonic clock.
+
+    Built from the Lambda context and/or the budget a caller sent along, less a margin kept
+    to answer before the caller gives up. Without a budget the deadline never expires.
+    """
+
+    def __init__(self,remaining_ms=None,*,margin_ms:int=0):
+        self.reset(remaining_ms,margin_ms=margin_ms)
+
+    def reset(self,remaining_ms=None,*,margin_ms:int=0):
+
+        if remaining_ms is None:
+            self.expires_at = None
+        else:
+            self.expires_at = time.monotonic() + max(0,remaining_ms - margin_ms)/1000
+
+    @classmethod
+    def from_context(cls,context,*,margin_ms:int=0):
+
+        # outside Lambda (tests, local runs) there is no context to ask
+
+        get_remaining_time_in_millis = getattr(context,'get_remaining_time_in_millis',None)
+
+        return cls(
+            get_remaining_time_in_millis() if get_remaining_time_in_millis else None,
+            margin_ms = margin_ms
+        )
+
+    def remaining(self):
+
+        if self.expires_at is None:
+            return None
+
+        return max(0.0,self.expires_at - time.monotonic())
+
+    def remaining_ms(self):
+
+        remaining = self.remaining()
+
+        return None if remaining is None else int(remaining*1000)
+
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self,what:str):
+        if self.expired():
+            raise DeadlineExceeded(f'{what}: deadline exceeded')
+
+    def timeout(self,default=None):
+
+        # the smaller of a per-call timeout and what is left of the budget; None when neither is set
+
+        remaining = self.remaining()
+
+        if remaining is None:
+            return default
+        if default is None:
+            return remaining
+
+        return min(default,remaining)
+
+def retry(function,*,
+    deadline:Deadline,
+    attempts:int=3,
+    base_delay:float=0.2,
+    max_delay:float=2.0,
+    retry_exceptions=(Exception,),
+    retry_result=None
+):
+    """Calls function until it succeeds, with full-jitter exponential backoff between attempts.
+
+    An attempt is retried when it raises one of retry_exceptions or its result satisfies
+    retry_result. No attempt is made that the backoff would start after the deadline: the
+    last exception is raised, or the last result returned, instead.
+    """
+
+    for attempt in range(1,attempts+1):
+
+        try:
+            result = function()
+        except retry_exceptions as e:
+            error, result = e, None
+        else:
+            error = None
+            if retry_result is None or not retry_result(result):
+                return result
+
+        delay = random.uniform(0,min(max_delay,base_delay*2**(attempt-1)))
+
+        remaining = deadline.remaining()
+
+        if attempt == attempts or (remaining is not None and remaining <= delay):
+            if error is not None:
+                raise error
+            return result
+
+        print(f'retrying:\nattempt:\n{attempt}\ndelay:\n{delay:.3f}s\n{error if error is not None else result}')
+
+        time.sleep(delay)
@@ -0,0 +1,97 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# inputs up to this size travel inline in the engine payload, so the engine does not read back what the handler
+# has just written; they are archived to S3 alongside the engine call instead of before it. 0 inlines nothing
+
+INLINE_INPUT_MAX_BYTES = int(os.environ.get('InlineInputMaxBytes',0))
+
+# the whole engine payload, inline inputs included and measured as payload_bytes, under the smallest payload
+# limit of any transport (SQS and asynchronous invocations, 256 KB) with room for the transport's own envelope
+
+INLINE_INPUTS_MAX_TOTAL_BYTES = int(os.environ.get('InlineInputsMaxTotalBytes',224*1024))
+
+def payload_bytes(value):
+
+    # value's size in the largest payload that carries it: lambda-event sends the engine input as a JSON
+    # string inside JSON, so an inline input, itself a JSON string, is escaped twice over
+
+    return len(json.dumps(json.dumps(value)).encode('utf-8'))
+
+# per container, so warm invocations reuse its threads
+
+archive_executor = ThreadPoolExecutor(max_workers=16)
+
+class InputStager():
+    """Hands inputs to the Eval Engine as InputToBeEvaluated, inline where they are small enough.
+
+    An input too large to inline is put to S3 before stage() returns, as the engine reads it from there.
+    An inline one is archived to the same location in the background: wait() before the invocation
+    returns, so Lambda does not freeze the upload half-way.
+    """
+
+    def __init__(self,*,put,max_bytes:int=INLINE_INPUT_MAX_BYTES,max_total_bytes:int=INLINE_INPUTS_MAX_TOTAL_BYTES):
+        self.put = put
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.archivals = []
+
+    def stage(self,locations:list,objects:list,reserved_bytes:int=0):
+        """{'Bucket','Key'} per object -> InputToBeEvaluated per object, with 'Inline' set on the small ones.
+
+        reserved_bytes is the payload_bytes of the rest of the engine payload, which inline inputs share
+        max_total_bytes with.
+        """
+
+        # the inline text is exactly what put() writes, so the engine evaluates, and caches, the same bytes
+
+        bodies = [json.dumps(object_) for object_ in objects]
+
+        inline_bytes = reserved_bytes
+
+        inputs_to_be_evaluated = []
+
+        for location, body in zip(locations,bodies):
+
+            size = len(body.encode('utf-8'))
+
+            encoded_size = payload_bytes(body)
+
+            if size <= self.max_bytes and inline_bytes + encoded_size <= self.max_total_bytes:
+                inline_bytes += encoded_size
+                inputs_to_be_evaluated.append({**location,'Inline': body})
+            else:
+                inputs_to_be_evaluated.append(dict(location))
+
+        def put(index):
+            return self.put(
+                bucket = locations[index]['Bucket'],
+                key = locations[index]['Key'],
+                object_ = objects[index]
+            )
+
+        inline = [index for index, i in enumerate(inputs_to_be_evaluated) if 'Inline' in i]
+
+        self.archivals += [archive_executor.submit(put,index) for index in inline]
+
+        uploads = [index for index, i in enumerate(inputs_to_be_evaluated) if 'Inline' not in i]
+
+        if len(uploads) == 1:
+            put(uploads[0])
+        elif uploads:
+            with ThreadPoolExecutor(max_workers=min(16,len(uploads))) as executor:
+                list(executor.map(put,uploads))
+
+        print(f'inputs staged:\ninline:\n{len(inline)}\nuploaded:\n{len(uploads)}')
+
+        return inputs_to_be_evaluated
+
+    def wait(self):
+
+        # raises the first failed archival, as a failed upload before the engine call would have
+
+        archivals, self.archivals = self.archivals, []
+
+        for archival in archivals:
+            archival.result()
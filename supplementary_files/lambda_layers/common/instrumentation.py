@@ -0,0 +1,152 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = os.environ.get('MetricsNamespace','ControlBroker')
+
+# EMF accepts at most 100 values per metric in one record
+
+MAX_VALUES = 100
+
+cold_start = True
+
+class Metrics():
+    """Per-phase latencies for one Lambda, emitted as CloudWatch Embedded Metric Format.
+
+    Phases are timed in milliseconds and flushed as a single EMF line per invocation,
+    dimensioned by Handler and InputType, so CloudWatch can report p50/p99 per phase.
+    A phase timed more than once in an invocation (e.g. per batch item) is emitted as a list.
+    """
+
+    def __init__(self,*,handler:str):
+        self.handler = handler
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.dimensions = {'InputType': 'Unknown'}
+        self.values = {}
+        self.units = {}
+
+    def set_input_type(self,input_type):
+        if input_type:
+            self.dimensions['InputType'] = str(input_type)
+
+    def put(self,name,value,unit='Milliseconds'):
+        with self.lock:
+            self.values.setdefault(name,[]).append(value)
+            self.units[name] = unit
+
+    def total(self,name):
+        with self.lock:
+            return sum(self.values.get(name,[]))
+
+    @contextmanager
+    def phase(self,name,excluding=None):
+
+        # excluding: another phase timed inside this one, e.g. evaluation streamed into an upload
+
+        excluded = self.total(excluding) if excluding else 0
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start)*1000
+            if excluding:
+                elapsed -= self.total(excluding) - excluded
+            self.put(name,round(elapsed,2))
+
+    def timed(self,name):
+        """Decorates a function so that every call is timed as the named phase."""
+
+        def decorator(function):
+
+            @functools.wraps(function)
+            def wrapper(*args,**kwargs):
+                with self.phase(name):
+                    return function(*args,**kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def iterate(self,name,iterable):
+
+        # times only the work done producing each item, not what the consumer does between items
+
+        elapsed = 0
+
+        iterator = iter(iterable)
+
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.put(name,round(elapsed*1000,2))
+
+    def record(self):
+
+        metrics = []
+        record = {}
+
+        for name, values in self.values.items():
+            metrics.append({'Name': name, 'Unit': self.units[name]})
+            record[name] = values[0] if len(values) == 1 else values[:MAX_VALUES]
+
+        return {
+            '_aws': {
+                'Timestamp': int(time.time()*1000),
+                'CloudWatchMetrics': [
+                    {
+                        'Namespace': NAMESPACE,
+                        'Dimensions': [['Handler','InputType']],
+                        'Metrics': metrics
+                    }
+                ]
+            },
+            'Handler': self.handler,
+            **self.dimensions,
+            **record
+        }
+
+    def flush(self):
+
+        if self.values:
+            # one line, so the Lambda log agent picks it up as a single EMF record
+            print(json.dumps(self.record()))
+
+        self.reset()
+
+    def instrument(self,lambda_handler):
+        """Decorates a lambda_handler: times the whole invocation and flushes once it returns or raises."""
+
+        @functools.wraps(lambda_handler)
+        def wrapper(event,context):
+
+            global cold_start
+
+            self.reset()
+
+            self.put('ColdStart',int(cold_start),unit='Count')
+
+            cold_start = False
+
+            try:
+                with self.phase('Invocation'):
+                    return lambda_handler(event,context)
+            finally:
+                self.flush()
+
+        return wrapper
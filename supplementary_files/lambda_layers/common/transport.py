@@ -0,0 +1,522 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from clients import LazyClient
+from coalescing import request_coalescer
+from deadlines import retry
+from inline_inputs import InputStager, payload_bytes
+
+# how a handler hands its eval_engine_input to the Eval Engine:
+# "http" calls the engine through API Gateway and waits, "lambda" invokes the engine function directly and waits,
+# "lambda-event" invokes it asynchronously and returns, "sqs" enqueues it and returns,
+# "local" enqueues it on an in-process queue, a stand-in for SQS in tests
+
+TRANSPORTS = {'http','lambda','lambda-event','sqs','local'}
+
+# the handler waits for the engine's answer; with the others the consumer polls the presigned URLs
+
+SYNCHRONOUS_TRANSPORTS = {'http','lambda'}
+
+# http: API Gateway gives up on the engine after 29s, so no read waits longer; these statuses, connection
+# errors and timeouts are retried while the caller's budget lasts. A 504 means the budget ran out, so it is not
+# retried; neither is a read timeout worth much, the engine will have stopped at the budget it was sent
+
+ENGINE_CONNECT_TIMEOUT = float(os.environ.get('EvalEngineConnectTimeoutSeconds',3))
+
+ENGINE_READ_TIMEOUT = float(os.environ.get('EvalEngineReadTimeoutSeconds',29))
+
+ENGINE_ATTEMPTS = int(os.environ.get('EvalEngineAttempts',3))
+
+RETRY_STATUS_CODES = {429,502,503}
+
+# kept back from a handler's own budget, to answer its caller after the engine has
+
+DEADLINE_MARGIN_MS = int(os.environ.get('DeadlineMarginMs',500))
+
+# http: connections to API Gateway kept alive across invocations of a container, so only its first call pays
+# for the TLS handshake
+
+ENGINE_MAX_POOL_CONNECTIONS = int(os.environ.get('EvalEngineMaxPoolConnections',4))
+
+# lambda: no gateway in between, so the engine has the handler's whole budget; a read never outwaits the
+# engine's own timeout, which the stack sets this to
+
+ENGINE_INVOKE_READ_TIMEOUT = float(os.environ.get('EvalEngineInvokeReadTimeoutSeconds',65))
+
+class EngineClient():
+    """Calls the Eval Engine's IAM-authorized API with SigV4-signed requests over a keep-alive pool.
+
+    Signed with botocore's own signer and the container's credentials, resolved once and refreshed
+    by botocore before they expire. urllib3 and botocore ship with the Lambda runtime's boto3, so
+    handlers need no requests or aws_requests_auth layer. Both are imported on first use.
+    """
+
+    def __init__(self,*,region:str,service:str='execute-api',max_pool_connections:int=ENGINE_MAX_POOL_CONNECTIONS):
+        self.region = region
+        self.service = service
+        self.max_pool_connections = max_pool_connections
+        self.pool = None
+        self.credentials = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    import urllib3
+                    # retries are left to the caller, which knows the deadline
+                    self.pool = urllib3.PoolManager(maxsize=self.max_pool_connections,retries=False)
+
+        return self.pool
+
+    def get_credentials(self):
+
+        if self.credentials is None:
+            with self.lock:
+                if self.credentials is None:
+                    import botocore.session
+                    self.credentials = botocore.session.get_session().get_credentials()
+
+        return self.credentials.get_frozen_credentials()
+
+    def sign(self,*,url:str,body:bytes,headers:dict):
+
+        from botocore.auth import SigV4Auth
+        from botocore.awsrequest import AWSRequest
+
+        request = AWSRequest(method='POST',url=url,data=body,headers=headers)
+
+        SigV4Auth(self.get_credentials(),self.service,self.region).add_auth(request)
+
+        return dict(request.headers.items())
+
+    def post(self,url:str,*,body:dict,connect_timeout:float,read_timeout:float):
+        """Returns (status, headers sent, response bytes). Connection errors and timeouts raise urllib3's HTTPError."""
+
+        import urllib3
+
+        body = json.dumps(body).encode('utf-8')
+
+        # signed per attempt: the signature covers the time it was made at
+
+        headers = self.sign(url=url,body=body,headers={'Content-Type':'application/json'})
+
+        r = self.get_pool().request(
+            'POST',
+            url,
+            body = body,
+            headers = headers,
+            timeout = urllib3.Timeout(connect=connect_timeout,read=read_timeout),
+            retries = False
+        )
+
+        return r.status, headers, r.data
+
+engine_client = None
+
+def get_engine_client(region:str):
+
+    global engine_client
+
+    if engine_client is None or engine_client.region != region:
+        engine_client = EngineClient(region=region)
+
+    return engine_client
+
+engine_lambda = None
+
+def get_engine_lambda():
+
+    global engine_lambda
+
+    if engine_lambda is None:
+
+        from botocore.config import Config
+
+        # retries are left to the caller, which knows the deadline
+
+        engine_lambda = LazyClient('lambda',config=Config(
+            connect_timeout = ENGINE_CONNECT_TIMEOUT,
+            read_timeout = ENGINE_INVOKE_READ_TIMEOUT,
+            retries = {'max_attempts': 0}
+        ))
+
+    return engine_lambda
+
+def engine_response(payload):
+
+    # the engine answers API Gateway's proxy shape: a structured error as {statusCode, body}, else its result
+
+    if isinstance(payload,dict) and 'statusCode' in payload:
+        try:
+            content = json.loads(payload.get('body') or 'null')
+        except ValueError:
+            content = {'Error': payload['body'][:1024]}
+        return payload['statusCode'], content
+
+    return 200, payload
+
+def invoke_engine(*,function_name:str,input:dict,deadline):
+    """Invokes the Eval Engine function with RequestResponse, retrying throttles and connection errors within deadline."""
+
+    from botocore.exceptions import ClientError, ConnectionError
+
+    client = get_engine_lambda()
+
+    def invoke():
+        deadline.check('EngineCall')
+        # the engine's payload as API Gateway would deliver it, with what is left of this handler's budget
+        body = input if deadline.remaining() is None else {**input,'RemainingTimeMs':deadline.remaining_ms()}
+        try:
+            r = client.invoke(
+                FunctionName = function_name,
+                InvocationType = 'RequestResponse',
+                Payload = json.dumps({'body': json.dumps(body)})
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('TooManyRequestsException','ServiceException'):
+                return 429, {'Error': str(e)}
+            raise
+        payload = r['Payload'].read()
+        if r.get('FunctionError'):
+            return 500, {'Error': json.loads(payload) if payload else r['FunctionError']}
+        return engine_response(json.loads(payload) if payload else None)
+
+    status, content = retry(
+        invoke,
+        deadline = deadline,
+        attempts = ENGINE_ATTEMPTS,
+        retry_exceptions = (ConnectionError,),
+        retry_result = lambda r: r[0] in RETRY_STATUS_CODES
+    )
+
+    return {
+        'StatusCode': status,
+        'Content': content
+    }
+
+def call_engine(*,full_invoke_url:str,region:str,input:dict,deadline):
+    """Hands an eval_engine_input to the Eval Engine within deadline and waits, retrying while it allows.
+
+    Posts to the engine's API route, or with EvalEngineTransport=lambda invokes the function directly.
+    Returns the engine's answer as {'StatusCode','Content'}, the shape enqueue returns.
+    """
+
+    if get_transport() == 'lambda':
+        return invoke_engine(
+            function_name = os.environ['EvalEngineFunctionName'],
+            input = input,
+            deadline = deadline
+        )
+
+    import urllib3
+
+    client = get_engine_client(region)
+
+    def post():
+        deadline.check('EngineCall')
+        return client.post(
+            full_invoke_url,
+            # the engine stops evaluating in time to answer before this read, and so API Gateway, gives up
+            body = {**input,'RemainingTimeMs':int(deadline.timeout(ENGINE_READ_TIMEOUT)*1000)},
+            connect_timeout = deadline.timeout(ENGINE_CONNECT_TIMEOUT),
+            read_timeout = deadline.timeout(ENGINE_READ_TIMEOUT)
+        )
+
+    status, headers, content = retry(
+        post,
+        deadline = deadline,
+        attempts = ENGINE_ATTEMPTS,
+        retry_exceptions = (urllib3.exceptions.HTTPError,),
+        retry_result = lambda r: r[0] in RETRY_STATUS_CODES
+    )
+
+    # names only: the values carry the signature and the session token
+
+    print(f'signed request headers:\n{sorted(headers)}')
+
+    # an error page from API Gateway or a load balancer is not JSON
+
+    try:
+        content = json.loads(content)
+    except ValueError:
+        content = {'Error': content[:1024].decode('utf-8','replace')}
+
+    return {
+        'StatusCode': status,
+        'Content': content
+    }
+
+def error_response(status_code:int,body:dict):
+
+    # answered to the consumer in API Gateway's proxy shape, as the engine answers its own errors
+
+    return {
+        'statusCode': status_code,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps(body)
+    }
+
+def engine_error_response(eval_engine_response:dict):
+
+    # the engine's own 5xx and throttles pass through; anything else it refused is a bad gateway to the consumer
+
+    status = eval_engine_response['StatusCode']
+
+    return error_response(
+        status if status >= 500 or status == 429 else 502,
+        {
+            'Error': 'Eval Engine did not evaluate the request',
+            'EvalEngineResponse': eval_engine_response
+        }
+    )
+
+def get_transport():
+
+    transport = os.environ.get('EvalEngineTransport','http')
+
+    if transport not in TRANSPORTS:
+        raise ValueError(f'unknown EvalEngineTransport: {transport}, expected one of {TRANSPORTS}')
+
+    return transport
+
+def is_queued():
+    return get_transport() not in SYNCHRONOUS_TRANSPORTS
+
+class SQSQueue():
+
+    def __init__(self,*,queue_url:str):
+        self.queue_url = queue_url
+        self.sqs = LazyClient('sqs')
+
+    def send(self,body:dict):
+
+        r = self.sqs.send_message(
+            QueueUrl = self.queue_url,
+            MessageBody = json.dumps(body)
+        )
+
+        return r['MessageId']
+
+class LocalQueue():
+    """In-process stand-in for the Eval Engine queue and its dead-letter queue.
+
+    consume() delivers messages to a handler as an SQS event, honouring batchItemFailures:
+    failed messages are redelivered, and moved to dead_letters after max_receive_count receives.
+    """
+
+    def __init__(self,*,max_receive_count:int=3):
+        self.max_receive_count = max_receive_count
+        self.messages = deque()
+        self.dead_letters = []
+        self.lock = threading.Lock()
+
+    def send(self,body:dict):
+
+        message = {
+            'messageId': str(uuid.uuid4()),
+            'body': json.dumps(body),
+            'receiveCount': 0,
+            'sentTimestamp': int(time.time()*1000)
+        }
+
+        with self.lock:
+            self.messages.append(message)
+
+        return message['messageId']
+
+    def receive(self,batch_size:int):
+
+        with self.lock:
+            batch = [self.messages.popleft() for _ in range(min(batch_size,len(self.messages)))]
+
+        for message in batch:
+            message['receiveCount'] += 1
+
+        return batch
+
+    def consume(self,handler,*,batch_size:int=10,context=None):
+
+        batch = self.receive(batch_size)
+
+        if not batch:
+            return None
+
+        event = {
+            'Records': [
+                {
+                    'messageId': message['messageId'],
+                    'body': message['body'],
+                    'eventSource': 'aws:sqs',
+                    'attributes': {
+                        'ApproximateReceiveCount': str(message['receiveCount']),
+                        'SentTimestamp': str(message['sentTimestamp'])
+                    }
+                } for message in batch
+            ]
+        }
+
+        r = handler(event,context)
+
+        failed = {failure['itemIdentifier'] for failure in (r or {}).get('batchItemFailures',[])}
+
+        with self.lock:
+            for message in batch:
+                if message['messageId'] not in failed:
+                    continue
+                if message['receiveCount'] >= self.max_receive_count:
+                    self.dead_letters.append(message)
+                else:
+                    self.messages.append(message)
+
+        return r
+
+    def drain(self,handler,*,batch_size:int=10,context=None):
+
+        # consumes until the queue is empty, e.g. after a test has enqueued its requests
+
+        while self.consume(handler,batch_size=batch_size,context=context) is not None:
+            pass
+
+class LambdaEventQueue():
+    """The Eval Engine function's own asynchronous invocation queue.
+
+    Lambda retries failed events and sends them to the engine's on-failure destination, as SQS would.
+    """
+
+    def __init__(self,*,function_name:str):
+        self.function_name = function_name
+        self.lambda_ = LazyClient('lambda')
+
+    def send(self,body:dict):
+
+        r = self.lambda_.invoke(
+            FunctionName = self.function_name,
+            InvocationType = 'Event',
+            # marked so the engine raises on a timeout, for Lambda to retry, rather than answering it
+            Payload = json.dumps({'body': json.dumps(body),'InvocationType': 'Event'})
+        )
+
+        return r['ResponseMetadata']['RequestId']
+
+local_queue = LocalQueue()
+
+queue = None
+
+def get_queue():
+
+    global queue
+
+    if queue is None:
+        if get_transport() == 'local':
+            queue = local_queue
+        elif get_transport() == 'lambda-event':
+            queue = LambdaEventQueue(function_name=os.environ['EvalEngineFunctionName'])
+        else:
+            queue = SQSQueue(queue_url=os.environ['EvalEngineQueueUrl'])
+
+    return queue
+
+def enqueue(eval_engine_input:dict):
+    """Queues an eval_engine_input for the Eval Engine, in the shape sign_request returns."""
+
+    message_id = get_queue().send(eval_engine_input)
+
+    r = {
+        'StatusCode': 202,
+        'Content': {
+            'Transport': get_transport(),
+            'MessageId': message_id
+        }
+    }
+
+    print(f'queued for the Eval Engine:\n{r}')
+
+    return r
+
+def submit_evaluation(*,
+    claim,
+    eval_engine_input:dict,
+    inputs:list,
+    batch:bool,
+    put,
+    metrics,
+    full_invoke_url:str,
+    region:str,
+    deadline,
+    convert=None
+):
+    """Hands a handler's request to the Eval Engine, unless its claim coalesced it with an earlier one.
+
+    inputs are {'Location','Object','ResponseExpectedByConsumer'}, one per evaluation key, where convert
+    (if given) turns each Object into what is evaluated. eval_engine_input gets them as InputToBeEvaluated
+    and ResponseExpectedByConsumer, or as a batch of Inputs. The claim is settled by the engine's answer,
+    and released if the request fails before then. Returns that answer, or None when coalesced.
+    """
+
+    if claim.coalesced:
+        return None
+
+    try:
+
+        objects = [i['Object'] if convert is None else convert(i['Object']) for i in inputs]
+
+        # small inputs go inline, archived while the engine evaluates them; the rest are uploaded first
+
+        input_stager = InputStager(put=put)
+
+        # what the payload carries besides the inline inputs, presigned URLs included
+
+        reserved_bytes = payload_bytes({
+            **eval_engine_input,
+            'Inputs': [{'InputToBeEvaluated': i['Location'],'ResponseExpectedByConsumer': i['ResponseExpectedByConsumer']} for i in inputs]
+        })
+
+        inputs_to_be_evaluated = input_stager.stage([i['Location'] for i in inputs],objects,reserved_bytes=reserved_bytes)
+
+        items = [
+            {
+                "InputToBeEvaluated": input_to_be_evaluated,
+                "ResponseExpectedByConsumer": i['ResponseExpectedByConsumer']
+            } for input_to_be_evaluated, i in zip(inputs_to_be_evaluated,inputs)
+        ]
+
+        eval_engine_input = {**eval_engine_input,'Inputs': items} if batch else {**eval_engine_input,**items[0]}
+
+        print(f'eval_engine_input:\n{eval_engine_input}')
+
+        if is_queued():
+
+            # async mode: the engine consumes the queue, the consumer polls the presigned URLs for results
+
+            with metrics.phase('EngineEnqueue'):
+                eval_engine_response = enqueue(eval_engine_input)
+
+        else:
+
+            print(f'begin request\nfull_invoke_url\n{full_invoke_url}')
+
+            with metrics.phase('EngineCall'):
+                eval_engine_response = call_engine(
+                    full_invoke_url = full_invoke_url,
+                    region = region,
+                    input = eval_engine_input,
+                    deadline = deadline
+                )
+
+            print(f'formatted response:\n{eval_engine_response}')
+
+        input_stager.wait()
+
+    except Exception:
+        request_coalescer.release(claim)
+        raise
+
+    request_coalescer.settle(claim,eval_engine_response)
+
+    return eval_engine_response
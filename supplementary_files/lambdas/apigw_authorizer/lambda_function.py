@@ -1,8 +1,3 @@
-import json
-
-import boto3
-from botocore.exceptions import ClientError
-
 def determine_is_authorized(auth_header):
     # TODO
     return True
@@ -0,0 +1,82 @@
+import json
+import os
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+s3 = boto3.client('s3')
+
+class EvaluationContextCache():
+    """EvaluationContext held in memory (and mirrored to /tmp for OPA) across invocations.
+
+    Revalidated with a conditional GET on the cached ETag once the TTL has elapsed,
+    so an unchanged context costs a 304 rather than a download.
+    """
+
+    def __init__(self,*,
+        bucket:str,
+        key:str,
+        local_path:str,
+        ttl_seconds:int=0
+    ):
+        self.bucket = bucket
+        self.key = key
+        self.local_path = local_path
+        self.ttl_seconds = ttl_seconds
+
+        self.content = None
+        self.etag = None
+        self.version = None
+        self.last_validated = None
+
+    def is_fresh(self):
+        if self.last_validated is None:
+            return False
+        return time.monotonic() - self.last_validated < self.ttl_seconds
+
+    def write_local(self,body:bytes):
+
+        partial_path = f'{self.local_path}.partial'
+
+        with open(partial_path,'wb') as f:
+            f.write(body)
+
+        os.replace(partial_path,self.local_path)
+
+    def get(self):
+
+        if self.content is not None and self.is_fresh():
+            return self.content
+
+        kwargs = {
+            'Bucket': self.bucket,
+            'Key': self.key
+        }
+
+        if self.etag and os.path.exists(self.local_path):
+            kwargs['IfNoneMatch'] = self.etag
+
+        try:
+            r = s3.get_object(**kwargs)
+        except ClientError as e:
+            if e.response.get('ResponseMetadata',{}).get('HTTPStatusCode') == 304:
+                print(f'EvaluationContext not modified:\nversion:\n{self.version}')
+                self.last_validated = time.monotonic()
+                return self.content
+            print(f'ClientError:\nbucket:\n{self.bucket}\nkey:\n{self.key}\n{e}')
+            raise
+
+        body = r['Body'].read()
+
+        self.content = json.loads(body)
+        self.write_local(body)
+
+        self.etag = r['ETag']
+        # VersionId is only returned by versioned buckets, otherwise the ETag identifies the content
+        self.version = r.get('VersionId') or self.etag.strip('"')
+        self.last_validated = time.monotonic()
+
+        print(f'EvaluationContext downloaded:\nbucket:\n{self.bucket}\nkey:\n{self.key}\nversion:\n{self.version}')
+
+        return self.content
@@ -0,0 +1,696 @@
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tarfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from contextlib import contextmanager
+
+OPA_BINARY = '/tmp/opa'
+
+# decision: allow/deny plus infractions, with early exit and no trace
+# audit: full explanation trace, every rule evaluated
+
+EVALUATION_MODES = ['decision','audit']
+
+def install_opa():
+
+    # the deployment package is read-only, so copy the binary out once per container rather than once per request
+
+    if not os.path.exists(OPA_BINARY):
+        shutil.copy('./opa',OPA_BINARY)
+        os.chmod(OPA_BINARY,0o755)
+
+    return OPA_BINARY
+
+def file_version(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def with_request_data(query,request_data:dict):
+
+    # JSON values are valid Rego terms, so request-scoped data can be substituted into the query itself
+
+    modifiers = ''.join(
+        f' with data.{k} as {json.dumps(v)}' for k,v in request_data.items()
+    )
+
+    return f'{query}{modifiers}'
+
+def packages_query(packages):
+
+    # None means no policy index: evaluate the entire data tree
+
+    if packages is None:
+        return 'data'
+
+    return '{' + ', '.join(f'{json.dumps(package)}: data.{package}' for package in packages) + '}'
+
+def unwrap_result(body:bytes,*,prefix=b'{"result":',suffix=b'}'):
+
+    # OPA wraps a defined value as {"result":<value>}: slicing the envelope off hands the value
+    # on as bytes without parsing it. Anything else (undefined, extra fields) is parsed instead.
+    # Returns None when the value is undefined.
+
+    body = body.strip()
+
+    if body.startswith(prefix) and body.endswith(suffix):
+        return body[len(prefix):-len(suffix)]
+
+    r = json.loads(body)
+
+    if isinstance(r,list):
+        r = r[0] if r else {}
+
+    return json.dumps(r['result']).encode('utf-8') if 'result' in r else None
+
+def join_results(results):
+
+    # (package, value bytes) pairs -> {"<package>":<value>,...}, skipping undefined values
+
+    yield b'{'
+
+    separator = b''
+
+    for package, value in results:
+        if value is None:
+            continue
+        yield separator + json.dumps(package).encode('utf-8') + b':' + value
+        separator = b','
+
+    yield b'}'
+
+class OpaEvalEvaluator():
+    """Runs a fresh `opa eval` process for every evaluation.
+
+    Only the bundle and EvaluationContext are read from disk; the input is piped on stdin
+    and the request-scoped data is substituted into the query with `with`.
+    """
+
+    # every evaluation is its own process, so evaluations may run side by side, e.g. per input chunk
+
+    concurrent = True
+
+    def __init__(self):
+        self.opa = install_opa()
+
+    def load(self,*,bundle_path,evaluation_context_path):
+        self.bundle_path = bundle_path
+        self.evaluation_context_path = evaluation_context_path
+
+    def evaluate(self,*,request_data:dict,input_bytes:bytes,packages=None,mode='decision',timeout=None):
+
+        if mode == 'audit':
+            # --format raw drops the explanation, so audit mode needs the json output
+            mode_args = ['--explain', 'full', '--disable-early-exit', '--format', 'json']
+        else:
+            mode_args = ['--format', 'raw']
+
+        args = [
+            self.opa, 'eval',
+            *mode_args,
+            '--bundle', self.bundle_path,
+            '--data', self.evaluation_context_path,
+            '--stdin-input',
+            with_request_data(packages_query(packages),request_data)
+        ]
+
+        try:
+            # the process is killed once the timeout expires
+            output = subprocess.run(args, input=input_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise TimeoutError(f'opa eval did not finish within {timeout}s') from None
+
+        stderr = output.stderr.decode('utf-8')
+
+        if output.returncode != 0:
+            raise RuntimeError(f'opa eval exited {output.returncode}:\n{stderr}')
+
+        if mode != 'audit':
+            # --format raw prints nothing when the query is undefined
+            return json.loads(output.stdout) if output.stdout.strip() else {}, None
+
+        r = json.loads(output.stdout)
+
+        result = r['result'][0]['expressions'][0]['value'] if r.get('result') else {}
+
+        return result, r.get('explanation')
+
+    def evaluate_stream(self,*,request_data:dict,input_bytes:bytes,packages=None,timeout=None,chunk_size=64*1024):
+
+        # decision mode only: the raw result is passed on as opa writes it, never parsed
+
+        args = [
+            self.opa, 'eval',
+            '--format', 'raw',
+            '--bundle', self.bundle_path,
+            '--data', self.evaluation_context_path,
+            '--stdin-input',
+            with_request_data(packages_query(packages),request_data)
+        ]
+
+        process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        timer = None
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            process.kill()
+
+        if timeout is not None:
+            # killing the process ends its stdout, so a blocked read returns
+            timer = threading.Timer(timeout,expire)
+            timer.start()
+
+        try:
+            # opa reads all of stdin before it evaluates, so the input can be written up front
+            process.stdin.write(input_bytes)
+            process.stdin.close()
+
+            while True:
+                chunk = process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+            if process.wait() != 0:
+                if expired.is_set():
+                    raise TimeoutError(f'opa eval did not finish within {timeout}s')
+                raise RuntimeError(f'opa eval exited {process.returncode}:\n{process.stderr.read().decode("utf-8")}')
+
+        except BrokenPipeError:
+            if expired.is_set():
+                raise TimeoutError(f'opa eval did not finish within {timeout}s') from None
+            raise
+
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+def partial_module(*,module_id,request_data:dict,packages):
+
+    # one rule per package, each pinning the request-scoped data with `with`, so everything but input is known
+
+    rules = [
+        f'{package.replace(".","__")} = result {{\n    result := {with_request_data(f"data.{package}",request_data)}\n}}'
+        for package in packages
+    ]
+
+    return '\n\n'.join([f'package {module_id.replace("/",".")}',*rules]) + '\n'
+
+class OpaServerEvaluator():
+    """Keeps one `opa run --server` process per container, listening on localhost.
+
+    The bundle and EvaluationContext are loaded once and reloaded only when their files change;
+    each evaluation only sends the request-scoped data and the input.
+
+    When the applicable packages are known, each distinct (InputType, ApprovedContext,
+    EvaluationContext version) gets a small wrapper module that pins that data. Its rules are
+    queried with ?partial, so the server partially evaluates them once and later requests only
+    evaluate the input-dependent residual. Wrapper modules are kept in a bounded LRU.
+    """
+
+    # the server handles queries concurrently; only the wrapper module LRU needs a lock
+
+    concurrent = True
+
+    def __init__(self,*,port=8181,startup_timeout=10,partial_cache_size=32):
+        self.opa = install_opa()
+        self.url = f'http://127.0.0.1:{port}'
+        self.addr = f'127.0.0.1:{port}'
+        self.startup_timeout = startup_timeout
+        self.partial_cache_size = partial_cache_size
+
+        self.process = None
+        self.bundle_version = None
+        self.evaluation_context_version = None
+        self.partial_modules = OrderedDict()
+        self.partial_modules_lock = threading.Lock()
+
+    def request(self,method,path,body=None,timeout=30):
+
+        content = self.request_bytes(method,path,body,timeout)
+
+        return json.loads(content) if content else None
+
+    def request_bytes(self,method,path,body=None,timeout=30):
+
+        # a timeout disconnects, which cancels the query on the server
+
+        if body is None or isinstance(body,bytes):
+            data = body
+        else:
+            data = json.dumps(body).encode('utf-8')
+
+        request = urllib.request.Request(
+            f'{self.url}{path}',
+            data = data,
+            method = method,
+            headers = {'Content-Type':'application/json'}
+        )
+
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as r:
+                return r.read()
+        except socket.timeout:
+            raise TimeoutError(f'{method} {path} did not finish within {timeout}s') from None
+        except urllib.error.URLError as e:
+            if isinstance(e.reason,socket.timeout):
+                raise TimeoutError(f'{method} {path} did not finish within {timeout}s') from None
+            raise
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.is_running():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+    def start(self,*,bundle_path):
+
+        self.stop()
+
+        self.partial_modules.clear()
+
+        print(f'starting opa server:\naddr:\n{self.addr}\nbundle:\n{bundle_path}')
+
+        self.process = subprocess.Popen(
+            [self.opa, 'run', '--server', '--addr', self.addr, '--bundle', bundle_path],
+            stdout = subprocess.DEVNULL,
+            stderr = subprocess.DEVNULL
+        )
+
+        deadline = time.monotonic() + self.startup_timeout
+
+        while time.monotonic() < deadline:
+            if not self.is_running():
+                raise RuntimeError(f'opa server exited during startup: {self.process.returncode}')
+            try:
+                self.request('GET','/health',timeout=1)
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.02)
+            else:
+                return True
+
+        self.stop()
+        raise TimeoutError(f'opa server not healthy after {self.startup_timeout}s')
+
+    def load(self,*,bundle_path,evaluation_context_path):
+
+        bundle_version = file_version(bundle_path)
+
+        if not self.is_running() or bundle_version != self.bundle_version:
+            self.start(bundle_path=bundle_path)
+            self.bundle_version = bundle_version
+            self.evaluation_context_version = None
+
+        evaluation_context_version = file_version(evaluation_context_path)
+
+        if evaluation_context_version != self.evaluation_context_version:
+
+            with open(evaluation_context_path) as f:
+                evaluation_context = json.load(f)
+
+            self.request('PATCH','/v1/data',[
+                {'op':'add','path':f'/{k}','value':v} for k,v in evaluation_context.items()
+            ])
+
+            self.evaluation_context_version = evaluation_context_version
+
+    def partial_module_id(self,*,request_data:dict,packages):
+
+        key = json.dumps(
+            [request_data, packages, self.evaluation_context_version, self.bundle_version],
+            sort_keys=True,
+            default=str
+        )
+
+        module_id = f'cb_partial/p{hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]}'
+
+        with self.partial_modules_lock:
+
+            if module_id in self.partial_modules:
+                self.partial_modules.move_to_end(module_id)
+                return module_id
+
+            self.request(
+                'PUT',
+                f'/v1/policies/{module_id}',
+                partial_module(module_id=module_id,request_data=request_data,packages=packages).encode('utf-8')
+            )
+
+            self.partial_modules[module_id] = True
+
+            print(f'partial evaluation cache miss:\nmodule_id:\n{module_id}\nrequest_data:\n{request_data}')
+
+            while len(self.partial_modules) > self.partial_cache_size:
+                evicted, _ = self.partial_modules.popitem(last=False)
+                self.request('DELETE',f'/v1/policies/{evicted}')
+
+            return module_id
+
+    def evaluate(self,*,request_data:dict,input_bytes:bytes,packages=None,mode='decision',timeout=30):
+
+        # the input is already JSON, so wrap its bytes rather than parsing and re-serializing it
+
+        body = b'{"input":' + input_bytes + b'}'
+
+        query_string = '?explain=full' if mode == 'audit' else ''
+
+        if packages is None:
+
+            # Lambda runs one request per container at a time, so the request-scoped data can be swapped in place
+
+            self.request('PATCH','/v1/data',[
+                {'op':'add','path':f'/{k}','value':v} for k,v in request_data.items()
+            ])
+
+            r = self.request('POST',f'/v1/data{query_string}',body,timeout=timeout)
+            return r.get('result',{}), r.get('explanation')
+
+        module_id = self.partial_module_id(request_data=request_data,packages=packages)
+
+        if mode != 'audit':
+            query_string = '?partial'
+
+        result = {}
+        explanation = {}
+
+        for package in packages:
+            r = self.request('POST',f'/v1/data/{module_id}/{package.replace(".","__")}{query_string}',body,timeout=timeout)
+            if 'result' in r:
+                result[package] = r['result']
+            if 'explanation' in r:
+                explanation[package] = r['explanation']
+
+        return result, explanation or None
+
+    def evaluate_stream(self,*,request_data:dict,input_bytes:bytes,packages=None,timeout=30):
+
+        # decision mode only: each package's value is passed on as the server's bytes, never parsed
+
+        body = b'{"input":' + input_bytes + b'}'
+
+        if packages is None:
+
+            self.request('PATCH','/v1/data',[
+                {'op':'add','path':f'/{k}','value':v} for k,v in request_data.items()
+            ])
+
+            yield unwrap_result(self.request_bytes('POST','/v1/data',body,timeout)) or b'{}'
+            return
+
+        module_id = self.partial_module_id(request_data=request_data,packages=packages)
+
+        yield from join_results(
+            (package, unwrap_result(self.request_bytes('POST',f'/v1/data/{module_id}/{package.replace(".","__")}?partial',body,timeout)))
+            for package in packages
+        )
+
+def read_wasm_bundle(path):
+
+    # `opa build -t wasm` bundles hold the compiled policy alongside the static data it was built with
+
+    policy = None
+    data = {}
+
+    with tarfile.open(path,'r:gz') as tar:
+        for member in tar.getmembers():
+            name = member.name.lstrip('/')
+            if name == 'policy.wasm':
+                policy = tar.extractfile(member).read()
+            elif name == 'data.json':
+                data = json.load(tar.extractfile(member))
+
+    if policy is None:
+        raise ValueError(f'no policy.wasm in bundle: {path}')
+
+    return policy, data
+
+NO_EPOCH_DEADLINE = 2**62
+
+class WasmEvaluator():
+    """Evaluates policies compiled with `opa build -t wasm` in-process, through wasmtime.
+
+    No process is spawned and the input bytes are copied straight into Wasm memory, where the
+    policy parses them itself. Implements the OPA Wasm ABI one-shot `opa_eval` entrypoint (ABI 1.2+).
+    Wasm policies carry no explanation trace, so only decision mode is supported.
+    """
+
+    # one instance and one linear memory, evaluations have to take turns
+
+    concurrent = False
+
+    def __init__(self):
+
+        # the wasmtime layer is only attached when OpaMode is wasm
+
+        import wasmtime
+
+        self.wasmtime = wasmtime
+
+        # epoch interruption lets a timer thread stop an evaluation that runs past its timeout
+
+        config = wasmtime.Config()
+        config.epoch_interruption = True
+
+        self.engine = wasmtime.Engine(config)
+
+        self.bundle_version = None
+        self.evaluation_context_version = None
+        self.bundle_data = {}
+        self.evaluation_context = {}
+
+    def read_string(self,addr,chunk_size=64*1024):
+
+        # strings returned by the policy are NUL-terminated
+
+        memory_size = self.memory.data_len(self.store)
+        content = bytearray()
+
+        while addr < memory_size:
+            chunk = self.memory.read(self.store,addr,min(addr+chunk_size,memory_size))
+            end = chunk.find(b'\x00')
+            if end != -1:
+                content += chunk[:end]
+                return bytes(content)
+            content += chunk
+            addr += len(chunk)
+
+        raise RuntimeError('unterminated string in wasm memory')
+
+    def write_bytes(self,value:bytes):
+        addr = self.exports['opa_malloc'](self.store,len(value))
+        self.memory.write(self.store,value,addr)
+        return addr
+
+    def dump_value(self,value_addr):
+        return json.loads(self.read_string(self.exports['opa_json_dump'](self.store,value_addr)))
+
+    def instantiate(self,policy:bytes):
+
+        wasmtime = self.wasmtime
+
+        module = wasmtime.Module(self.engine,policy)
+
+        self.store = wasmtime.Store(self.engine)
+
+        # with epoch interruption on, a store traps at its deadline, which is never reached without a timeout
+
+        self.store.set_epoch_deadline(NO_EPOCH_DEADLINE)
+
+        # the policy imports its memory, sized to at least what the module declares
+
+        min_pages = max(
+            [5] + [i.type.limits.min for i in module.imports if i.module == 'env' and i.name == 'memory']
+        )
+
+        self.memory = wasmtime.Memory(self.store,wasmtime.MemoryType(wasmtime.Limits(min_pages,None)))
+
+        linker = wasmtime.Linker(self.engine)
+        linker.define(self.store,'env','memory',self.memory)
+
+        i32 = wasmtime.ValType.i32()
+
+        def opa_abort(addr):
+            raise RuntimeError(f'opa_abort: {self.read_string(addr).decode("utf-8")}')
+
+        def opa_println(addr):
+            print(f'opa_println:\n{self.read_string(addr).decode("utf-8")}')
+
+        linker.define_func('env','opa_abort',wasmtime.FuncType([i32],[]),opa_abort)
+        linker.define_func('env','opa_println',wasmtime.FuncType([i32],[]),opa_println)
+
+        # builtins without a native Wasm implementation would be called back into the host. Every policy imports
+        # these, but none are provided: a policy that needs one is rejected below, before it is ever evaluated
+
+        def opa_builtin(builtin_id,*args):
+            raise RuntimeError(f'host builtin called: {builtin_id}')
+
+        for arity in range(5):
+            linker.define_func(
+                'env',
+                f'opa_builtin{arity}',
+                wasmtime.FuncType([i32]*(arity+2),[i32]),
+                opa_builtin
+            )
+
+        instance = linker.instantiate(self.store,module)
+
+        self.exports = instance.exports(self.store)
+
+        builtins = self.dump_value(self.exports['builtins'](self.store))
+
+        if builtins:
+            self.exports = None
+            raise ValueError(f'wasm policy calls host builtins, which WasmEvaluator does not provide: {sorted(builtins)}')
+
+        self.entrypoints = self.dump_value(self.exports['entrypoints'](self.store))
+
+        # everything allocated from here on is per-evaluation, so the heap is reset to this point each time
+
+        self.base_heap_ptr = self.exports['opa_heap_ptr_get'](self.store)
+
+    def load(self,*,bundle_path,evaluation_context_path):
+
+        bundle_version = file_version(bundle_path)
+
+        if bundle_version != self.bundle_version:
+
+            policy, self.bundle_data = read_wasm_bundle(bundle_path)
+
+            self.instantiate(policy)
+
+            print(f'wasm policy loaded:\nbundle:\n{bundle_path}\nentrypoints:\n{list(self.entrypoints)}')
+
+            self.bundle_version = bundle_version
+
+        evaluation_context_version = file_version(evaluation_context_path)
+
+        if evaluation_context_version != self.evaluation_context_version:
+
+            with open(evaluation_context_path) as f:
+                self.evaluation_context = json.load(f)
+
+            self.evaluation_context_version = evaluation_context_version
+
+    def evaluate_entrypoints(self,*,request_data:dict,input_bytes:bytes,packages=None):
+
+        # yields (package, result bytes) as `[{"result":<value>}]`, or `[]` when undefined
+
+        self.exports['opa_heap_ptr_set'](self.store,self.base_heap_ptr)
+
+        data = json.dumps({**self.bundle_data,**self.evaluation_context,**request_data}).encode('utf-8')
+
+        data_addr = self.exports['opa_json_parse'](self.store,self.write_bytes(data),len(data))
+
+        if data_addr == 0:
+            raise RuntimeError('failed to parse data into wasm memory')
+
+        # the input is parsed by the policy itself, straight from the request bytes
+
+        input_addr = self.write_bytes(input_bytes)
+
+        heap_ptr = self.exports['opa_heap_ptr_get'](self.store)
+
+        if packages is None:
+            packages = [entrypoint.replace('/','.') for entrypoint in self.entrypoints]
+
+        for package in packages:
+
+            entrypoint_id = self.entrypoints[package.replace('.','/')]
+
+            # each evaluation restarts from heap_ptr, so the previous result is read before the next runs
+
+            result_addr = self.exports['opa_eval'](
+                self.store,
+                0,
+                entrypoint_id,
+                data_addr,
+                input_addr,
+                len(input_bytes),
+                heap_ptr,
+                0 # JSON
+            )
+
+            yield package, self.read_string(result_addr)
+
+    @contextmanager
+    def interruptible(self,timeout):
+
+        timer = None
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            self.engine.increment_epoch()
+
+        if timeout is not None:
+            # the store traps once the engine's epoch moves past the deadline, one tick from now
+            self.store.set_epoch_deadline(1)
+            timer = threading.Timer(timeout,expire)
+            timer.start()
+
+        try:
+            yield
+        except self.wasmtime.Trap:
+            if expired.is_set():
+                raise TimeoutError(f'wasm evaluation did not finish within {timeout}s') from None
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+                self.store.set_epoch_deadline(NO_EPOCH_DEADLINE)
+
+    def evaluate(self,*,request_data:dict,input_bytes:bytes,packages=None,mode='decision',timeout=None):
+
+        if mode != 'decision':
+            raise ValueError(f'EvaluationMode {mode} needs OpaMode eval or server, Wasm policies carry no explanation trace')
+
+        result = {}
+
+        with self.interruptible(timeout):
+            for package, content in self.evaluate_entrypoints(request_data=request_data,input_bytes=input_bytes,packages=packages):
+                r = json.loads(content)
+                if r:
+                    result[package] = r[0]['result']
+
+        return result, None
+
+    def evaluate_stream(self,*,request_data:dict,input_bytes:bytes,packages=None,timeout=None):
+
+        # the policy's own JSON output is passed on without being parsed
+
+        with self.interruptible(timeout):
+            yield from join_results(
+                (package, unwrap_result(content,prefix=b'[{"result":',suffix=b'}]'))
+                for package, content in self.evaluate_entrypoints(request_data=request_data,input_bytes=input_bytes,packages=packages)
+            )
+
+EVALUATORS = {
+    'eval': OpaEvalEvaluator,
+    'server': OpaServerEvaluator,
+    'wasm': WasmEvaluator,
+}
+
+def get_evaluator(mode,**kwargs):
+    try:
+        evaluator_class = EVALUATORS[mode]
+    except KeyError:
+        raise ValueError(f'unknown OpaMode: {mode}, expected one of {list(EVALUATORS)}')
+    return evaluator_class(**kwargs)
@@ -0,0 +1,300 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from result_cache import canonical_json
+
+# a resource-local package's verdict for a template is the merge of its verdicts for each resource on its own,
+# so the template without resources is evaluated once as the base and every resource as {"Resources": {<name>: <resource>}},
+# each with the template's other sections (Parameters, Conditions, Mappings...) that Ref and Fn::If resolve against
+
+class MergeConflict(ValueError):
+    pass
+
+def merge_allow(values):
+
+    # any unit denying denies the template; null (not applicable) only when no unit applied
+
+    if any(value is False for value in values):
+        return False
+    if any(value is True for value in values):
+        return True
+    if all(value is None for value in values):
+        return None
+
+    raise MergeConflict(f'allow is not a boolean or null: {values}')
+
+def merge_documents(documents:list,path:str=''):
+    """Deterministically merges the per-unit documents of one package into the template's document.
+
+    Objects merge key by key, arrays (Rego sets) become their sorted, de-duplicated union and
+    `allow` follows merge_allow. Any other value must agree across units, else MergeConflict:
+    the package is not resource-local after all, and the template has to be evaluated whole.
+    """
+
+    if path.endswith('.allow'):
+        return merge_allow(documents)
+
+    if all(isinstance(d,dict) for d in documents):
+        keys = sorted({k for d in documents for k in d})
+        return {
+            k: merge_documents([d[k] for d in documents if k in d],f'{path}.{k}')
+            for k in keys
+        }
+
+    if all(isinstance(d,list) for d in documents):
+        union = {canonical_json(v): v for d in documents for v in d}
+        return [union[k] for k in sorted(union)]
+
+    first = canonical_json(documents[0])
+
+    if any(canonical_json(d) != first for d in documents[1:]):
+        raise MergeConflict(f'{path or "document"} differs between resources')
+
+    return documents[0]
+
+class ResourceVerdictCache():
+    """Per-container LRU of {package: document} per evaluated unit, keyed by unit_keys."""
+
+    def __init__(self,*,size:int):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self,key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self,key,documents:dict):
+        with self.lock:
+            self.entries[key] = documents
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+def template_sections(template:dict):
+    return {k: v for k, v in template.items() if k != 'Resources'}
+
+def unit_resources(template:dict):
+
+    yield {}
+
+    for name in sorted(template['Resources']):
+        yield {name: template['Resources'][name]}
+
+def unit_keys(*,sections:dict,resources:list,request_data:dict,versions:dict,packages:list):
+
+    # the logical id is part of the unit, policies report offending resources by name; the packages are part of
+    # the key as a unit may be evaluated for some of them only, under per-package deadlines. The sections every
+    # unit shares are hashed once
+
+    h = hashlib.sha256()
+
+    h.update(canonical_json({
+        'InputType': request_data['InputType'],
+        'ApprovedContext': request_data['ApprovedContext'],
+        'Versions': versions,
+        'Packages': sorted(packages),
+        'Sections': sections
+    }))
+    h.update(b'\n')
+
+    keys = []
+
+    for unit in resources:
+        unit_h = h.copy()
+        unit_h.update(canonical_json(unit))
+        keys.append(unit_h.hexdigest())
+
+    return keys
+
+def evaluate_parts(*,evaluator,request_data:dict,parts:list,packages:list,workers:int,deadline=None):
+
+    # [{package: document}] per part, side by side where the evaluator allows it; each part gets what is
+    # left of the deadline when it starts, and none starts after it
+
+    def evaluate_part(part):
+        if deadline is not None:
+            deadline.check('OpaEval')
+        documents, _ = evaluator.evaluate(
+            request_data = request_data,
+            input_bytes = canonical_json(part),
+            packages = packages,
+            timeout = deadline.timeout() if deadline is not None else None
+        )
+        return documents
+
+    if not evaluator.concurrent or workers < 2 or len(parts) < 2:
+        return [evaluate_part(part) for part in parts]
+
+    with ThreadPoolExecutor(max_workers=min(workers,len(parts))) as executor:
+        return list(executor.map(evaluate_part,parts))
+
+def merge_package_documents(documents:list,packages:list):
+
+    results = {}
+
+    for package in packages:
+        package_documents = [d[package] for d in documents if package in d]
+        if package_documents:
+            results[package] = merge_documents(package_documents,package)
+
+    return results
+
+def evaluate_resources(*,evaluator,cache:ResourceVerdictCache,request_data:dict,template:dict,packages:list,versions:dict,workers:int=1,deadline=None):
+    """Evaluates resource-local packages against a template one resource at a time.
+
+    Only units missing from the cache reach OPA, so the cost follows the number of new or
+    changed resources rather than the size of the template. Returns ({package: document}, stats).
+    """
+
+    sections = template_sections(template)
+
+    resources = list(unit_resources(template))
+
+    keys = unit_keys(
+        sections = sections,
+        resources = resources,
+        request_data = request_data,
+        versions = versions,
+        packages = packages
+    )
+
+    documents = [cache.get(key) for key in keys]
+
+    missing = [index for index, unit_documents in enumerate(documents) if unit_documents is None]
+
+    evaluated = evaluate_parts(
+        evaluator = evaluator,
+        request_data = request_data,
+        parts = [{**sections,'Resources': resources[index]} for index in missing],
+        packages = packages,
+        workers = workers,
+        deadline = deadline
+    )
+
+    for index, unit_documents in zip(missing,evaluated):
+        cache.put(keys[index],unit_documents)
+        documents[index] = unit_documents
+
+    stats = {
+        'Resources': len(template['Resources']),
+        'Evaluated': len(missing),
+        'Reused': len(resources) - len(missing)
+    }
+
+    return merge_package_documents(documents,packages), stats
+
+# inputs the engine knows how to split by resource: (resource ids, the input restricted to some of them)
+
+TERRAFORM_RESOURCE_LISTS = [
+    ('configuration','root_module','resources'),
+    ('planned_values','root_module','resources'),
+    ('prior_state','values','root_module','resources'),
+    ('resource_changes',),
+]
+
+def get_path(value,path):
+    for key in path:
+        if not isinstance(value,dict):
+            return None
+        value = value.get(key)
+    return value
+
+def replace_path(value:dict,path,replacement):
+
+    # copies only the dicts along the path, everything else is shared with the original
+
+    if len(path) == 1:
+        return {**value,path[0]: replacement}
+
+    return {**value,path[0]: replace_path(value[path[0]],path[1:],replacement)}
+
+def cloudformation_layout(template:dict):
+
+    if not isinstance(template.get('Resources'),dict):
+        return None
+
+    def restrict(names):
+        return {**template,'Resources': {name: template['Resources'][name] for name in names}}
+
+    return sorted(template['Resources']), restrict
+
+def terraform_layout(plan:dict):
+
+    lists = [path for path in TERRAFORM_RESOURCE_LISTS if isinstance(get_path(plan,path),list)]
+
+    if not lists:
+        return None
+
+    addresses = sorted({
+        resource['address']
+        for path in lists
+        for resource in get_path(plan,path)
+        if isinstance(resource,dict) and 'address' in resource
+    })
+
+    def restrict(chunk_addresses):
+        chunk_addresses = set(chunk_addresses)
+        restricted = plan
+        for path in lists:
+            restricted = replace_path(restricted,path,[
+                resource for resource in get_path(plan,path)
+                if not isinstance(resource,dict) or resource.get('address') in chunk_addresses
+            ])
+        return restricted
+
+    return addresses, restrict
+
+def input_layout(input_):
+
+    if not isinstance(input_,dict):
+        return None
+
+    return cloudformation_layout(input_) or terraform_layout(input_)
+
+def evaluate_chunks(*,evaluator,request_data:dict,input_:dict,packages:list,workers:int,deadline=None):
+    """Evaluates resource-local packages against a large input split into one resource chunk per worker.
+
+    Whatever is not a resource (parameters, outputs, module calls) goes into every chunk; the
+    union merge keeps results derived from it once. Returns ({package: document}, stats), or
+    None where the input cannot be split.
+    """
+
+    layout = input_layout(input_)
+
+    if layout is None:
+        return None
+
+    ids, restrict = layout
+
+    chunk_count = min(workers,len(ids)) if evaluator.concurrent else 1
+
+    if chunk_count < 2:
+        return None
+
+    # contiguous slices of the sorted ids, so a chunk's membership does not depend on the worker count's remainder
+
+    chunk_size = -(-len(ids) // chunk_count)
+
+    parts = [restrict(ids[start:start+chunk_size]) for start in range(0,len(ids),chunk_size)]
+
+    documents = evaluate_parts(
+        evaluator = evaluator,
+        request_data = request_data,
+        parts = parts,
+        packages = packages,
+        workers = workers,
+        deadline = deadline
+    )
+
+    stats = {
+        'Resources': len(ids),
+        'Chunks': len(parts)
+    }
+
+    return merge_package_documents(documents,packages), stats
@@ -1,30 +1,42 @@
 import json
-import subprocess
-import shutil
-import re
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
-s3 = boto3.client('s3')
-s3r = boto3.resource('s3')
+from clients import LazyClient
+from deadlines import Deadline
+from evaluation_context import EvaluationContextCache
+from instrumentation import Metrics
+from evaluators import EVALUATION_MODES, get_evaluator
+from incremental import MergeConflict, ResourceVerdictCache, evaluate_chunks, evaluate_resources
+from policy_cache import PolicyCache
+from policy_index import PolicyIndex
+from raw_results import put_raw_result, splice_eval_engine
+from result_cache import (
+    DynamoDBResultCacheStore,
+    MemoryResultCacheStore,
+    ResultCache,
+    S3ResultCacheStore,
+    cache_key
+)
+
+metrics = Metrics(handler='EvalEngine')
+
+BATCH_CONCURRENCY = int(os.environ.get('BatchConcurrency',16))
+
+# batch inputs are fetched and their results written concurrently, one connection per thread
+
+s3 = boto3.client('s3', config=Config(max_pool_connections=BATCH_CONCURRENCY))
+
+# only used to revalidate stale cached results, by invoking this function asynchronously
+
+lambda_ = LazyClient('lambda')
 
-def put_object(*,bucket,key,object_:dict):
-    try:
-        r = s3.put_object(
-            Bucket = bucket,
-            Key = key,
-            Body = json.dumps(object_)
-        )
-    except ClientError as e:
-        print(f'ClientError:\nbucket:\n{bucket}\nkey:\n{key}\n{e}')
-        raise
-    else:
-        print(f'no ClientError put_object:\nbucket:\n{bucket}\nkey:\n{key}')
-        return True
-        
 def get_object(*,bucket,key):
     
     try:
@@ -41,169 +53,884 @@ def get_object(*,bucket,key):
         content = json.loads(body.read().decode('utf-8'))
         return content
 
-def s3_download(*,bucket,key,local_path):
+def get_object_bytes(*,bucket,key):
     
     try:
-        s3.download_file(
-            bucket,
-            key,
-            local_path
+        r = s3.get_object(
+            Bucket = bucket,
+            Key = key
         )
     except ClientError as e:
-        print(f'ClientError:\nbucket: {bucket}\nkey:\n{key}\n{e}')
+        print(f'ClientError:\nbucket:\n{bucket}\nkey:\n{key}\n{e}')
         raise
     else:
-        # print(f'No ClientError download_file\nbucket:\n{bucket}\nkey:\n{key}')
-        return True
+        print(f'no ClientError get_object:\nbucket:\n{bucket}\nkey:\n{key}')
+        return r['Body'].read()
 
-def s3_download_dir(*,bucket, prefix=None, local_path):
-    # print(f'Begin s3_download_dir\nbucket:\n{bucket}\nprefix:\n{prefix}\nlocal_path:\n{local_path}')
-    paginator = s3.get_paginator('list_objects')
+def get_input_bytes(input_to_be_evaluated:dict):
     
-    if prefix:
-        pagination = paginator.paginate(Bucket=bucket, Delimiter='/', Prefix=prefix)
-    else:
-        pagination = paginator.paginate(Bucket=bucket, Delimiter='/')
-            
-    for result in pagination:
-        if result.get('CommonPrefixes') is not None:
-            for subdir in result.get('CommonPrefixes'):
-                s3_download_dir(
-                    prefix = subdir.get('Prefix'),
-                    local_path = local_path,
-                    bucket = bucket
-                )
-        for file in result.get('Contents', []):
-            dest_pathname = os.path.join(local_path, file.get('Key'))
-            if not os.path.exists(os.path.dirname(dest_pathname)):
-                os.makedirs(os.path.dirname(dest_pathname))
-            if not file.get('Key').endswith('/'):
-                s3_download(
-                    bucket=bucket,
-                    key=file.get('Key'),
-                    local_path=dest_pathname
-                )
+    # small inputs arrive inline, as the exact text the handler archives to Bucket/Key in the background
+    
+    if 'Inline' in input_to_be_evaluated:
+        metrics.put('InputInline',1,unit='Count')
+        return input_to_be_evaluated['Inline'].encode('utf-8')
+    
+    with metrics.phase('InputDownload'):
+        return get_object_bytes(
+            bucket = input_to_be_evaluated['Bucket'],
+            key = input_to_be_evaluated['Key']
+        )
+
+def get_evaluation_mode(request_json_body):
+    
+    # set by the handler route in the engine payload, else requested by the consumer in its Context
+    
+    mode = (
+        request_json_body.get('EvaluationMode')
+        or (request_json_body.get('Context') or {}).get('EvaluationMode')
+        or os.environ.get('DefaultEvaluationMode','decision')
+    )
+    
+    if mode not in EVALUATION_MODES:
+        raise ValueError(f'unknown EvaluationMode: {mode}, expected one of {EVALUATION_MODES}')
+    
+    return mode
 
 def mkdir(dir_):
     p = Path(dir_)
     p.mkdir(parents=True,exist_ok=True)
     return str(p) 
 
-def run_bash(*, bash_path):
-    subprocess.run(["chmod","u+rx", bash_path])
-    output = subprocess.run(["sh", f"{bash_path}"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    print('raw subprocess output:')
-    print(output)
-    print('stdout:')
-    stdout = output.stdout.decode('utf-8')
-    print('stderr:')
-    stderr = output.stderr.decode('utf-8')
-    return {
-        'stdout': stdout,
-        'stderr': stderr
-    }
+# lives as long as the container, so warm invocations only fetch what changed
+
+policy_cache = PolicyCache(
+    bucket = os.environ['PaCPoliciesBucket'],
+    prefix = os.environ['PaCFramework'],
+    local_path = mkdir('/tmp/pac_policies'),
+    ttl_seconds = int(os.environ.get('PaCPoliciesCacheTTLSeconds',0))
+)
+
+policy_index = PolicyIndex()
+
+evaluation_context_location = json.loads(os.environ['EvaluationContext'])
+
+evaluation_context_cache = EvaluationContextCache(
+    bucket = evaluation_context_location['Bucket'],
+    key = evaluation_context_location['Key'],
+    local_path = '/tmp/evaluation_context.json',
+    ttl_seconds = int(os.environ.get('EvaluationContextCacheTTLSeconds',0))
+)
+
+opa_mode = os.environ.get('OpaMode','eval')
+
+evaluator = get_evaluator(
+    opa_mode,
+    **({'partial_cache_size': int(os.environ.get('PartialEvaluationCacheSize',32))} if opa_mode == 'server' else {})
+)
+
+# templates evaluated one resource at a time for resource-local packages, reusing the verdicts of unchanged resources
+
+incremental_evaluation = os.environ.get('IncrementalEvaluation','false') == 'true'
 
-def write_to_tmp(object_,filename):
+resource_verdict_cache = ResourceVerdictCache(
+    size = int(os.environ.get('IncrementalCacheSize',4096))
+)
+
+# inputs this large are split into resource chunks for resource-local packages, evaluated side by side;
+# Lambda allots vCPUs in proportion to memory, which cpu_count reflects
+
+CHUNKED_EVALUATION_MIN_BYTES = int(os.environ.get('ChunkedEvaluationMinBytes',1024*1024))
+
+EVALUATION_CONCURRENCY = int(os.environ.get('EvaluationConcurrency',0)) or os.cpu_count() or 1
+
+# each package queried on its own with this deadline, so one slow policy cannot hold up the others; 0 queries them together
+
+PACKAGE_DEADLINE_MS = int(os.environ.get('PackageDeadlineMs',0))
+
+PACKAGE_TIMED_OUT = {'allow': None, 'reason': 'timeout'}
+
+# the current request's budget: the invocation's remaining time or the RemainingTimeMs its caller sent, whichever
+# is shorter, less this margin to answer in. OPA is stopped once it runs out, rather than the caller giving up on it
+
+ENGINE_DEADLINE_MARGIN_MS = int(os.environ.get('EngineDeadlineMarginMs',500))
+
+request_deadline = Deadline()
+
+def reset_request_deadline(*,request_json_body:dict,context):
     
-    with open(f'/tmp/{filename}','w') as f:
-        json.dump(object_,f,indent=2)
+    budgets = [
+        budget for budget in [
+            Deadline.from_context(context).remaining_ms(),
+            request_json_body.get('RemainingTimeMs')
+        ] if budget is not None
+    ]
+    
+    request_deadline.reset(min(budgets) if budgets else None,margin_ms=ENGINE_DEADLINE_MARGIN_MS)
+    
+    print(f'request_deadline:\nremaining_ms:\n{request_deadline.remaining_ms()}')
 
-def lambda_handler(event,context):
-    print(f'event\n{event}\ncontext:\n{context}')
+def get_result_cache():
     
-    request_json_body = json.loads(event['body'])
+    store = os.environ.get('ResultCacheStore','none')
     
-    print(f'request_json_body:\n{request_json_body}')
+    ttl_seconds = int(os.environ.get('ResultCacheTTLSeconds',86400))
+    
+    if store == 'none':
+        return None
+    elif store == 's3':
+        store = S3ResultCacheStore(s3=s3,bucket=os.environ['ResultCacheBucket'])
+    elif store == 'dynamodb':
+        store = DynamoDBResultCacheStore(
+            dynamodb = LazyClient('dynamodb'),
+            table = os.environ['ResultCacheTable'],
+            ttl_seconds = max(ttl_seconds,int(os.environ.get('ResultCacheStaleSeconds',0)))
+        )
+    elif store == 'memory':
+        store = MemoryResultCacheStore()
+    else:
+        raise ValueError(f'unknown ResultCacheStore: {store}, expected one of none, s3, dynamodb, memory')
+    
+    return ResultCache(
+        store = store,
+        s3 = s3,
+        ttl_seconds = ttl_seconds,
+        stale_seconds = int(os.environ.get('ResultCacheStaleSeconds',0)),
+        serve_stale = os.environ.get('ResultCacheServeStale','never')
+    )
 
-    input_to_be_evaluated = request_json_body['InputToBeEvaluated']
+result_cache = get_result_cache()
+
+# a container answers from the stale cache at most once before loading policies, so it cannot stay cold
+
+served_stale_cold = False
+
+def load_policies(request_data:dict):
+    
+    # get PaC Framework bundle
+    
+    policy_cache.sync()
+    
+    policy_index_key = os.environ.get('PaCPolicyIndexKey')
     
-    print(f'input_to_be_evaluated:\n{input_to_be_evaluated}')
+    policy_index.load(
+        path = policy_cache.local_file(policy_index_key) if policy_index_key else None,
+        version = policy_cache.manifest.get(policy_index_key)
+    )
+    
+    packages = policy_index.packages(request_data['InputType'])
+    
+    print(f'packages:\n{packages}')
+    
+    # no policy applies to this InputType, OPA is skipped entirely
     
-    # write InputType to tmp
+    if packages != []:
+        evaluator.load(
+            bundle_path = policy_cache.local_file(os.environ['PaCBundleKey']),
+            evaluation_context_path = evaluation_context_cache.local_path
+        )
+    
+    return packages
+
+def evaluated_against(packages):
     
-    input_type = {
-        "InputType":request_json_body['InputType']
+    return {
+        'Packages': packages,
+        'EvaluationContextVersion': evaluation_context_cache.version,
+        'PaCBundleVersion': policy_cache.manifest.get(os.environ['PaCBundleKey'],'').strip('"')
     }
+
+def package_deadline():
     
-    write_to_tmp(input_type,'input_type.json')
+    # a package's own deadline, never past the request's
     
-    # write approved_context to tmp
+    remaining_ms = request_deadline.remaining_ms()
     
-    approved_context = {
-        "ApprovedContext":request_json_body['Context']
+    return Deadline(PACKAGE_DEADLINE_MS if remaining_ms is None else min(PACKAGE_DEADLINE_MS,remaining_ms))
+
+def evaluate_each_package(evaluate_units,packages):
+    
+    # evaluate_units(packages,deadline=,workers=) -> (results, stats) or None, called for each package on its own
+    # within its own deadline; a package past it is reported as timed out, as evaluate_packages does
+    
+    workers = max(1,EVALUATION_CONCURRENCY // len(packages))
+    
+    def evaluate_package(package):
+        try:
+            return evaluate_units([package],deadline=package_deadline(),workers=workers)
+        except TimeoutError as e:
+            print(f'package timed out:\npackage:\n{package}\n{e}')
+            return {package: dict(PACKAGE_TIMED_OUT)}, None
+    
+    if evaluator.concurrent and len(packages) > 1:
+        with ThreadPoolExecutor(max_workers=min(EVALUATION_CONCURRENCY,len(packages))) as executor:
+            package_results = list(executor.map(evaluate_package,packages))
+    else:
+        package_results = [evaluate_package(package) for package in packages]
+    
+    request_deadline.check('OpaEval')
+    
+    if any(package_result is None for package_result in package_results):
+        return None
+    
+    results = {}
+    package_stats = []
+    timed_out = []
+    
+    for package, (result, stats) in zip(packages,package_results):
+        results.update(result)
+        if stats is None:
+            timed_out.append(package)
+        else:
+            package_stats.append(stats)
+    
+    # the input's size is the same for every package, the work done adds up
+    
+    stats = {
+        name: max(s[name] for s in package_stats) if name in ('Resources','Chunks') else sum(s[name] for s in package_stats)
+        for name in (package_stats[0] if package_stats else {})
     }
     
-    write_to_tmp(approved_context,'approved_context.json')
+    return results, stats, timed_out
+
+def evaluate_by_resource(*,request_data:dict,input_bytes:bytes,packages):
+    
+    # resource-local packages only: incrementally for templates, in parallel chunks for any other large input.
+    # None where neither applies, and the input is evaluated whole. Returns (results, stats, timed out packages)
+    
+    resource_local = policy_index.resource_local(packages)
+    
+    chunked = len(input_bytes) >= CHUNKED_EVALUATION_MIN_BYTES
+    
+    if not resource_local or not (incremental_evaluation or chunked):
+        return None
+    
+    input_ = json.loads(input_bytes)
+    
+    incremental = incremental_evaluation and isinstance(input_,dict) and isinstance(input_.get('Resources'),dict)
+    
+    if not incremental and not chunked:
+        return None
+    
+    def evaluate_units(units_packages,*,deadline,workers):
+        if incremental:
+            return evaluate_resources(
+                evaluator = evaluator,
+                cache = resource_verdict_cache,
+                request_data = request_data,
+                template = input_,
+                packages = units_packages,
+                versions = evaluated_against(packages),
+                workers = workers,
+                deadline = deadline
+            )
+        return evaluate_chunks(
+            evaluator = evaluator,
+            request_data = request_data,
+            input_ = input_,
+            packages = units_packages,
+            workers = workers,
+            deadline = deadline
+        )
     
-    # get evaluation context
+    timed_out = []
     
-    evaluation_context_path = '/tmp/evaluation_context.json'
+    try:
+        if PACKAGE_DEADLINE_MS:
+            by_units = evaluate_each_package(evaluate_units,resource_local)
+            if by_units is None:
+                return None
+            results, stats, timed_out = by_units
+        else:
+            by_units = evaluate_units(resource_local,deadline=request_deadline,workers=EVALUATION_CONCURRENCY)
+            if by_units is None:
+                return None
+            results, stats = by_units
+    except MergeConflict as e:
+        print(f'evaluation by resource not possible, evaluating the whole input:\n{e}')
+        return None
+    
+    if incremental:
+        stats = {'Incremental': stats}
+        metrics.put('IncrementalResourcesEvaluated',stats['Incremental'].get('Evaluated',0),unit='Count')
+        metrics.put('IncrementalResourcesReused',stats['Incremental'].get('Reused',0),unit='Count')
+    else:
+        stats = {'Chunked': stats}
+        metrics.put('EvaluationChunks',stats['Chunked'].get('Chunks',0),unit='Count')
     
-    evaluation_context = json.loads(os.environ['EvaluationContext'])
+    whole_input_packages = [package for package in packages if package not in resource_local]
     
-    s3_download(
-        bucket = evaluation_context['Bucket'],
-        key = evaluation_context['Key'],
-        local_path = evaluation_context_path
-    )
+    if whole_input_packages and PACKAGE_DEADLINE_MS:
+        whole_input_results, _, _, whole_input_timed_out = evaluate_packages(
+            request_data = request_data,
+            input_bytes = input_bytes,
+            packages = whole_input_packages,
+            evaluation_mode = 'decision'
+        )
+        results.update(whole_input_results)
+        timed_out += whole_input_timed_out
+    elif whole_input_packages:
+        whole_input_results, _ = evaluator.evaluate(
+            request_data = request_data,
+            input_bytes = input_bytes,
+            packages = whole_input_packages,
+            timeout = request_deadline.timeout()
+        )
+        results.update(whole_input_results)
     
-    # write ConsumerMetadata to /tmp
+    if PACKAGE_DEADLINE_MS:
+        metrics.put('PackageTimeouts',len([package for package in timed_out if package in resource_local]),unit='Count')
     
-    consumer_metadata= request_json_body['ConsumerMetadata']
+    print(f'evaluation by resource:\n{stats}')
     
-    print(f'consumer_metadata:\n{consumer_metadata}')
+    return {package: results[package] for package in packages if package in results}, stats, timed_out
 
-    write_to_tmp(consumer_metadata,'consumer_metadata.json')
+def evaluate_packages(*,request_data:dict,input_bytes:bytes,packages,evaluation_mode):
+    
+    # a package past its deadline is reported as not applicable with a reason rather than failing the request;
+    # once the request's own deadline has passed too, the request fails
+    
+    timings = {}
+    
+    def evaluate_package(package):
+        start = time.perf_counter()
+        try:
+            return evaluator.evaluate(
+                request_data = request_data,
+                input_bytes = input_bytes,
+                packages = [package],
+                mode = evaluation_mode,
+                timeout = request_deadline.timeout(PACKAGE_DEADLINE_MS/1000)
+            )
+        except TimeoutError as e:
+            print(f'package timed out:\npackage:\n{package}\n{e}')
+            return {package: dict(PACKAGE_TIMED_OUT)}, None
+        finally:
+            timings[package] = elapsed_ms(start)
+    
+    if evaluator.concurrent and len(packages) > 1:
+        with ThreadPoolExecutor(max_workers=min(EVALUATION_CONCURRENCY,len(packages))) as executor:
+            package_results = list(executor.map(evaluate_package,packages))
+    else:
+        package_results = [evaluate_package(package) for package in packages]
+    
+    results = {}
+    explanations = {}
+    
+    for package, (result, explanation) in zip(packages,package_results):
+        results.update(result)
+        if explanation is not None:
+            # the server already keys explanations by package, opa eval returns the query's trace
+            explanations[package] = explanation.get(package,explanation) if isinstance(explanation,dict) else explanation
+    
+    timed_out = [package for package in packages if results.get(package) == PACKAGE_TIMED_OUT]
+    
+    for package in packages:
+        metrics.put('PackageEval',timings[package])
+    
+    metrics.put('PackageTimeouts',len(timed_out),unit='Count')
+    
+    request_deadline.check('OpaEval')
+    
+    return results, explanations or None, {package: timings[package] for package in packages}, timed_out
 
-    # write input_analyzed_object to /tmp
+def evaluate(*,request_data:dict,input_bytes:bytes,packages,evaluation_mode,timed_out_packages:list=None):
+    
+    # packages that ran out of time are added to timed_out_packages: their results are no verdict, never cached
     
-    input_to_be_evaluated_object_path = '/tmp/input_to_be_evaluated_object.json'
+    # record what the results were evaluated against
     
-    s3_download(
-        bucket = input_to_be_evaluated['Bucket'],
-        key = input_to_be_evaluated['Key'],
-        local_path = input_to_be_evaluated_object_path
+    eval_engine = {
+        'InputType': request_data['InputType'],
+        'EvaluationMode': evaluation_mode,
+        **evaluated_against(packages)
+    }
+    
+    if packages == []:
+        yield json.dumps({'EvalEngine': eval_engine}).encode('utf-8')
+        return
+    
+    by_resource = evaluate_by_resource(
+        request_data = request_data,
+        input_bytes = input_bytes,
+        packages = packages
+    ) if evaluation_mode == 'decision' else None
+    
+    if by_resource is not None:
+        opa_eval_results, stats, timed_out = by_resource
+        eval_engine.update(stats)
+        if timed_out:
+            eval_engine['TimedOutPackages'] = timed_out
+            if timed_out_packages is not None:
+                timed_out_packages.extend(timed_out)
+        opa_eval_results['EvalEngine'] = eval_engine
+        yield json.dumps(opa_eval_results).encode('utf-8')
+        return
+    
+    # with per-package deadlines the packages are separate queries, so their results are parsed and joined here
+    
+    if PACKAGE_DEADLINE_MS and packages is not None:
+        
+        opa_eval_results, explanation, eval_engine['PackageTimingsMs'], timed_out = evaluate_packages(
+            request_data = request_data,
+            input_bytes = input_bytes,
+            packages = packages,
+            evaluation_mode = evaluation_mode
+        )
+        
+        if timed_out:
+            eval_engine['TimedOutPackages'] = timed_out
+            if timed_out_packages is not None:
+                timed_out_packages.extend(timed_out)
+        
+        if explanation is not None:
+            eval_engine['Explanation'] = explanation
+        
+        opa_eval_results['EvalEngine'] = eval_engine
+        
+        yield json.dumps(opa_eval_results).encode('utf-8')
+        return
+    
+    # where the evaluator can stream its output, OPA's bytes go to S3 as they are: nothing in the
+    # engine needs fields from the result, so it is never parsed
+    
+    if evaluation_mode == 'decision' and hasattr(evaluator,'evaluate_stream'):
+        yield from splice_eval_engine(
+            evaluator.evaluate_stream(
+                request_data = request_data,
+                input_bytes = input_bytes,
+                packages = packages,
+                timeout = request_deadline.timeout()
+            ),
+            eval_engine
+        )
+        return
+    
+    opa_eval_results, explanation = evaluator.evaluate(
+        request_data = request_data,
+        input_bytes = input_bytes,
+        packages = packages,
+        mode = evaluation_mode,
+        timeout = request_deadline.timeout()
     )
     
-    # get PaC Framework Policies
+    print(f'opa_eval_results:\n{list(opa_eval_results)}')
     
-    policy_path_root = mkdir('/tmp/pac_policies')
+    if explanation is not None:
+        eval_engine['Explanation'] = explanation
     
-    s3_download_dir(
-        bucket = os.environ['PaCPoliciesBucket'],
-        local_path = policy_path_root,
-        prefix = os.environ['PaCFramework']
+    opa_eval_results['EvalEngine'] = eval_engine
+    
+    yield json.dumps(opa_eval_results).encode('utf-8')
+
+def result_cache_keys(*,request_data:dict,input_bytes:bytes,packages,evaluation_mode):
+    
+    # the exact verdict first, then the lineage that keeps the last verdict across policy and context versions
+    
+    return [
+        cache_key(
+            input_bytes = input_bytes,
+            request_data = request_data,
+            evaluation_mode = evaluation_mode,
+            versions = evaluated_against(packages)
+        ),
+        cache_key(
+            input_bytes = input_bytes,
+            request_data = request_data,
+            evaluation_mode = evaluation_mode
+        )
+    ]
+
+def revalidate(*,context,request_json_body:dict):
+    
+    # evaluated again by an asynchronous invocation of this function, which skips cache lookups,
+    # overwrites the stale raw result and refreshes the cache entries. Marked as the transport marks
+    # its events, so that a timeout fails the invocation for Lambda to retry rather than being answered
+    
+    lambda_.invoke(
+        FunctionName = context.invoked_function_arn,
+        InvocationType = 'Event',
+        Payload = json.dumps({
+            'body': json.dumps({**request_json_body,'ResultCacheRevalidate': True}),
+            'InvocationType': 'Event'
+        })
     )
+    
+    print(f'ResultCache revalidation invoked:\nfunction:\n{context.invoked_function_arn}')
 
-    # opa to tmp
+def elapsed_ms(start):
+    return round((time.perf_counter() - start)*1000, 1)
 
-    shutil.copy('./opa','/tmp/opa')
+def evaluate_batch(*,request_data:dict,inputs:list,packages,evaluation_mode):
+    
+    # every input is evaluated against the policies already loaded for this invocation;
+    # a failure is reported against its own input and never fails the rest of the batch
+    
+    reports = [
+        {
+            'Index': index,
+            'Key': item['ResponseExpectedByConsumer']['ControlBrokerEvaluation']['Raw']['Key'],
+            'Status': 'Failed',
+            'TimingsMs': {}
+        } for index, item in enumerate(inputs)
+    ]
+    
+    def fetch(index):
+        if 'Inline' in inputs[index]['InputToBeEvaluated']:
+            return get_input_bytes(inputs[index]['InputToBeEvaluated'])
+        start = time.perf_counter()
+        try:
+            return get_object_bytes(
+                bucket = inputs[index]['InputToBeEvaluated']['Bucket'],
+                key = inputs[index]['InputToBeEvaluated']['Key']
+            )
+        except Exception as e:
+            reports[index]['Error'] = f'GetInput: {e}'
+        finally:
+            reports[index]['TimingsMs']['GetInput'] = elapsed_ms(start)
+    
+    # cache keys per input, only set while the result cache is enabled
+    
+    cache_keys = {}
+    
+    def put(index, raw_result=None, cache_entry=None, cacheable=True):
+        start = time.perf_counter()
+        raw = inputs[index]['ResponseExpectedByConsumer']['ControlBrokerEvaluation']['Raw']
+        try:
+            if cache_entry:
+                result_cache.copy(cache_entry,bucket=raw['Bucket'],key=raw['Key'],status='hit')
+            else:
+                put_raw_result(
+                    s3 = s3,
+                    bucket = raw['Bucket'],
+                    key = raw['Key'],
+                    chunks = [raw_result]
+                )
+                if index in cache_keys and cacheable:
+                    result_cache.put(cache_keys[index],bucket=raw['Bucket'],key=raw['Key'])
+        except Exception as e:
+            reports[index]['Error'] = f'PutResult: {e}'
+        else:
+            reports[index]['Status'] = 'Succeeded'
+        finally:
+            reports[index]['TimingsMs']['PutResult'] = elapsed_ms(start)
+    
+    start = time.perf_counter()
+    
+    with ThreadPoolExecutor(max_workers=max(1,min(BATCH_CONCURRENCY,len(inputs)))) as executor:
+        
+        input_bytes = list(executor.map(fetch,range(len(inputs))))
+        
+        # the evaluator holds one OPA process and its request-scoped state, so evaluations run one at a time
+        
+        put_futures = []
+        
+        for index, input_bytes_ in enumerate(input_bytes):
+            
+            if input_bytes_ is None:
+                continue
+            
+            # inputs left once the deadline has passed are reported as failed, so the caller can resend only those
+            
+            if request_deadline.expired():
+                reports[index]['Error'] = 'Evaluate: deadline exceeded'
+                continue
+            
+            if result_cache:
+                
+                cache_keys[index] = result_cache_keys(
+                    request_data = request_data,
+                    input_bytes = input_bytes_,
+                    packages = packages,
+                    evaluation_mode = evaluation_mode
+                )
+                
+                cache_entry = result_cache.get(cache_keys[index][0])
+                
+                reports[index]['ResultCache'] = 'Hit' if cache_entry else 'Miss'
+                
+                metrics.put('ResultCacheHit' if cache_entry else 'ResultCacheMiss',1,unit='Count')
+                
+                if cache_entry:
+                    put_futures.append(executor.submit(put,index,cache_entry=cache_entry))
+                    continue
+            
+            evaluate_start = time.perf_counter()
+            
+            timed_out_packages = []
+            
+            try:
+                raw_result = b''.join(evaluate(
+                    request_data = request_data,
+                    input_bytes = input_bytes_,
+                    packages = packages,
+                    evaluation_mode = evaluation_mode,
+                    timed_out_packages = timed_out_packages
+                ))
+            except Exception as e:
+                reports[index]['Error'] = f'Evaluate: {e}'
+                continue
+            finally:
+                reports[index]['TimingsMs']['Evaluate'] = elapsed_ms(evaluate_start)
+            
+            put_futures.append(executor.submit(put,index,raw_result,cacheable=not timed_out_packages))
+        
+        for future in put_futures:
+            future.result()
+    
+    phases = {'GetInput': 'InputDownload', 'Evaluate': 'OpaEval', 'PutResult': 'ResultUpload'}
+    
+    for report in reports:
+        for timing, ms in report['TimingsMs'].items():
+            metrics.put(phases[timing],ms)
+    
+    batch_report = {
+        'Inputs': reports,
+        'Succeeded': sum(report['Status'] == 'Succeeded' for report in reports),
+        'Failed': sum(report['Status'] == 'Failed' for report in reports),
+        'ElapsedMs': elapsed_ms(start)
+    }
+    
+    print(f'batch_report:\n{batch_report}')
+    
+    return batch_report
+
+def handle_queue_batch(*,records:list,context):
+    
+    # each record is one engine request; a failed record is retried by SQS on its own, and moved to the
+    # dead-letter queue once it has been received maxReceiveCount times
     
-    os.chmod('/tmp/opa',755)
+    batch_item_failures = []
+    
+    for record in records:
+        
+        sent_timestamp = record.get('attributes',{}).get('SentTimestamp')
         
-    shutil.copy('./opa-eval.sh','/tmp/opa-eval.sh')
+        if sent_timestamp:
+            metrics.put('QueueWait',int(time.time()*1000) - int(sent_timestamp))
+        
+        try:
+            request_json_body = json.loads(record['body'])
+            reset_request_deadline(request_json_body=request_json_body,context=context)
+            handle_request(
+                request_json_body = request_json_body,
+                context = context
+            )
+        except Exception as e:
+            print(f'queued request failed:\nmessage_id:\n{record["messageId"]}\n{type(e).__name__}: {e}')
+            batch_item_failures.append({'itemIdentifier': record['messageId']})
+    
+    metrics.put('QueueMessages',len(records),unit='Count')
+    metrics.put('QueueMessageFailures',len(batch_item_failures),unit='Count')
+    
+    return {'batchItemFailures': batch_item_failures}
+
+def handle_request(*,request_json_body:dict,context):
     
-    # eval
+    global served_stale_cold
     
-    opa_eval_result = run_bash(bash_path='/tmp/opa-eval.sh')
+    print(f'request_json_body:\n{request_json_body}')
+    
+    # request-scoped data: InputType, ApprovedContext
+    
+    request_data = {
+        "InputType":request_json_body['InputType'],
+        "ApprovedContext":request_json_body['Context']
+    }
+    
+    metrics.set_input_type(request_data['InputType'])
+    
+    evaluation_mode = get_evaluation_mode(request_json_body)
+    
+    print(f'evaluation_mode:\n{evaluation_mode}')
+    
+    # get evaluation context
+    
+    request_deadline.check('ContextFetch')
+    
+    with metrics.phase('ContextFetch'):
+        evaluation_context_cache.get()
+    
+    consumer_metadata= request_json_body['ConsumerMetadata']
     
-    print(f'eval_result:\n{opa_eval_result}\n{type(opa_eval_result)}')
+    print(f'consumer_metadata:\n{consumer_metadata}')
+    
+    # set when this invocation revalidates a stale cached result: the cache is written but not read
+    
+    revalidating = bool(request_json_body.get('ResultCacheRevalidate'))
+    
+    # no policies loaded yet, the most expensive invocation a saturated engine can be asked for
+    
+    cold = policy_cache.last_validated is None and not served_stale_cold
+    
+    # batch form: a list of inputs, each with its own InputToBeEvaluated and ResponseExpectedByConsumer
+    
+    if 'Inputs' in request_json_body:
+        
+        with metrics.phase('PolicySync'):
+            packages = load_policies(request_data)
+        
+        return {
+            'Batch': evaluate_batch(
+                request_data = request_data,
+                inputs = request_json_body['Inputs'],
+                packages = packages,
+                evaluation_mode = evaluation_mode
+            )
+        }
 
-    stdout_ = json.loads(opa_eval_result.get('stdout'))
-    print(f'stdout_:\n{stdout_}\n{type(stdout_)}')
+    input_to_be_evaluated = request_json_body['InputToBeEvaluated']
     
-    opa_eval_results = stdout_
-    print(f'opa_eval_results:\n{opa_eval_results}\n{type(opa_eval_results)}')
+    print(f'input_to_be_evaluated:\n{input_to_be_evaluated["Bucket"]}/{input_to_be_evaluated["Key"]}')
+
+    # get input_analyzed_object, kept in memory and handed to OPA as-is
     
-    # put raw pac results
+    request_deadline.check('InputDownload')
+    
+    input_to_be_evaluated_object = get_input_bytes(input_to_be_evaluated)
     
     response_expected_by_consumer = request_json_body['ResponseExpectedByConsumer']
     
-    put_object(
-        bucket=response_expected_by_consumer['ControlBrokerEvaluation']['Raw']['Bucket'],
-        key=response_expected_by_consumer['ControlBrokerEvaluation']['Raw']['Key'],
-        object_ = opa_eval_results
-    )
+    raw = response_expected_by_consumer['ControlBrokerEvaluation']['Raw']
+    
+    def serve_stale(lineage_key):
+        
+        cache_entry = result_cache.get_stale(lineage_key,cold=cold)
+        
+        if cache_entry:
+            metrics.put('ResultCacheStaleHit',1,unit='Count')
+            with metrics.phase('ResultCopy'):
+                result_cache.copy(cache_entry,bucket=raw['Bucket'],key=raw['Key'],status='stale')
+            revalidate(context=context,request_json_body=request_json_body)
+        
+        return bool(cache_entry)
+    
+    if result_cache and not revalidating and cold:
+        
+        # the lineage key needs no policies, so a stale verdict can be served before loading them
+        
+        lineage_key = cache_key(
+            input_bytes = input_to_be_evaluated_object,
+            request_data = request_data,
+            evaluation_mode = evaluation_mode
+        )
+        
+        if serve_stale(lineage_key):
+            served_stale_cold = True
+            return True
+    
+    request_deadline.check('PolicySync')
+    
+    with metrics.phase('PolicySync'):
+        packages = load_policies(request_data)
+    
+    if result_cache:
+        
+        cache_keys = result_cache_keys(
+            request_data = request_data,
+            input_bytes = input_to_be_evaluated_object,
+            packages = packages,
+            evaluation_mode = evaluation_mode
+        )
+        
+        if not revalidating:
+            
+            cache_entry = result_cache.get(cache_keys[0])
+            
+            metrics.put('ResultCacheHit' if cache_entry else 'ResultCacheMiss',1,unit='Count')
+            
+            if cache_entry:
+                with metrics.phase('ResultCopy'):
+                    result_cache.copy(cache_entry,bucket=raw['Bucket'],key=raw['Key'],status='hit')
+                return True
+            
+            if not cold and serve_stale(cache_keys[1]):
+                return True
+    
+    request_deadline.check('OpaEval')
+    
+    # eval, streamed gzipped into raw pac results as it is produced
+    
+    # time spent producing chunks counts as OpaEval, the rest as ResultUpload
+    
+    timed_out_packages = []
+    
+    with metrics.phase('ResultUpload',excluding='OpaEval'):
+        put_raw_result(
+            s3 = s3,
+            bucket = raw['Bucket'],
+            key = raw['Key'],
+            chunks = metrics.iterate('OpaEval',evaluate(
+                request_data = request_data,
+                input_bytes = input_to_be_evaluated_object,
+                packages = packages,
+                evaluation_mode = evaluation_mode,
+                timed_out_packages = timed_out_packages
+            ))
+        )
+    
+    # a verdict missing a package that ran out of time is not cached, the next request evaluates it again
+    
+    if result_cache and not timed_out_packages:
+        result_cache.put(cache_keys,bucket=raw['Bucket'],key=raw['Key'])
     
     return True
-    
\ No newline at end of file
+
+@metrics.instrument
+def lambda_handler(event,context):
+    
+    print(f'event\n{event}\ncontext:\n{context}')
+    
+    # queued by the handlers in async mode: an SQS batch rather than an API Gateway request.
+    # Direct invocations from the handlers carry the same {"body": ...} payload as API Gateway
+    
+    if 'Records' in event:
+        return handle_queue_batch(
+            records = event['Records'],
+            context = context
+        )
+    
+    request_json_body = json.loads(event['body'])
+    
+    reset_request_deadline(request_json_body=request_json_body,context=context)
+    
+    # out of budget: a structured answer the handler can report, before API Gateway gives up with its own 504.
+    # A streamed raw result is aborted with its multipart upload, so no partial result is left behind
+    
+    try:
+        return handle_request(
+            request_json_body = request_json_body,
+            context = context
+        )
+    except TimeoutError as e:
+        print(f'request timed out:\n{e}')
+        metrics.put('RequestTimeouts',1,unit='Count')
+        # nobody waits on an asynchronous invocation: failing it has Lambda retry it, then send it to the dead letters
+        if event.get('InvocationType') == 'Event':
+            raise
+        return {
+            'statusCode': 504,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({
+                'EvalEngine': {
+                    'Status': 'Timeout',
+                    'Error': str(e),
+                    'BudgetMs': request_json_body.get('RemainingTimeMs')
+                }
+            })
+        }
+    except Exception as e:
+        # an S3 error, OPA exiting non-zero, a wasm trap: still an answer the handler can pass on to the consumer
+        print(f'request failed:\n{type(e).__name__}: {e}')
+        metrics.put('RequestErrors',1,unit='Count')
+        if event.get('InvocationType') == 'Event':
+            raise
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({
+                'EvalEngine': {
+                    'Status': 'Error',
+                    'Error': f'{type(e).__name__}: {e}'
+                }
+            })
+        }
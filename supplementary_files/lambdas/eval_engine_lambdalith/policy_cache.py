@@ -0,0 +1,156 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+DOWNLOAD_CONCURRENCY = int(os.environ.get('PaCPoliciesDownloadConcurrency',16))
+
+# one connection per download thread, plus headroom for multipart ranges of larger objects such as the bundle
+
+s3 = boto3.client('s3', config=Config(max_pool_connections=DOWNLOAD_CONCURRENCY*2))
+
+transfer_config = TransferConfig(
+    max_concurrency = DOWNLOAD_CONCURRENCY,
+    multipart_threshold = 8*1024*1024,
+    multipart_chunksize = 8*1024*1024
+)
+
+class PolicyCache():
+    """Mirror of a PaC policy prefix in /tmp that lives as long as the container.
+
+    Keeps a manifest of {Key: ETag} for every object it has downloaded. Each sync
+    revalidates the whole prefix with a single flat listing (skipped entirely while
+    the TTL has not elapsed), downloads only new or changed objects on a pooled
+    thread pool and prunes objects that were removed from the bucket.
+    """
+
+    def __init__(self,*,
+        bucket:str,
+        prefix:str,
+        local_path:str,
+        ttl_seconds:int=0
+    ):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.local_path = local_path
+        self.ttl_seconds = ttl_seconds
+
+        self.manifest = {}
+        self.last_validated = None
+
+    def is_fresh(self):
+        if self.last_validated is None:
+            return False
+        return time.monotonic() - self.last_validated < self.ttl_seconds
+
+    def local_file(self,key):
+        return os.path.join(self.local_path,key)
+
+    def list_remote(self):
+
+        paginator = s3.get_paginator('list_objects_v2')
+
+        pagination = paginator.paginate(Bucket=self.bucket, Prefix=self.prefix)
+
+        remote = {}
+
+        for result in pagination:
+            for file in result.get('Contents', []):
+                if not file['Key'].endswith('/'):
+                    remote[file['Key']] = file
+
+        return remote
+
+    def download(self,key):
+
+        dest_pathname = self.local_file(key)
+
+        Path(dest_pathname).parent.mkdir(parents=True,exist_ok=True)
+
+        # download beside the destination and swap it in, so a failed download never leaves a truncated policy behind
+
+        partial_pathname = f'{dest_pathname}.partial'
+
+        try:
+            s3.download_file(
+                self.bucket,
+                key,
+                partial_pathname,
+                Config = transfer_config
+            )
+        except ClientError as e:
+            print(f'ClientError:\nbucket: {self.bucket}\nkey:\n{key}\n{e}')
+            raise
+
+        os.replace(partial_pathname,dest_pathname)
+
+    def prune(self,key):
+
+        dest_pathname = Path(self.local_file(key))
+
+        dest_pathname.unlink(missing_ok=True)
+
+        # remove directories left empty, up to the cache root
+
+        root = Path(self.local_path)
+        parent = dest_pathname.parent
+
+        while parent != root and root in parent.parents and not any(parent.iterdir()):
+            parent.rmdir()
+            parent = parent.parent
+
+    def sync(self):
+
+        if self.is_fresh():
+            print(f'PolicyCache fresh, skipping revalidation:\nbucket:\n{self.bucket}\nprefix:\n{self.prefix}')
+            return {
+                'Revalidated': False,
+                'Downloaded': 0,
+                'DownloadedBytes': 0,
+                'Pruned': 0,
+                'Cached': len(self.manifest),
+                'ElapsedMs': 0
+            }
+
+        start = time.perf_counter()
+
+        remote = self.list_remote()
+
+        changed = [
+            key for key, file in remote.items()
+            if self.manifest.get(key) != file['ETag'] or not os.path.exists(self.local_file(key))
+        ]
+
+        removed = [key for key in self.manifest if key not in remote]
+
+        if changed:
+            with ThreadPoolExecutor(max_workers=min(DOWNLOAD_CONCURRENCY,len(changed))) as executor:
+                # list() surfaces the first download error, if any
+                list(executor.map(self.download,changed))
+
+        for key in changed:
+            self.manifest[key] = remote[key]['ETag']
+
+        for key in removed:
+            self.prune(key)
+            del self.manifest[key]
+
+        self.last_validated = time.monotonic()
+
+        summary = {
+            'Revalidated': True,
+            'Downloaded': len(changed),
+            'DownloadedBytes': sum(remote[key]['Size'] for key in changed),
+            'Pruned': len(removed),
+            'Cached': len(self.manifest),
+            'ElapsedMs': round((time.perf_counter() - start)*1000, 1)
+        }
+
+        print(f'PolicyCache synced:\nbucket:\n{self.bucket}\nprefix:\n{self.prefix}\n{summary}')
+
+        return summary
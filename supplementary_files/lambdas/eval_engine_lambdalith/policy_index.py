@@ -0,0 +1,41 @@
+import json
+
+class PolicyIndex():
+    """InputType -> applicable policy packages, as published next to the bundle at deploy time.
+
+    Reparsed only when the cached index file's version changes.
+    """
+
+    def __init__(self):
+        self.index = None
+        self.version = None
+
+    def load(self,*,path,version):
+
+        if version is None:
+            # no index deployed, every package is queried
+            self.index = None
+        elif version != self.version:
+            with open(path) as f:
+                self.index = json.load(f)
+            print(f'PolicyIndex loaded:\nversion:\n{version}\n{self.index}')
+
+        self.version = version
+
+    def packages(self,input_type):
+
+        if self.index is None:
+            return None
+
+        return sorted(
+            set(self.index['InputTypes'].get(input_type,[])) | set(self.index['AllInputTypes'])
+        )
+
+    def resource_local(self,packages):
+
+        # packages whose templates may be evaluated one resource at a time; none without an index
+
+        if self.index is None or packages is None:
+            return []
+
+        return sorted(set(packages) & set(self.index.get('ResourceLocal',[])))
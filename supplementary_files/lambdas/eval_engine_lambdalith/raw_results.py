@@ -0,0 +1,131 @@
+import json
+import os
+import zlib
+
+# S3 multipart parts must be at least 5MB, except the last
+
+PART_SIZE = int(os.environ.get('RawResultsPartSize',8*1024*1024))
+
+CONTENT_ENCODING = 'gzip'
+
+WHITESPACE = b' \t\r\n'
+
+def splice_eval_engine(chunks,eval_engine:dict):
+    """Appends the EvalEngine key to a JSON object streamed as bytes, without parsing it.
+
+    Everything but the closing brace is passed through as it arrives; the tail is held
+    back only until the stream ends.
+    """
+
+    members = 0
+    tail = b''
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        # cheap validation of the head, the tail is checked once the stream ends
+        if not members and chunk.strip(WHITESPACE) and not chunk.lstrip(WHITESPACE).startswith(b'{'):
+            raise ValueError('raw result is not a JSON object')
+        # non-whitespace bytes beyond "{}" mean the object already has members
+        members += len(chunk.translate(None,WHITESPACE))
+        tail += chunk
+        cut = len(tail) - 64
+        if cut > 0:
+            yield tail[:cut]
+            tail = tail[cut:]
+
+    tail = tail.rstrip(WHITESPACE)
+
+    # an undefined query prints nothing, recorded as an empty result
+
+    if not members:
+        tail = b'{}'
+
+    if not tail.endswith(b'}'):
+        raise ValueError('raw result is not a JSON object')
+
+    separator = b',' if members > 2 else b''
+
+    yield tail[:-1] + separator + b'"EvalEngine":' + json.dumps(eval_engine).encode('utf-8') + b'}'
+
+def put_raw_result(*,s3,bucket,key,chunks):
+    """gzips a raw result as it is produced and uploads it with Content-Encoding: gzip.
+
+    Results that compress to less than one part are sent with a single put_object,
+    larger ones are streamed part by part with a multipart upload.
+    """
+
+    compressor = zlib.compressobj(6,zlib.DEFLATED,31) # wbits 31: gzip container
+
+    buffer = bytearray()
+    upload_id = None
+    parts = []
+    size = 0
+    compressed_size = 0
+
+    def upload_part(body):
+        nonlocal compressed_size
+        compressed_size += len(body)
+        r = s3.upload_part(
+            Bucket = bucket,
+            Key = key,
+            UploadId = upload_id,
+            PartNumber = len(parts) + 1,
+            Body = bytes(body)
+        )
+        parts.append({'PartNumber': len(parts) + 1, 'ETag': r['ETag']})
+
+    try:
+
+        for chunk in chunks:
+
+            size += len(chunk)
+            buffer += compressor.compress(chunk)
+
+            # a chunk may compress to several parts, none of which stays buffered past its upload
+
+            while len(buffer) >= PART_SIZE:
+                if upload_id is None:
+                    upload_id = s3.create_multipart_upload(
+                        Bucket = bucket,
+                        Key = key,
+                        ContentType = 'application/json',
+                        ContentEncoding = CONTENT_ENCODING
+                    )['UploadId']
+                upload_part(buffer[:PART_SIZE])
+                del buffer[:PART_SIZE]
+
+        buffer += compressor.flush()
+
+        if upload_id is None:
+            compressed_size = len(buffer)
+            s3.put_object(
+                Bucket = bucket,
+                Key = key,
+                Body = bytes(buffer),
+                ContentType = 'application/json',
+                ContentEncoding = CONTENT_ENCODING
+            )
+        else:
+            upload_part(buffer)
+            s3.complete_multipart_upload(
+                Bucket = bucket,
+                Key = key,
+                UploadId = upload_id,
+                MultipartUpload = {'Parts': parts}
+            )
+
+    except Exception:
+        if upload_id is not None:
+            s3.abort_multipart_upload(Bucket=bucket,Key=key,UploadId=upload_id)
+        raise
+
+    summary = {
+        'Bytes': size,
+        'CompressedBytes': compressed_size,
+        'Parts': len(parts) or 1
+    }
+
+    print(f'raw result uploaded:\nbucket:\n{bucket}\nkey:\n{key}\n{summary}')
+
+    return summary
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from raw_results import CONTENT_ENCODING
+
+# serve-stale policies: never, only while this container is still loading policies, or whenever the exact result is missing
+
+SERVE_STALE = {'never','cold','always'}
+
+def canonical_json(value):
+    return json.dumps(value,sort_keys=True,separators=(',',':'),ensure_ascii=False).encode('utf-8')
+
+def cache_key(*,input_bytes:bytes,request_data:dict,evaluation_mode:str,versions:dict=None):
+    """sha256 over the exact input bytes and everything else the raw result depends on.
+
+    With versions (EvaluationContext, PaC bundle, packages) the key identifies one verdict;
+    without them it identifies the lineage of verdicts for the same input, i.e. the last one.
+    """
+
+    h = hashlib.sha256()
+
+    h.update(canonical_json({
+        'InputType': request_data['InputType'],
+        'ApprovedContext': request_data['ApprovedContext'],
+        'EvaluationMode': evaluation_mode,
+        **({'Versions': versions} if versions is not None else {})
+    }))
+    h.update(b'\n')
+    h.update(input_bytes)
+
+    return h.hexdigest()
+
+class S3ResultCacheStore():
+    """Cached raw results kept as copies in a bucket of their own, so they outlive the originals.
+
+    The entry's age is the copy's LastModified; expiry is left to the bucket's lifecycle rule.
+    """
+
+    def __init__(self,*,s3,bucket:str,prefix:str='results'):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def object_key(self,key):
+        return f'{self.prefix}/{key}'
+
+    def get(self,key):
+
+        try:
+            r = self.s3.head_object(
+                Bucket = self.bucket,
+                Key = self.object_key(key)
+            )
+        except ClientError as e:
+            if e.response.get('ResponseMetadata',{}).get('HTTPStatusCode') == 404:
+                return None
+            raise
+
+        return {
+            'Bucket': self.bucket,
+            'Key': self.object_key(key),
+            'CreatedAt': r['LastModified'].timestamp()
+        }
+
+    def put(self,key,*,bucket:str,object_key:str):
+
+        self.s3.copy_object(
+            CopySource = {'Bucket': bucket, 'Key': object_key},
+            Bucket = self.bucket,
+            Key = self.object_key(key)
+        )
+
+class DynamoDBResultCacheStore():
+    """Cached raw results as pointers to the raw result they were first written to.
+
+    Nothing is copied on a miss, at the cost of the entry dangling if that raw result is deleted.
+    """
+
+    def __init__(self,*,dynamodb,table:str,ttl_seconds:int):
+        self.dynamodb = dynamodb
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+
+    def get(self,key):
+
+        r = self.dynamodb.get_item(
+            TableName = self.table,
+            Key = {'CacheKey': {'S': key}}
+        )
+
+        item = r.get('Item')
+
+        if not item:
+            return None
+
+        return {
+            'Bucket': item['Bucket']['S'],
+            'Key': item['Key']['S'],
+            'CreatedAt': float(item['CreatedAt']['N'])
+        }
+
+    def put(self,key,*,bucket:str,object_key:str):
+
+        now = time.time()
+
+        self.dynamodb.put_item(
+            TableName = self.table,
+            Item = {
+                'CacheKey': {'S': key},
+                'Bucket': {'S': bucket},
+                'Key': {'S': object_key},
+                'CreatedAt': {'N': str(now)},
+                # DynamoDB TTL attribute, removal is best-effort so lookups check CreatedAt too
+                'ExpiresAt': {'N': str(int(now + self.ttl_seconds))}
+            }
+        )
+
+class MemoryResultCacheStore():
+    """In-process stand-in for tests and local runs, with the same pointer semantics as the DynamoDB store."""
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self,key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return dict(entry) if entry else None
+
+    def put(self,key,*,bucket:str,object_key:str):
+        with self.lock:
+            self.entries[key] = {
+                'Bucket': bucket,
+                'Key': object_key,
+                'CreatedAt': time.time()
+            }
+
+class ResultCache():
+    """Content-addressed raw results: a byte-identical request is answered with a server-side copy.
+
+    An exact entry is served while younger than ttl_seconds. Depending on serve_stale, the last
+    verdict for the same input under older policies or context (its lineage entry) may be served
+    while younger than stale_seconds, leaving the caller to revalidate it.
+    """
+
+    def __init__(self,*,
+        store,
+        s3,
+        ttl_seconds:int,
+        stale_seconds:int=0,
+        serve_stale:str='never'
+    ):
+        if serve_stale not in SERVE_STALE:
+            raise ValueError(f'unknown ResultCacheServeStale: {serve_stale}, expected one of {SERVE_STALE}')
+
+        self.store = store
+        self.s3 = s3
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.serve_stale = serve_stale
+
+    def lookup(self,key,*,max_age_seconds):
+
+        try:
+            entry = self.store.get(key)
+        except ClientError as e:
+            # the cache is an optimization, an unavailable store is a miss
+            print(f'ResultCache lookup failed:\nkey:\n{key}\n{e}')
+            return None
+
+        if entry is None or time.time() - entry['CreatedAt'] > max_age_seconds:
+            return None
+
+        return entry
+
+    def get(self,key):
+        return self.lookup(key,max_age_seconds=self.ttl_seconds)
+
+    def get_stale(self,lineage_key,*,cold:bool):
+
+        if self.serve_stale == 'never' or (self.serve_stale == 'cold' and not cold):
+            return None
+
+        return self.lookup(lineage_key,max_age_seconds=self.stale_seconds)
+
+    def copy(self,entry,*,bucket:str,key:str,status:str):
+
+        # metadata has to be restated to be replaced, status marks the raw result as served from the cache
+
+        self.s3.copy_object(
+            CopySource = {'Bucket': entry['Bucket'], 'Key': entry['Key']},
+            Bucket = bucket,
+            Key = key,
+            MetadataDirective = 'REPLACE',
+            ContentType = 'application/json',
+            ContentEncoding = CONTENT_ENCODING,
+            Metadata = {'result-cache': status}
+        )
+
+        print(f'ResultCache {status}:\nsource:\n{entry["Bucket"]}/{entry["Key"]}\ndestination:\n{bucket}/{key}')
+
+    def put(self,keys,*,bucket:str,key:str):
+
+        for cache_key_ in keys:
+            try:
+                self.store.put(cache_key_,bucket=bucket,object_key=key)
+            except ClientError as e:
+                print(f'ResultCache put failed:\nkey:\n{cache_key_}\n{e}')
@@ -1,19 +1,21 @@
 import json
-import re
 import os
 import uuid
 
-import boto3
 from botocore.exceptions import ClientError
 
-import requests
-from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
+from clients import LazyClient
+from instrumentation import Metrics
+from deadlines import Deadline
+from transport import DEADLINE_MARGIN_MS, engine_error_response, error_response, submit_evaluation
+from coalescing import IdempotencyKeyReused, request_coalescer
 
-s3 = boto3.client('s3')
+# set by the Lambda runtime, no session needed
+region = os.environ['AWS_REGION']
 
-session = boto3.session.Session()
-region = session.region_name
-account_id = boto3.client('sts').get_caller_identity().get('Account')
+s3 = LazyClient('s3')
+
+metrics = Metrics(handler='CloudFormation')
 
 class RequestParser():
     
@@ -126,45 +128,7 @@ class RequestParser():
         
         self.get_approved_context()
         
-def sign_request(*,
-    full_invoke_url:str,
-    region:str,
-    input:dict,
-):
-    
-    def get_host(full_invoke_url):
-        m = re.search('https://(.*)/.*',full_invoke_url)
-        return m.group(1)
-    
-    host = get_host(full_invoke_url)
-    
-    auth = BotoAWSRequestsAuth(
-        aws_host= host,
-        aws_region=region,
-        aws_service='execute-api'
-    )
-    
-    print(f'begin request\nfull_invoke_url\n{full_invoke_url}\njson input\n{input}')
-    
-    r = requests.post(
-        full_invoke_url,
-        auth = auth,
-        json = input
-    )
-    
-    print(f'signed request headers:\n{dict(r.request.headers)}')
-    
-    content = json.loads(r.content)
-    
-    r = {
-        'StatusCode':r.status_code,
-        'Content': content
-    }
-    
-    print(f'formatted response:\n{r}')
-    
-    return True
-
+@metrics.timed('InputUpload')
 def put_object(*,bucket,key,object_:dict):
     
     print(f'begin put_object\nbucket:\n{bucket}\nkey:\n{key}')
@@ -193,6 +157,7 @@ def generate_s3_uuid_uri(*,bucket):
     
     return s3_uri
 
+@metrics.timed('Presign')
 def generate_presigned_url(bucket,key,client_method="get_object",ttl=3600):
     try:
         url = s3.generate_presigned_url(
@@ -209,6 +174,31 @@ def generate_presigned_url(bucket,key,client_method="get_object",ttl=3600):
         print(f"Presigned URL:\n{url}")
         return url
 
+def get_response_expected_by_consumer(evaluation_key):
+    
+    return {
+        "ControlBrokerEvaluation": {
+            "Raw": {
+                "PresignedUrl": generate_presigned_url(
+                    bucket = os.environ['RawPaCResultsBucket'],
+                    key = evaluation_key
+                ),
+                "Bucket": os.environ['RawPaCResultsBucket'],
+                "Key": evaluation_key
+            },
+            "OutputHandlers":{
+                "OPA": {
+                    "PresignedUrl": generate_presigned_url(
+                        bucket = json.loads(os.environ['OutputHandlers'])['OPA']['Bucket'],
+                        key = evaluation_key
+                    ),
+                    "Bucket": json.loads(os.environ['OutputHandlers'])['OPA']['Bucket'],
+                    "Key": evaluation_key
+                }
+            }
+        }
+    }
+
 def format_response_expected_by_consumer(response_expected_by_consumer):
     
     from collections.abc import MutableMapping
@@ -226,8 +216,13 @@ def format_response_expected_by_consumer(response_expected_by_consumer):
     
     return response_expected_by_consumer
     
+@metrics.instrument
 def lambda_handler(event,context):
     
+    # this invocation's time budget, less what it needs to answer
+    
+    deadline = Deadline.from_context(context,margin_ms=DEADLINE_MARGIN_MS)
+    
     print(f'event:\n{event}\ncontext:\n{context}')
     
     # instantiate
@@ -252,71 +247,74 @@ def lambda_handler(event,context):
     
     fail_fast = r.fail_fast()
     
+    metrics.set_input_type(r.validated_input_type)
+    
     if fail_fast:
         return fail_fast
     
-    # set response
+    # batch form: "Inputs" is a list of templates, all evaluated by a single Eval Engine invocation
     
-    evaluation_key = f'cb-{generate_uuid()}'
+    is_batch = 'Inputs' in request_json_body
     
-    response_expected_by_consumer = {
-        "ControlBrokerEvaluation": {
-            "Raw": {
-                "PresignedUrl": generate_presigned_url(
-                    bucket = os.environ['RawPaCResultsBucket'],
-                    key = evaluation_key
-                ),
-                "Bucket": os.environ['RawPaCResultsBucket'],
-                "Key": evaluation_key
-            },
-            "OutputHandlers":{
-                "OPA": {
-                    "PresignedUrl": generate_presigned_url(
-                        bucket = json.loads(os.environ['OutputHandlers'])['OPA']['Bucket'],
-                        key = evaluation_key
-                    ),
-                    "Bucket": json.loads(os.environ['OutputHandlers'])['OPA']['Bucket'],
-                    "Key": evaluation_key
-                }
-            }
-        }
-    }
+    consumer_inputs = request_json_body['Inputs'] if is_batch else [request_json_body['Input']]
     
-    # set input
+    # a repeat of a recent request, or of its Idempotency-Key, is answered with the evaluation already issued
     
-    input_to_be_evaluated = {
-        'Bucket':os.environ['CloudFormationRawInputsBucket'],
-        'Key':evaluation_key
-    }
-    
-    put_object(
-        bucket = input_to_be_evaluated['Bucket'],
-        key = input_to_be_evaluated['Key'],
-        object_ = request_json_body['Input']
-    )
+    try:
+        claim = request_coalescer.claim_request(
+            scope = metrics.handler,
+            headers = headers,
+            consumer_metadata = r.consumer_metadata,
+            input_type = r.validated_input_type,
+            context = r.approved_context,
+            input = consumer_inputs if is_batch else consumer_inputs[0],
+            evaluation_keys = [f'cb-{generate_uuid()}' for _ in consumer_inputs],
+            lease_seconds = deadline.remaining()
+        )
+    except IdempotencyKeyReused as e:
+        return error_response(422,{'Error': str(e)})
     
-    eval_engine_input =  {
-        "InputToBeEvaluated": input_to_be_evaluated,
-        "ConsumerMetadata": r.consumer_metadata, 
-        "Context": r.approved_context,
-        "InputType": r.validated_input_type,
-        "ResponseExpectedByConsumer": response_expected_by_consumer
-    }
+    # set response, one evaluation key per input
     
-    print(f'eval_engine_input:\n{eval_engine_input}')
+    evaluation_keys = claim.evaluation_keys
     
-    # sign request
+    responses_expected_by_consumer = [get_response_expected_by_consumer(evaluation_key) for evaluation_key in evaluation_keys]
     
-    sign_request(
-        full_invoke_url = headers['x-eval-engine-invoke-url'],
+    eval_engine_response = submit_evaluation(
+        claim = claim,
+        eval_engine_input = {
+            "ConsumerMetadata": r.consumer_metadata,
+            "Context": r.approved_context,
+            "InputType": r.validated_input_type
+        },
+        inputs = [
+            {
+                'Location': {
+                    'Bucket':os.environ['CloudFormationRawInputsBucket'],
+                    'Key':evaluation_key
+                },
+                'Object': consumer_input,
+                'ResponseExpectedByConsumer': response_expected_by_consumer
+            } for evaluation_key, consumer_input, response_expected_by_consumer in zip(evaluation_keys,consumer_inputs,responses_expected_by_consumer)
+        ],
+        batch = is_batch,
+        put = put_object,
+        metrics = metrics,
+        full_invoke_url = headers.get('x-eval-engine-invoke-url'),
         region = region,
-        input = eval_engine_input
+        deadline = deadline
     )
     
+    # no presigned URLs for results that will never be written
+    
+    if eval_engine_response and eval_engine_response['StatusCode'] >= 400:
+        return engine_error_response(eval_engine_response)
+    
     # set response
     
     control_broker_request_status = {
         "Request":{
+            "Coalesced": claim.coalesced,
             # "Content": request_json_body,
             "Requestor": {
                 "IsAuthorized": r.requestor_is_authorized
@@ -328,9 +326,21 @@ def lambda_handler(event,context):
                 "IsApproved":bool(r.approved_context)
             }
         },
-        "Response": format_response_expected_by_consumer(response_expected_by_consumer)
     }
     
+    if is_batch:
+        control_broker_request_status['Responses'] = [
+            format_response_expected_by_consumer(response_expected_by_consumer)
+            for response_expected_by_consumer in responses_expected_by_consumer
+        ]
+        
+        # per-input status and timings as reported by the Eval Engine
+        
+        if eval_engine_response and isinstance(eval_engine_response['Content'],dict):
+            control_broker_request_status['Batch'] = eval_engine_response['Content'].get('Batch')
+    else:
+        control_broker_request_status['Response'] = format_response_expected_by_consumer(responses_expected_by_consumer[0])
+    
     print(f'control_broker_request_status:\n{control_broker_request_status}')
     
     return control_broker_request_status
\ No newline at end of file
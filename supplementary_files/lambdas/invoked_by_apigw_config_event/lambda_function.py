@@ -1,22 +1,25 @@
 import json
-import re
 import os
 import uuid
 
-import boto3
 from botocore.exceptions import ClientError
 
-import requests
-from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
+from clients import LazyClient
+from instrumentation import Metrics
+from deadlines import Deadline
+from transport import DEADLINE_MARGIN_MS, engine_error_response, error_response, submit_evaluation
+from coalescing import IdempotencyKeyReused, request_coalescer
 
-session = boto3.session.Session()
-region = session.region_name
-account_id = boto3.client('sts').get_caller_identity().get('Account')
+# set by the Lambda runtime, no session needed
+region = os.environ['AWS_REGION']
 
-s3 = boto3.client('s3')
-cfn = boto3.client('cloudformation')
-cloudcontrol = boto3.client('cloudcontrol')
+s3 = LazyClient('s3')
+cfn = LazyClient('cloudformation')
+cloudcontrol = LazyClient('cloudcontrol')
 
+metrics = Metrics(handler='ConfigEvent')
+
+@metrics.timed('InputDownload')
 def get_object(*,bucket,key):
     
     try:
@@ -33,6 +36,7 @@ def get_object(*,bucket,key):
         content = json.loads(body.read().decode('utf-8'))
         return content
 
+@metrics.timed('InputUpload')
 def put_object(*,bucket,key,object_:dict):
     try:
         r = s3.put_object(
@@ -274,6 +278,7 @@ class ConfigEventToCloudFormationConverter():
         
         return self.cfn
     
+@metrics.timed('InputConversion')
 def convert_config_event_to_cfn(*,config_event_input_to_be_evaluated):
         
     c = ConfigEventToCloudFormationConverter(config_event_input_to_be_evaluated)
@@ -282,45 +287,6 @@ def convert_config_event_to_cfn(*,config_event_input_to_be_evaluated):
     
     return modified_input_to_be_evaluated
     
-def sign_request(*,
-    full_invoke_url:str,
-    region:str,
-    input:dict,
-):
-    
-    def get_host(full_invoke_url):
-        m = re.search('https://(.*)/.*',full_invoke_url)
-        return m.group(1)
-    
-    host = get_host(full_invoke_url)
-    
-    auth = BotoAWSRequestsAuth(
-        aws_host= host,
-        aws_region=region,
-        aws_service='execute-api'
-    )
-    
-    print(f'begin request\nfull_invoke_url\n{full_invoke_url}\njson input\n{input}')
-    
-    r = requests.post(
-        full_invoke_url,
-        auth = auth,
-        json = input
-    )
-    
-    print(f'signed request headers:\n{dict(r.request.headers)}')
-    
-    content = json.loads(r.content)
-    
-    r = {
-        'StatusCode':r.status_code,
-        'Content': content
-    }
-    
-    print(f'formatted response:\n{r}')
-    
-    return True
-    
 def generate_uuid():
     return str(uuid.uuid4())
 
@@ -332,6 +298,7 @@ def generate_s3_uuid_uri(*,bucket):
     
     return s3_uri
 
+@metrics.timed('Presign')
 def generate_presigned_url(bucket,key,client_method="get_object",ttl=3600):
     try:
         url = s3.generate_presigned_url(
@@ -365,8 +332,13 @@ def format_response_expected_by_consumer(response_expected_by_consumer):
     
     return response_expected_by_consumer
 
+@metrics.instrument
 def lambda_handler(event,context):
     
+    # this invocation's time budget, less what it needs to answer
+    
+    deadline = Deadline.from_context(context,margin_ms=DEADLINE_MARGIN_MS)
+    
     print(f'event:\n{event}\ncontext:\n{context}')
     
     # instantiate
@@ -391,12 +363,30 @@ def lambda_handler(event,context):
     
     fail_fast = r.fail_fast()
     
+    metrics.set_input_type(r.validated_input_type)
+    
     if fail_fast:
         return fail_fast
     
+    # a repeat of a recent request, or of its Idempotency-Key, is answered with the evaluation already issued
+    
+    try:
+        claim = request_coalescer.claim_request(
+            scope = metrics.handler,
+            headers = headers,
+            consumer_metadata = r.consumer_metadata,
+            input_type = r.validated_input_type,
+            context = r.approved_context,
+            input = request_json_body['Input'],
+            evaluation_keys = [f'cb-{generate_uuid()}'],
+            lease_seconds = deadline.remaining()
+        )
+    except IdempotencyKeyReused as e:
+        return error_response(422,{'Error': str(e)})
+    
     # set response
     
-    evaluation_key = f'cb-{generate_uuid()}'
+    evaluation_key = claim.evaluation_keys[0]
     
     response_expected_by_consumer = {
         "ControlBrokerEvaluation": {
@@ -421,51 +411,42 @@ def lambda_handler(event,context):
         }
     }
     
-    original_input_to_be_evaluated = request_json_body['Input']
-    
-    print(f'original_input_to_be_evaluated:\n{original_input_to_be_evaluated}')
-    
-    converted_input_to_be_evaluated_object = convert_config_event_to_cfn(
-        config_event_input_to_be_evaluated = original_input_to_be_evaluated
-    )
-    
-    print(f'converted_input_to_be_evaluated_object:\n{converted_input_to_be_evaluated_object}')
-    
-    # set input
-    
-    input_to_be_evaluated = {
-        'Bucket' : os.environ['ConfigEventsConvertedInputsBucket'],
-        'Key' : evaluation_key,
-    }
-        
-    put_object(
-        bucket = input_to_be_evaluated['Bucket'],
-        key = input_to_be_evaluated['Key'],
-        object_ = converted_input_to_be_evaluated_object
+    eval_engine_response = submit_evaluation(
+        claim = claim,
+        eval_engine_input = {
+            "ConsumerMetadata": r.consumer_metadata,
+            "Context": r.approved_context,
+            "InputType": r.validated_input_type
+        },
+        inputs = [
+            {
+                'Location': {
+                    'Bucket':os.environ['ConfigEventsConvertedInputsBucket'],
+                    'Key':evaluation_key
+                },
+                'Object': request_json_body['Input'],
+                'ResponseExpectedByConsumer': response_expected_by_consumer
+            }
+        ],
+        batch = False,
+        put = put_object,
+        metrics = metrics,
+        full_invoke_url = headers.get('x-eval-engine-invoke-url'),
+        region = region,
+        deadline = deadline,
+        convert = lambda input_: convert_config_event_to_cfn(config_event_input_to_be_evaluated=input_)
     )
     
-    eval_engine_input =  {
-        "InputToBeEvaluated": input_to_be_evaluated,
-        "ConsumerMetadata": r.consumer_metadata, 
-        "Context": r.approved_context,
-        "InputType": r.validated_input_type,
-        "ResponseExpectedByConsumer": response_expected_by_consumer
-    }
+    # no presigned URLs for results that will never be written
     
-    print(f'eval_engine_input:\n{eval_engine_input}')
-    
-    # sign request
-    
-    sign_request(
-        full_invoke_url = headers['x-eval-engine-invoke-url'],
-        region = region,
-        input = eval_engine_input
-    )
+    if eval_engine_response and eval_engine_response['StatusCode'] >= 400:
+        return engine_error_response(eval_engine_response)
     
     # set response
     
     control_broker_request_status = {
         "Request":{
+            "Coalesced": claim.coalesced,
             "Content": request_json_body,
             "Requestor": {
                 "IsAuthorized": r._requestor_is_authorized
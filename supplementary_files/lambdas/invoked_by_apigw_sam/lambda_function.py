@@ -1,19 +1,21 @@
 import json
-import re
 import os
 import uuid
 
-import boto3
 from botocore.exceptions import ClientError
 
-import requests
-from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
+from clients import LazyClient
+from instrumentation import Metrics
+from deadlines import Deadline
+from transport import DEADLINE_MARGIN_MS, engine_error_response, error_response, submit_evaluation
+from coalescing import IdempotencyKeyReused, request_coalescer
 
-s3 = boto3.client('s3')
+# set by the Lambda runtime, no session needed
+region = os.environ['AWS_REGION']
 
-session = boto3.session.Session()
-region = session.region_name
-account_id = boto3.client('sts').get_caller_identity().get('Account')
+s3 = LazyClient('s3')
+
+metrics = Metrics(handler='SAM')
 
 class RequestParser():
     
@@ -126,45 +128,7 @@ class RequestParser():
         
         self.get_approved_context()
         
-def sign_request(*,
-    full_invoke_url:str,
-    region:str,
-    input:dict,
-):
-    
-    def get_host(full_invoke_url):
-        m = re.search('https://(.*)/.*',full_invoke_url)
-        return m.group(1)
-    
-    host = get_host(full_invoke_url)
-    
-    auth = BotoAWSRequestsAuth(
-        aws_host= host,
-        aws_region=region,
-        aws_service='execute-api'
-    )
-    
-    print(f'begin request\nfull_invoke_url\n{full_invoke_url}\njson input\n{input}')
-    
-    r = requests.post(
-        full_invoke_url,
-        auth = auth,
-        json = input
-    )
-    
-    print(f'signed request headers:\n{dict(r.request.headers)}')
-    
-    content = json.loads(r.content)
-    
-    r = {
-        'StatusCode':r.status_code,
-        'Content': content
-    }
-    
-    print(f'formatted response:\n{r}')
-    
-    return True
-
+@metrics.timed('InputUpload')
 def put_object(*,bucket,key,object_:dict):
     
     print(f'begin put_object\nbucket:\n{bucket}\nkey:\n{key}')
@@ -193,6 +157,7 @@ def generate_s3_uuid_uri(*,bucket):
     
     return s3_uri
 
+@metrics.timed('Presign')
 def generate_presigned_url(bucket,key,client_method="get_object",ttl=3600):
     try:
         url = s3.generate_presigned_url(
@@ -226,8 +191,13 @@ def format_response_expected_by_consumer(response_expected_by_consumer):
     
     return response_expected_by_consumer
     
+@metrics.instrument
 def lambda_handler(event,context):
     
+    # this invocation's time budget, less what it needs to answer
+    
+    deadline = Deadline.from_context(context,margin_ms=DEADLINE_MARGIN_MS)
+    
     print(f'event:\n{event}\ncontext:\n{context}')
     
     # instantiate
@@ -252,12 +222,30 @@ def lambda_handler(event,context):
     
     fail_fast = r.fail_fast()
     
+    metrics.set_input_type(r.validated_input_type)
+    
     if fail_fast:
         return fail_fast
     
+    # a repeat of a recent request, or of its Idempotency-Key, is answered with the evaluation already issued
+    
+    try:
+        claim = request_coalescer.claim_request(
+            scope = metrics.handler,
+            headers = headers,
+            consumer_metadata = r.consumer_metadata,
+            input_type = r.validated_input_type,
+            context = r.approved_context,
+            input = request_json_body['Input'],
+            evaluation_keys = [f'cb-{generate_uuid()}'],
+            lease_seconds = deadline.remaining()
+        )
+    except IdempotencyKeyReused as e:
+        return error_response(422,{'Error': str(e)})
+    
     # set response
     
-    evaluation_key = f'cb-{generate_uuid()}'
+    evaluation_key = claim.evaluation_keys[0]
     
     response_expected_by_consumer = {
         "ControlBrokerEvaluation": {
@@ -282,41 +270,41 @@ def lambda_handler(event,context):
         }
     }
     
-    # set input
-    
-    input_to_be_evaluated = {
-        'Bucket':os.environ['SAMInputsBucket'],
-        'Key':evaluation_key
-    }
-    
-    put_object(
-        bucket = input_to_be_evaluated['Bucket'],
-        key = input_to_be_evaluated['Key'],
-        object_ = request_json_body['Input']
+    eval_engine_response = submit_evaluation(
+        claim = claim,
+        eval_engine_input = {
+            "ConsumerMetadata": r.consumer_metadata,
+            "Context": r.approved_context,
+            "InputType": r.validated_input_type
+        },
+        inputs = [
+            {
+                'Location': {
+                    'Bucket':os.environ['SAMInputsBucket'],
+                    'Key':evaluation_key
+                },
+                'Object': request_json_body['Input'],
+                'ResponseExpectedByConsumer': response_expected_by_consumer
+            }
+        ],
+        batch = False,
+        put = put_object,
+        metrics = metrics,
+        full_invoke_url = headers.get('x-eval-engine-invoke-url'),
+        region = region,
+        deadline = deadline
     )
     
-    eval_engine_input =  {
-        "InputToBeEvaluated": input_to_be_evaluated,
-        "ConsumerMetadata": r.consumer_metadata, 
-        "Context": r.approved_context,
-        "InputType": r.validated_input_type,
-        "ResponseExpectedByConsumer": response_expected_by_consumer
-    }
-    
-    print(f'eval_engine_input:\n{eval_engine_input}')
+    # no presigned URLs for results that will never be written
     
-    # sign request
-    
-    sign_request(
-        full_invoke_url = headers['x-eval-engine-invoke-url'],
-        region = region,
-        input = eval_engine_input
-    )
+    if eval_engine_response and eval_engine_response['StatusCode'] >= 400:
+        return engine_error_response(eval_engine_response)
     
     # set response
     
     control_broker_request_status = {
         "Request":{
+            "Coalesced": claim.coalesced,
             # "Content": request_json_body,
             "Requestor": {
                 "IsAuthorized": r.requestor_is_authorized
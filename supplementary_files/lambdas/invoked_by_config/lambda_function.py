@@ -4,16 +4,10 @@ import os
 import re
 
 from botocore.exceptions import ClientError
-from datetime import datetime
 
-import requests
-from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
+# set by the Lambda runtime, no session needed
+region = os.environ['AWS_REGION']
 
-session = boto3.session.Session()
-region = session.region_name
-account_id = boto3.client('sts').get_caller_identity().get('Account')
-
-sfn = boto3.client("stepfunctions")
 s3 = boto3.client("s3")
 
 def put_object(bucket,key,object_:dict):
@@ -52,6 +46,11 @@ class SimpleControlBrokerClient():
         
     def invoke_endpoint(self):
         
+        # only needed to call the endpoint, so not imported at init
+        
+        import requests
+        from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
+        
         def get_host(*,full_invoke_url):
             m = re.search('https://(.*)/.*',full_invoke_url)
             return m.group(1)
@@ -1,16 +1,18 @@
+import gzip
 import json
-import subprocess
-import shutil
-import re
 import os
-from pathlib import Path
 
-import boto3
 from botocore.exceptions import ClientError
 
-eb = boto3.client('events')
-s3 = boto3.client('s3')
+from clients import LazyClient
+from instrumentation import Metrics
 
+metrics = Metrics(handler='OutputHandlerOPA')
+
+eb = LazyClient('events') # only used when there are infractions
+s3 = LazyClient('s3')
+
+@metrics.timed('ResultDownload')
 def get_object(*,bucket,key):
     
     try:
@@ -23,10 +25,14 @@ def get_object(*,bucket,key):
         raise
     else:
         print(f'no ClientError get_object:\nbucket:\n{bucket}\nkey:\n{key}\n')
-        body = r['Body']
-        content = json.loads(body.read().decode('utf-8'))
+        body = r['Body'].read()
+        # raw results are uploaded gzipped by the Eval Engine
+        if r.get('ContentEncoding') == 'gzip':
+            body = gzip.decompress(body)
+        content = json.loads(body.decode('utf-8'))
         return content
 
+@metrics.timed('ResultUpload')
 def put_object(bucket,key,object_:dict):
     print(f'put_object\nbucket:\n{bucket}\nKey:\n{key}')
     try:
@@ -41,6 +47,7 @@ def put_object(bucket,key,object_:dict):
     else:
         return True
         
+@metrics.timed('PutEvents')
 def put_event_entry(*,
     event_bus_name:str,
     detail:dict,
@@ -90,7 +97,9 @@ def parse_pac_results(pac_results):
     
     opa_eval_results = pac_results
     
-    reserved_keys = ['ApprovedContext','EvaluationContext','InputType']
+    metrics.set_input_type((opa_eval_results.get('EvalEngine') or {}).get('InputType'))
+    
+    reserved_keys = ['ApprovedContext','EvaluationContext','InputType','EvalEngine']
 
     for k in reserved_keys:
         opa_eval_results.pop(k,None)
@@ -101,10 +110,17 @@ def parse_pac_results(pac_results):
     
     print(f'infractions:\n{infractions}\n')
     
-    is_allowed = not bool(infractions)
+    # a package that ran out of time has no verdict, so the input cannot be reported compliant
+    
+    timed_out_packages = [i for i in opa_eval_results if opa_eval_results[i].get('reason') == 'timeout']
+    
+    print(f'timed_out_packages:\n{timed_out_packages}\n')
+    
+    is_allowed = not bool(infractions) and not bool(timed_out_packages)
     
-    return infractions, is_allowed  
+    return infractions, timed_out_packages, is_allowed
 
+@metrics.instrument
 def lambda_handler(event,context):
     
     print(f'event\n{event}\ncontext:\n{context}')
@@ -129,7 +145,7 @@ def lambda_handler(event,context):
 
     pac_results = invoked_by_object
     
-    infractions, is_allowed = parse_pac_results(pac_results)
+    infractions, timed_out_packages, is_allowed = parse_pac_results(pac_results)
     
     handle_infractions(
         infractions=infractions,
@@ -139,7 +155,8 @@ def lambda_handler(event,context):
     results_report = {
         "EvalEngineLambdalith": {
             "Evaluation": {
-                "IsCompliant": is_allowed
+                "IsCompliant": is_allowed,
+                "TimedOutPackages": timed_out_packages
             },
             "Infractions":infractions
         }
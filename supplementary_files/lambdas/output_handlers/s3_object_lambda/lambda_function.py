@@ -1,19 +1,18 @@
+import gzip
 import json
-import subprocess
-import shutil
-import re
 import os
-from pathlib import Path
 
-import requests
-
-import boto3
 from botocore.exceptions import ClientError
 
-eb = boto3.client('events')
-s3 = boto3.client('s3')
-s3r = boto3.resource('s3')
+from clients import LazyClient
+from instrumentation import Metrics
+
+metrics = Metrics(handler='OutputHandlerS3ObjectLambda')
+
+eb = LazyClient('events') # only used when there are infractions
+s3 = LazyClient('s3')
 
+@metrics.timed('ResultDownload')
 def get_object(*,bucket,key):
     
     try:
@@ -26,11 +25,14 @@ def get_object(*,bucket,key):
         raise
     else:
         print(f'no ClientError get_object:\nbucket:\n{bucket}\nkey:\n{key}\n')
-        body = r['Body']
-        content = json.loads(body.read().decode('utf-8'))
+        body = r['Body'].read()
+        if r.get('ContentEncoding') == 'gzip':
+            body = gzip.decompress(body)
+        content = json.loads(body.decode('utf-8'))
         return content
 
 
+@metrics.timed('PutEvents')
 def put_event_entry(*,
     event_bus_name:str,
     detail:dict,
@@ -76,6 +78,7 @@ def handle_infractions(*,infractions:list,original_object_key:str):
             original_object_key=original_object_key
         )
 
+@metrics.timed('ResultUpload')
 def s3_object_lambda_send_response(*,request_route,request_token,response_object:dict):
     
     try:
@@ -96,7 +99,9 @@ def parse_pac_results(pac_results):
     
     opa_eval_results = pac_results
     
-    reserved_keys = ['ApprovedContext','EvaluationContext','InputType']
+    metrics.set_input_type((opa_eval_results.get('EvalEngine') or {}).get('InputType'))
+    
+    reserved_keys = ['ApprovedContext','EvaluationContext','InputType','EvalEngine']
 
     for k in reserved_keys:
         opa_eval_results.pop(k,None)
@@ -107,10 +112,17 @@ def parse_pac_results(pac_results):
     
     print(f'infractions:\n{infractions}\n')
     
-    is_allowed = not bool(infractions)
+    # a package that ran out of time has no verdict, so the input cannot be reported compliant
+    
+    timed_out_packages = [i for i in opa_eval_results if opa_eval_results[i].get('reason') == 'timeout']
+    
+    print(f'timed_out_packages:\n{timed_out_packages}\n')
     
-    return infractions, is_allowed  
+    is_allowed = not bool(infractions) and not bool(timed_out_packages)
+    
+    return infractions, timed_out_packages, is_allowed
 
+@metrics.instrument
 def lambda_handler(event,context):
     
     print(f'event\n{event}\ncontext:\n{context}')
@@ -143,9 +155,20 @@ def lambda_handler(event,context):
 
     # get original
     
-    original_object_response = requests.get(original_object_s3_url)
+    import requests # only needed for the presigned inputS3Url, so not imported at init
+    
+    with metrics.phase('ResultDownload'):
+        original_object_response = requests.get(original_object_s3_url)
+    
+    # raw results are stored gzipped; requests decodes them from the Content-Encoding header,
+    # this covers a presigned response that arrives without it
+    
+    original_object_content = original_object_response.content
+    
+    if original_object_content[:2] == b'\x1f\x8b':
+        original_object_content = gzip.decompress(original_object_content)
     
-    original_object = json.loads(original_object_response.content.decode('utf-8'))
+    original_object = json.loads(original_object_content.decode('utf-8'))
     
     print(f'original_object:\n{original_object}\n')
 
@@ -153,7 +176,7 @@ def lambda_handler(event,context):
 
     pac_results = original_object
     
-    infractions, is_allowed = parse_pac_results(pac_results)
+    infractions, timed_out_packages, is_allowed = parse_pac_results(pac_results)
     
     handle_infractions(
         infractions=infractions,
@@ -163,7 +186,8 @@ def lambda_handler(event,context):
     results_report = {
         "EvalEngineLambdalith": {
             "Evaluation": {
-                "IsCompliant": is_allowed
+                "IsCompliant": is_allowed,
+                "TimedOutPackages": timed_out_packages
             },
             "Infractions":infractions
         }
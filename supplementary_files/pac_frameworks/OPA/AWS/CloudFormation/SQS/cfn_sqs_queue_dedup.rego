@@ -2,6 +2,11 @@ package cfn_sqs_queue_dedup
 
 type = "AWS::SQS::Queue"
 
+# resource-local: the verdict for a template is the merge of the verdicts for each of its resources
+# on its own, so the Eval Engine may evaluate only new or changed resources
+
+evaluation_unit = "resource"
+
 # allow:null if this policy is not applicable
 
 # not applicable if ApprovedContext != "Prod"
@@ -2,6 +2,11 @@ package sam_serverless_function_runtime
 
 type = "AWS::Serverless::Function"
 
+# resource-local: the verdict for a template is the merge of the verdicts for each of its resources
+# on its own, so the Eval Engine may evaluate only new or changed resources
+
+evaluation_unit = "resource"
+
 rule_applicable {
     data.ApprovedContext.EnvironmentEvaluation == "Prod"
     data.InputType == "SAM"
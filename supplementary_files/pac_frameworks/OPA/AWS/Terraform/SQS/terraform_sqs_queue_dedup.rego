@@ -2,6 +2,11 @@ package terraform_sqs_queue_dedup
 
 type = "aws_sqs_queue"
 
+# resource-local: the verdict for a plan is the merge of the verdicts for each of its resources
+# on its own, so the Eval Engine may evaluate large plans in resource chunks
+
+evaluation_unit = "resource"
+
 rule_applicable {
     data.ApprovedContext.EnvironmentEvaluation == "Prod"
     data.InputType == "Terraform"
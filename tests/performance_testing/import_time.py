@@ -0,0 +1,146 @@
+"""Import/init time of every Lambda package, as a cold start would pay it.
+
+Runs `python -X importtime -c "import lambda_function"` in a fresh interpreter for each
+package under supplementary_files/lambdas, with the shared layers on the path and
+placeholder environment variables, and reports the cumulative import time of the
+handler module plus its slowest imports.
+
+    python tests/performance_testing/import_time.py [--repeat 5] [--top 5] [--json]
+
+Needs the Lambda runtime dependencies (boto3, ...) installed locally. Packages that fail
+to import are reported with the error rather than stopping the run.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+
+LAMBDAS = REPO_ROOT / "supplementary_files/lambdas"
+
+LAYERS = [REPO_ROOT / "supplementary_files/lambda_layers/common"]
+
+# module-level code reads these at import, as it would inside Lambda
+
+PLACEHOLDER_ENVIRONMENT = {
+    "AWS_REGION": "us-east-1",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_LAMBDA_FUNCTION_NAME": "import-time-benchmark",
+    "PaCPoliciesBucket": "placeholder",
+    "PaCFramework": "OPA",
+    "PaCBundleKey": "OPA/bundle.tar.gz",
+    "EvaluationContext": json.dumps({"Bucket": "placeholder", "Key": "placeholder"}),
+    "OpaMode": "eval",
+}
+
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def lambda_packages():
+    return sorted(p.parent for p in LAMBDAS.glob("**/lambda_function.py"))
+
+
+def import_time(package: Path):
+
+    environment = {
+        **os.environ,
+        **PLACEHOLDER_ENVIRONMENT,
+        "PYTHONPATH": os.pathsep.join(
+            [str(layer) for layer in LAYERS] + [os.environ.get("PYTHONPATH", "")]
+        ),
+        "PYTHONDONTWRITEBYTECODE": "1",
+    }
+
+    start = time.perf_counter()
+
+    r = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import lambda_function"],
+        cwd=package,
+        env=environment,
+        capture_output=True,
+        text=True,
+    )
+
+    wall_ms = (time.perf_counter() - start) * 1000
+
+    imports = []
+    error = None
+
+    for line in r.stderr.splitlines():
+        m = IMPORT_TIME_LINE.match(line)
+        if m:
+            self_us, cumulative_us, indent, module = m.groups()
+            imports.append(
+                {
+                    "Module": module,
+                    "SelfMs": int(self_us) / 1000,
+                    "CumulativeMs": int(cumulative_us) / 1000,
+                    "Depth": len(indent) // 2,
+                }
+            )
+        elif line.strip():
+            error = line.strip()
+
+    handler = next((i for i in imports if i["Module"] == "lambda_function"), None)
+
+    return {
+        "Package": str(package.relative_to(LAMBDAS)),
+        "ImportMs": handler["CumulativeMs"] if handler else None,
+        "WallMs": round(wall_ms, 1),
+        "Imports": imports,
+        "Error": error if r.returncode else None,
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="runs per package, the median is reported")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports listed per package")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = []
+
+    for package in lambda_packages():
+
+        runs = [import_time(package) for _ in range(args.repeat)]
+
+        last = runs[-1]
+
+        import_ms = [run["ImportMs"] for run in runs if run["ImportMs"] is not None]
+
+        # slowest imports by their own time, from the last run
+        slowest = sorted(last["Imports"], key=lambda i: i["SelfMs"], reverse=True)[: args.top]
+
+        report.append(
+            {
+                "Package": last["Package"],
+                "ImportMsMedian": round(statistics.median(import_ms), 1) if import_ms else None,
+                "WallMsMedian": round(statistics.median(run["WallMs"] for run in runs), 1),
+                "Slowest": [{"Module": i["Module"], "SelfMs": i["SelfMs"]} for i in slowest],
+                "Error": last["Error"],
+            }
+        )
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    for r in report:
+        import_ms = "failed" if r["ImportMsMedian"] is None else f'{r["ImportMsMedian"]:.1f}ms'
+        print(f'{r["Package"]:<45} import {import_ms:>10}   interpreter {r["WallMsMedian"]:.1f}ms')
+        if r["Error"]:
+            print(f'    {r["Error"]}')
+        for i in r["Slowest"]:
+            print(f'    {i["SelfMs"]:>8.1f}ms  {i["Module"]}')
+
+
+if __name__ == "__main__":
+    main()
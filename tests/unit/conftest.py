@@ -0,0 +1,11 @@
+import sys
+from pathlib import Path
+
+# the Lambda layer and the engine are deployed as flat modules, so they are imported the same way here
+
+SUPPLEMENTARY_FILES = Path(__file__).parents[2] / "supplementary_files"
+
+sys.path[:0] = [
+    str(SUPPLEMENTARY_FILES / "lambda_layers/common"),
+    str(SUPPLEMENTARY_FILES / "lambdas/eval_engine_lambdalith"),
+]
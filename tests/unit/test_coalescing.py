@@ -0,0 +1,150 @@
+import pytest
+
+import transport
+from coalescing import IdempotencyKeyReused, MemoryCoalescingStore, RequestCoalescer
+from instrumentation import Metrics
+from transport import LocalQueue, submit_evaluation
+
+
+@pytest.fixture
+def coalescer():
+    return RequestCoalescer(store=MemoryCoalescingStore(), window_seconds=300)
+
+
+def claim(coalescer, *, input, evaluation_key, consumer="a", headers={}, lease_seconds=None):
+    return coalescer.claim_request(
+        scope="CloudFormation",
+        headers=headers,
+        consumer_metadata={"Consumer": consumer},
+        input_type="CloudFormation",
+        context={"a": 1},
+        input=input,
+        evaluation_keys=[evaluation_key],
+        lease_seconds=lease_seconds,
+    )
+
+
+def test_identical_requests_share_an_evaluation(coalescer):
+    first = claim(coalescer, input={"Resources": {}}, evaluation_key="first")
+    second = claim(coalescer, input={"Resources": {}}, evaluation_key="second")
+
+    assert not first.coalesced
+    assert second.coalesced
+    assert second.evaluation_keys == ["first"]
+
+
+def test_different_requests_are_not_coalesced(coalescer):
+    claim(coalescer, input={"Resources": {}}, evaluation_key="first")
+    second = claim(coalescer, input={"Resources": {"R": {}}}, evaluation_key="second")
+
+    assert not second.coalesced
+    assert second.evaluation_keys == ["second"]
+
+
+def test_different_consumers_are_not_coalesced(coalescer):
+    claim(coalescer, input={"Resources": {}}, evaluation_key="first", consumer="a")
+    second = claim(coalescer, input={"Resources": {}}, evaluation_key="second", consumer="b")
+
+    assert not second.coalesced
+    assert second.evaluation_keys == ["second"]
+
+
+def test_idempotency_key_coalesces_retries(coalescer):
+    headers = {"Idempotency-Key": "k"}
+    claim(coalescer, input={"Resources": {}}, evaluation_key="first", headers=headers)
+
+    assert claim(coalescer, input={"Resources": {}}, evaluation_key="second", headers=headers).coalesced
+
+
+def test_idempotency_key_reused_for_a_different_request(coalescer):
+    headers = {"idempotency-key": "k"}
+    claim(coalescer, input={"Resources": {}}, evaluation_key="first", headers=headers)
+
+    with pytest.raises(IdempotencyKeyReused):
+        claim(coalescer, input={"Resources": {"R": {}}}, evaluation_key="second", headers=headers)
+
+    # the rejected request's own fingerprint was released along the way
+
+    assert not claim(coalescer, input={"Resources": {"R": {}}}, evaluation_key="third").coalesced
+
+
+def test_lapsed_lease_is_not_coalesced(coalescer):
+    claim(coalescer, input={"Resources": {}}, evaluation_key="first", lease_seconds=0)
+
+    assert not claim(coalescer, input={"Resources": {}}, evaluation_key="second").coalesced
+
+
+def test_memory_store_is_bounded():
+    store = MemoryCoalescingStore(max_entries=10)
+    coalescer = RequestCoalescer(store=store)
+
+    for i in range(50):
+        claim(coalescer, input={"Resources": {str(i): {}}}, evaluation_key=str(i))
+
+    assert len(store.entries) <= 10
+    assert claim(coalescer, input={"Resources": {"49": {}}}, evaluation_key="again").coalesced
+
+
+class Submission:
+    """submit_evaluation on the local transport, with the engine's answer and the uploads recorded."""
+
+    def __init__(self, monkeypatch, coalescer):
+        self.queue = LocalQueue()
+        self.uploads = []
+        self.engine_responses = []
+        monkeypatch.setenv("EvalEngineTransport", "local")
+        monkeypatch.setattr(transport, "queue", self.queue)
+        monkeypatch.setattr(transport, "request_coalescer", coalescer)
+        monkeypatch.setattr(transport, "call_engine", lambda **kwargs: self.engine_responses.pop(0))
+
+    def __call__(self, claim, *, convert=None):
+        return submit_evaluation(
+            claim=claim,
+            eval_engine_input={"ConsumerMetadata": {}, "Context": {"a": 1}, "InputType": "CloudFormation"},
+            inputs=[
+                {
+                    "Location": {"Bucket": "inputs", "Key": claim.evaluation_keys[0]},
+                    "Object": {"Resources": {}},
+                    "ResponseExpectedByConsumer": {},
+                }
+            ],
+            batch=False,
+            put=lambda *, bucket, key, object_: self.uploads.append(key),
+            metrics=Metrics(handler="Test"),
+            full_invoke_url=None,
+            region="us-east-1",
+            deadline=None,
+            convert=convert,
+        )
+
+
+def test_submit_evaluation_skips_coalesced_requests(monkeypatch, coalescer):
+    submit = Submission(monkeypatch, coalescer)
+
+    assert submit(claim(coalescer, input={"Resources": {}}, evaluation_key="first"))["StatusCode"] == 202
+    assert submit(claim(coalescer, input={"Resources": {}}, evaluation_key="second")) is None
+    assert submit.uploads == ["first"]
+    assert len(submit.queue.messages) == 1
+
+
+def test_submit_evaluation_releases_claim_on_failure(monkeypatch, coalescer):
+    submit = Submission(monkeypatch, coalescer)
+
+    def convert(input_):
+        raise ValueError("not a template")
+
+    with pytest.raises(ValueError):
+        submit(claim(coalescer, input={"Resources": {}}, evaluation_key="first"), convert=convert)
+
+    assert not claim(coalescer, input={"Resources": {}}, evaluation_key="second").coalesced
+
+
+@pytest.mark.parametrize("status_code, coalesced", [(200, True), (504, False)])
+def test_submit_evaluation_settles_claim(monkeypatch, coalescer, status_code, coalesced):
+    submit = Submission(monkeypatch, coalescer)
+    monkeypatch.setenv("EvalEngineTransport", "http")
+    submit.engine_responses.append({"StatusCode": status_code, "Content": {}})
+
+    submit(claim(coalescer, input={"Resources": {}}, evaluation_key="first", lease_seconds=10))
+
+    assert claim(coalescer, input={"Resources": {}}, evaluation_key="second").coalesced == coalesced
@@ -0,0 +1,119 @@
+import io
+import json
+
+import pytest
+
+import deadlines
+import transport
+from deadlines import Deadline, DeadlineExceeded, retry
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(deadlines.time, "sleep", lambda seconds: None)
+
+
+class Context:
+    def get_remaining_time_in_millis(self):
+        return 10000
+
+
+def test_deadline_without_budget_never_expires():
+    deadline = Deadline.from_context(None)
+
+    assert deadline.remaining() is None
+    assert deadline.timeout(3) == 3
+    deadline.check("Test")
+
+
+def test_deadline_keeps_a_margin():
+    deadline = Deadline.from_context(Context(), margin_ms=5000)
+
+    assert 4 < deadline.timeout(29) <= 5
+    assert deadline.timeout(1) == 1
+
+    deadline.reset(1000, margin_ms=1000)
+
+    assert deadline.remaining_ms() == 0
+    with pytest.raises(DeadlineExceeded, match="Test"):
+        deadline.check("Test")
+
+
+def test_retry_raises_last_error_once_attempts_are_spent():
+    calls = []
+
+    def function():
+        calls.append(1)
+        raise ConnectionError(len(calls))
+
+    with pytest.raises(ConnectionError, match="2"):
+        retry(function, deadline=Deadline(), attempts=2)
+
+
+def test_retry_does_not_retry_past_deadline():
+    calls = []
+
+    def function():
+        calls.append(1)
+        return 503
+
+    assert retry(function, deadline=Deadline(0), retry_result=lambda status: status == 503) == 503
+    assert len(calls) == 1
+
+
+class Lambda:
+    """invoke() answering each call with the next of answers: a payload, or a ClientError code."""
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.payloads = []
+
+    def invoke(self, *, FunctionName, InvocationType, Payload):
+        from botocore.exceptions import ClientError
+
+        self.payloads.append(json.loads(Payload))
+        answer = self.answers.pop(0)
+        if isinstance(answer, str):
+            raise ClientError({"Error": {"Code": answer}}, "Invoke")
+        response = answer.pop("_response", {})
+        return {"Payload": io.BytesIO(json.dumps(answer).encode("utf-8")), **response}
+
+
+def invoke(monkeypatch, *answers, deadline=None):
+    pytest.importorskip("botocore")
+    client = Lambda(*answers)
+    monkeypatch.setattr(transport, "get_engine_lambda", lambda: client)
+    r = transport.invoke_engine(function_name="EvalEngine", input={"Input": 1}, deadline=deadline or Deadline())
+    return r, client
+
+
+def test_invoke_engine_sends_remaining_budget(monkeypatch):
+    r, client = invoke(monkeypatch, {"Raw": 1}, deadline=Deadline(10000))
+
+    assert r == {"StatusCode": 200, "Content": {"Raw": 1}}
+    body = json.loads(client.payloads[0]["body"])
+    assert body["Input"] == 1
+    assert 9000 < body["RemainingTimeMs"] <= 10000
+
+
+def test_invoke_engine_retries_throttles(monkeypatch):
+    r, client = invoke(monkeypatch, "TooManyRequestsException", {"Raw": 1})
+
+    assert r["StatusCode"] == 200
+    assert len(client.payloads) == 2
+
+
+def test_invoke_engine_reports_structured_errors(monkeypatch):
+    timeout = {"EvalEngine": {"Status": "Timeout", "Error": "OpaEval: deadline exceeded", "BudgetMs": 100}}
+
+    r, client = invoke(monkeypatch, {"statusCode": 504, "body": json.dumps(timeout)})
+
+    assert r == {"StatusCode": 504, "Content": timeout}
+    assert len(client.payloads) == 1
+
+
+def test_invoke_engine_reports_function_errors(monkeypatch):
+    r, _ = invoke(monkeypatch, {"errorMessage": "boom", "_response": {"FunctionError": "Unhandled"}})
+
+    assert r["StatusCode"] == 500
+    assert r["Content"]["Error"]["errorMessage"] == "boom"
@@ -0,0 +1,132 @@
+import json
+
+import pytest
+
+pytest.importorskip("botocore")
+
+from incremental import MergeConflict, ResourceVerdictCache, evaluate_resources, merge_documents
+
+REQUEST_DATA = {"InputType": "CloudFormation", "ApprovedContext": {}}
+
+
+class ParameterPolicy:
+    """A resource-local package: denies unencrypted buckets when the template's Env parameter defaults to prod."""
+
+    concurrent = False
+
+    def __init__(self):
+        self.inputs = []
+
+    def evaluate(self, *, request_data, input_bytes, packages, timeout=None):
+        template = json.loads(input_bytes)
+        self.inputs.append(template)
+        prod = template.get("Parameters", {}).get("Env", {}).get("Default") == "prod"
+        deny = [
+            name
+            for name, resource in template["Resources"].items()
+            if prod and not resource["Properties"].get("Encrypted")
+        ]
+        return {"data.buckets": {"allow": not deny if template["Resources"] else None, "deny": deny}}, {}
+
+
+def template(env="prod", **resources):
+    return {
+        "Parameters": {"Env": {"Type": "String", "Default": env}},
+        "Resources": {
+            name: {"Type": "AWS::S3::Bucket", "Properties": {"Encrypted": encrypted}}
+            for name, encrypted in resources.items()
+        },
+    }
+
+
+def evaluate(evaluator, cache, template_):
+    return evaluate_resources(
+        evaluator=evaluator,
+        cache=cache,
+        request_data=REQUEST_DATA,
+        template=template_,
+        packages=["data.buckets"],
+        versions={"Bundle": "1"},
+    )
+
+
+@pytest.fixture
+def cache():
+    return ResourceVerdictCache(size=100)
+
+
+def test_units_keep_the_template_sections(cache):
+    evaluator = ParameterPolicy()
+
+    results, stats = evaluate(evaluator, cache, template(A=True, B=False))
+
+    assert results == {"data.buckets": {"allow": False, "deny": ["B"]}}
+    assert stats == {"Resources": 2, "Evaluated": 3, "Reused": 0}
+    assert all(unit["Parameters"] == {"Env": {"Type": "String", "Default": "prod"}} for unit in evaluator.inputs)
+
+
+def test_unchanged_resources_are_reused(cache):
+    evaluator = ParameterPolicy()
+    evaluate(evaluator, cache, template(A=True, B=False))
+    evaluator.inputs.clear()
+
+    results, stats = evaluate(evaluator, cache, template(A=True, B=True, C=True))
+
+    assert results == {"data.buckets": {"allow": True, "deny": []}}
+    assert stats == {"Resources": 3, "Evaluated": 2, "Reused": 2}
+    assert sorted(name for unit in evaluator.inputs for name in unit["Resources"]) == ["B", "C"]
+
+
+def test_section_change_invalidates_every_unit(cache):
+    evaluator = ParameterPolicy()
+    evaluate(evaluator, cache, template(A=False, B=False))
+
+    results, stats = evaluate(evaluator, cache, template("dev", A=False, B=False))
+
+    assert results == {"data.buckets": {"allow": True, "deny": []}}
+    assert stats["Reused"] == 0
+
+
+def test_packages_are_part_of_the_key(cache):
+    evaluator = ParameterPolicy()
+    evaluate(evaluator, cache, template(A=True))
+
+    evaluate_resources(
+        evaluator=evaluator,
+        cache=cache,
+        request_data=REQUEST_DATA,
+        template=template(A=True),
+        packages=["data.buckets", "data.other"],
+        versions={"Bundle": "1"},
+    )
+
+    assert len(evaluator.inputs) == 4
+
+
+@pytest.mark.parametrize(
+    "values, allow",
+    [
+        ([True, None], True),
+        ([True, False, None], False),
+        ([None, None], None),
+    ],
+)
+def test_merge_allow(values, allow):
+    assert merge_documents([{"allow": v} for v in values], "data.a") == {"allow": allow}
+
+
+def test_merge_sets_into_sorted_union():
+    documents = [
+        {"deny": [{"Resource": "B"}, {"Resource": "A"}]},
+        {"deny": [{"Resource": "A"}], "warn": ["W"]},
+    ]
+
+    assert merge_documents(documents) == merge_documents(documents[::-1]) == {
+        "deny": [{"Resource": "A"}, {"Resource": "B"}],
+        "warn": ["W"],
+    }
+
+
+def test_merge_conflict():
+    with pytest.raises(MergeConflict, match="count"):
+        merge_documents([{"count": 1}, {"count": 2}])
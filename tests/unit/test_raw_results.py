@@ -0,0 +1,114 @@
+import gzip
+import json
+import os
+import zlib
+
+import pytest
+
+import raw_results
+from raw_results import put_raw_result, splice_eval_engine
+
+EVAL_ENGINE = {"Packages": ["a"]}
+
+
+class S3:
+    """Records put_object and the multipart calls, with the largest part seen."""
+
+    def __init__(self, fail_part=None):
+        self.objects = {}
+        self.parts = []
+        self.aborted = False
+        self.fail_part = fail_part
+
+    def put_object(self, *, Bucket, Key, Body, ContentType, ContentEncoding):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, *, Bucket, Key, ContentType, ContentEncoding):
+        return {"UploadId": "upload"}
+
+    def upload_part(self, *, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise ConnectionError()
+        self.parts.append(Body)
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, *, Bucket, Key, UploadId, MultipartUpload):
+        assert [p["PartNumber"] for p in MultipartUpload["Parts"]] == list(range(1, len(self.parts) + 1))
+        self.objects[Key] = b"".join(self.parts)
+
+    def abort_multipart_upload(self, *, Bucket, Key, UploadId):
+        self.aborted = True
+
+
+@pytest.fixture
+def part_size(monkeypatch):
+    monkeypatch.setattr(raw_results, "PART_SIZE", 1024)
+    return 1024
+
+
+def test_small_result_is_a_single_put(part_size):
+    s3 = S3()
+
+    summary = put_raw_result(s3=s3, bucket="raw", key="k", chunks=[b'{"a":', b"1}"])
+
+    assert gzip.decompress(s3.objects["k"]) == b'{"a":1}'
+    assert summary["Parts"] == 1
+    assert not s3.parts
+
+
+def test_large_chunks_are_uploaded_in_bounded_parts(part_size):
+    s3 = S3()
+    # incompressible, so every chunk compresses to many parts' worth
+    pieces = [os.urandom(64 * part_size) for _ in range(4)]
+
+    def chunks():
+        # mirrors the upload's compressor: what it has produced, less what is uploaded, is all it can hold
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        produced = 0
+        for piece in pieces:
+            yield piece
+            produced += len(compressor.compress(piece))
+            assert produced - sum(map(len, s3.parts)) < part_size
+
+    summary = put_raw_result(s3=s3, bucket="raw", key="k", chunks=chunks())
+
+    assert gzip.decompress(s3.objects["k"]) == b"".join(pieces)
+    assert summary["Parts"] == len(s3.parts)
+    assert all(len(part) == part_size for part in s3.parts[:-1])
+    assert summary["CompressedBytes"] == len(s3.objects["k"])
+
+
+def test_failed_part_aborts_the_upload(part_size):
+    s3 = S3(fail_part=2)
+
+    with pytest.raises(ConnectionError):
+        put_raw_result(s3=s3, bucket="raw", key="k", chunks=[os.urandom(64 * part_size)])
+
+    assert s3.aborted
+    assert "k" not in s3.objects
+
+
+def test_splice_streams_into_the_upload(part_size):
+    s3 = S3()
+    result = {"data": {str(i): os.urandom(64).hex() for i in range(100)}}
+    text = json.dumps(result).encode("utf-8")
+
+    put_raw_result(
+        s3=s3,
+        bucket="raw",
+        key="k",
+        chunks=splice_eval_engine((text[i : i + 1000] for i in range(0, len(text), 1000)), EVAL_ENGINE),
+    )
+
+    assert json.loads(gzip.decompress(s3.objects["k"])) == {**result, "EvalEngine": EVAL_ENGINE}
+
+
+@pytest.mark.parametrize("chunks", [[], [b""], [b"{}"], [b" { ", b"}\n"]])
+def test_splice_into_empty_result(chunks):
+    assert json.loads(b"".join(splice_eval_engine(chunks, EVAL_ENGINE))) == {"EvalEngine": EVAL_ENGINE}
+
+
+@pytest.mark.parametrize("chunks", [[b"[1]"], [b'{"a":', b"1"]])
+def test_splice_rejects_non_objects(chunks):
+    with pytest.raises(ValueError):
+        list(splice_eval_engine(chunks, EVAL_ENGINE))
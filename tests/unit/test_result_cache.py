@@ -0,0 +1,157 @@
+import datetime
+
+import pytest
+
+botocore_exceptions = pytest.importorskip("botocore.exceptions")
+
+from result_cache import DynamoDBResultCacheStore, ResultCache, S3ResultCacheStore, cache_key
+
+REQUEST_DATA = {"InputType": "CloudFormation", "ApprovedContext": {"a": 1}}
+
+
+def client_error(code, status_code):
+    return botocore_exceptions.ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status_code}}, "Operation"
+    )
+
+
+class DynamoDB:
+    """get_item and put_item over a dict, enough for DynamoDBResultCacheStore."""
+
+    def __init__(self):
+        self.items = {}
+        self.error = None
+
+    def get_item(self, *, TableName, Key):
+        if self.error:
+            raise self.error
+        item = self.items.get(Key["CacheKey"]["S"])
+        return {"Item": item} if item else {}
+
+    def put_item(self, *, TableName, Item):
+        if self.error:
+            raise self.error
+        self.items[Item["CacheKey"]["S"]] = Item
+
+
+class S3:
+    def __init__(self):
+        self.objects = {}
+        self.copies = []
+
+    def head_object(self, *, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise client_error("404", 404)
+        return {"LastModified": self.objects[Bucket, Key]}
+
+    def copy_object(self, *, CopySource, Bucket, Key, **kwargs):
+        self.objects[Bucket, Key] = datetime.datetime.now(datetime.timezone.utc)
+        self.copies.append({"CopySource": CopySource, "Bucket": Bucket, "Key": Key, **kwargs})
+
+
+@pytest.fixture
+def dynamodb():
+    return DynamoDB()
+
+
+def result_cache(dynamodb, **kwargs):
+    return ResultCache(
+        store=DynamoDBResultCacheStore(dynamodb=dynamodb, table="cache", ttl_seconds=3600),
+        s3=S3(),
+        ttl_seconds=60,
+        **kwargs,
+    )
+
+
+def age(dynamodb, key, seconds):
+    created_at = dynamodb.items[key]["CreatedAt"]
+    created_at["N"] = str(float(created_at["N"]) - seconds)
+
+
+def test_result_cache_hit_and_miss(dynamodb):
+    cache = result_cache(dynamodb)
+    cache.put(["k1", "k2"], bucket="raw", key="evaluation")
+
+    assert cache.get("missing") is None
+    for key in ("k1", "k2"):
+        entry = cache.get(key)
+        assert (entry["Bucket"], entry["Key"]) == ("raw", "evaluation")
+    assert int(dynamodb.items["k1"]["ExpiresAt"]["N"]) > float(dynamodb.items["k1"]["CreatedAt"]["N"])
+
+
+def test_result_cache_expired_entry_is_a_miss(dynamodb):
+    cache = result_cache(dynamodb)
+    cache.put(["k"], bucket="raw", key="evaluation")
+    age(dynamodb, "k", 61)
+
+    assert cache.get("k") is None
+
+
+def test_unavailable_store_is_a_miss(dynamodb):
+    cache = result_cache(dynamodb)
+    dynamodb.error = client_error("ProvisionedThroughputExceededException", 400)
+
+    cache.put(["k"], bucket="raw", key="evaluation")
+    assert cache.get("k") is None
+
+
+@pytest.mark.parametrize(
+    "serve_stale, cold, age_seconds, served",
+    [
+        ("never", True, 600, False),
+        ("cold", False, 600, False),
+        ("cold", True, 600, True),
+        ("always", False, 600, True),
+        ("always", True, 3601, False),
+    ],
+)
+def test_result_cache_serve_stale(dynamodb, serve_stale, cold, age_seconds, served):
+    cache = result_cache(dynamodb, stale_seconds=3600, serve_stale=serve_stale)
+    cache.put(["lineage"], bucket="raw", key="evaluation")
+    age(dynamodb, "lineage", age_seconds)
+
+    assert (cache.get_stale("lineage", cold=cold) is not None) == served
+
+
+def test_result_cache_copy_marks_the_raw_result(dynamodb):
+    cache = result_cache(dynamodb)
+    cache.put(["k"], bucket="raw", key="first")
+
+    cache.copy(cache.get("k"), bucket="raw", key="second", status="hit")
+
+    copy = cache.s3.copies[0]
+    assert copy["CopySource"] == {"Bucket": "raw", "Key": "first"}
+    assert copy["Key"] == "second"
+    assert copy["MetadataDirective"] == "REPLACE"
+    assert copy["ContentEncoding"] == "gzip"
+    assert copy["Metadata"] == {"result-cache": "hit"}
+
+
+def test_s3_store_keeps_copies():
+    s3 = S3()
+    store = S3ResultCacheStore(s3=s3, bucket="cache")
+
+    assert store.get("k") is None
+
+    store.put("k", bucket="raw", object_key="evaluation")
+
+    assert s3.copies[0]["CopySource"] == {"Bucket": "raw", "Key": "evaluation"}
+    assert store.get("k")["Key"] == "results/k"
+
+
+def test_result_cache_rejects_unknown_serve_stale(dynamodb):
+    with pytest.raises(ValueError):
+        result_cache(dynamodb, serve_stale="sometimes")
+
+
+def test_cache_key_depends_on_versions():
+    key = lambda versions: cache_key(
+        input_bytes=b"{}",
+        request_data=REQUEST_DATA,
+        evaluation_mode="Whole",
+        versions=versions,
+    )
+
+    assert key({"Bundle": "1"}) == key({"Bundle": "1"})
+    assert key({"Bundle": "1"}) != key({"Bundle": "2"})
+    assert key(None) != key({"Bundle": "1"})
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from transport import LocalQueue, engine_error_response
+
+
+def failing(message_ids):
+    def handler(event, context):
+        received.extend(
+            (r["messageId"], r["attributes"]["ApproximateReceiveCount"]) for r in event["Records"]
+        )
+        return {
+            "batchItemFailures": [
+                {"itemIdentifier": r["messageId"]} for r in event["Records"] if r["messageId"] in message_ids
+            ]
+        }
+
+    received = []
+    handler.received = received
+    return handler
+
+
+def test_local_queue_delivers_sqs_event():
+    queue = LocalQueue()
+    message_id = queue.send({"InputType": "CloudFormation"})
+    handler = failing(set())
+
+    queue.drain(handler)
+
+    assert handler.received == [(message_id, "1")]
+    assert not queue.messages
+    assert not queue.dead_letters
+
+
+def test_local_queue_redelivers_failed_messages():
+    queue = LocalQueue()
+    ok = queue.send({"Input": 1})
+    failed = queue.send({"Input": 2})
+    handler = failing({failed})
+
+    queue.consume(handler)
+
+    assert [m["messageId"] for m in queue.messages] == [failed]
+
+    queue.consume(failing(set()))
+
+    assert not queue.messages
+    assert not queue.dead_letters
+    assert (ok, "1") in handler.received
+
+
+def test_local_queue_moves_messages_to_dead_letters():
+    queue = LocalQueue(max_receive_count=3)
+    message_id = queue.send({"Input": 1})
+    handler = failing({message_id})
+
+    queue.drain(handler)
+
+    assert handler.received == [(message_id, "1"), (message_id, "2"), (message_id, "3")]
+    assert [m["messageId"] for m in queue.dead_letters] == [message_id]
+    assert json.loads(queue.dead_letters[0]["body"]) == {"Input": 1}
+
+
+def test_local_queue_consume_on_empty_queue():
+    assert LocalQueue().consume(failing(set())) is None
+
+
+@pytest.mark.parametrize(
+    "engine_status, status",
+    [(504, 504), (500, 500), (429, 429), (403, 502), (400, 502)],
+)
+def test_engine_error_response(engine_status, status):
+    eval_engine_response = {"StatusCode": engine_status, "Content": {"Error": "x"}}
+
+    r = engine_error_response(eval_engine_response)
+
+    assert r["statusCode"] == status
+    assert json.loads(r["body"])["EvalEngineResponse"] == eval_engine_response
@@ -0,0 +1,74 @@
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Set
+
+REGO_PACKAGE = re.compile(r"^package\s+([\w.]+)", re.MULTILINE)
+
+
+def rego_packages(pac_framework_path: Path) -> List[str]:
+    """Find every Rego package declared under a PaC framework directory.
+
+    :param pac_framework_path: Directory containing the framework's .rego policies.
+    :type pac_framework_path: Path
+    :return: Sorted, de-duplicated package names, e.g. ["cfn_sqs_queue_dedup", ...]
+    :rtype: List[str]
+    """
+    packages = set()
+    for rego_file in Path(pac_framework_path).rglob("*.rego"):
+        packages.update(REGO_PACKAGE.findall(rego_file.read_text()))
+    return sorted(packages)
+
+
+def package_path(package: str) -> str:
+    """Convert a dotted Rego package name to the slash-separated path used by
+    OPA bundle roots and entrypoints.
+
+    :param package: Rego package name, e.g. "aws.cfn.sqs"
+    :type package: str
+    :return: Path form of the package, e.g. "aws/cfn/sqs"
+    :rtype: str
+    """
+    return package.replace(".", "/")
+
+
+REGO_INPUT_TYPE = re.compile(r'data\.InputType\s*==\s*"([^"]+)"')
+
+REGO_RESOURCE_LOCAL = re.compile(r'^evaluation_unit\s*:?=\s*"resource"', re.MULTILINE)
+
+
+def policy_index(pac_framework_path: Path) -> Dict[str, Any]:
+    """Map each InputType to the Rego packages whose policies apply to it.
+
+    A package applies to an InputType when one of its files compares
+    ``data.InputType == "<InputType>"``; packages that never check InputType
+    apply to every input and are listed under "AllInputTypes". Packages that
+    declare ``evaluation_unit = "resource"`` are also listed under
+    "ResourceLocal", so templates can be evaluated for them one resource at a time.
+
+    :param pac_framework_path: Directory containing the framework's .rego policies.
+    :type pac_framework_path: Path
+    :return: {"InputTypes": {"<InputType>": [packages]}, "AllInputTypes": [packages],
+        "ResourceLocal": [packages]}
+    :rtype: Dict[str, Any]
+    """
+    input_types: Dict[str, Set[str]] = {}
+    all_input_types: Set[str] = set()
+    resource_local: Set[str] = set()
+    for rego_file in Path(pac_framework_path).rglob("*.rego"):
+        rego = rego_file.read_text()
+        packages = REGO_PACKAGE.findall(rego)
+        checked_input_types = REGO_INPUT_TYPE.findall(rego)
+        if REGO_RESOURCE_LOCAL.search(rego):
+            resource_local.update(packages)
+        if not checked_input_types:
+            all_input_types.update(packages)
+        for input_type in checked_input_types:
+            input_types.setdefault(input_type, set()).update(packages)
+    return {
+        "InputTypes": {
+            input_type: sorted(packages)
+            for input_type, packages in sorted(input_types.items())
+        },
+        "AllInputTypes": sorted(all_input_types),
+        "ResourceLocal": sorted(resource_local),
+    }
@@ -5,3 +5,5 @@ __THIS_FILE_DIR = pathlib.Path(__file__).parent
 REPO_ROOT = __THIS_FILE_DIR.parent
 
 LAMBDA_FUNCTIONS = REPO_ROOT / "supplementary_files/lambdas"
+
+PAC_FRAMEWORKS = REPO_ROOT / "supplementary_files/pac_frameworks"